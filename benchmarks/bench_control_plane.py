@@ -0,0 +1,155 @@
+"""Benchmark ray-yarn control plane against in-memory skein stand-in.
+
+Measures spec creation, cluster start, scaling, concurrent scaling, worker polling, head address
+discovery and CLI parsing with ``ray_yarn.testing.FakeSkeinClient``. Results are written as JSON and can be
+compared with a baseline to catch regressions.
+
+$ python benchmarks/bench_control_plane.py --output results.json
+$ python benchmarks/bench_control_plane.py --baseline benchmarks/baselines/control_plane.json
+"""
+import argparse
+import json
+import platform
+import statistics
+import sys
+import threading
+import time
+
+from ray_yarn import cli, core, testing
+
+_ENVIRONMENT = "python:///usr/bin/python"
+
+# regression when median is more than threshold times of baseline and above noise floor
+_DEFAULT_THRESHOLD = 1.5
+_NOISE_FLOOR_MS = 0.05
+
+
+def _measure(func, repeat, setup=None):
+    """Run func repeat times and return timings in milliseconds. setup's result is passed to func."""
+    timings = []
+    for _ in range(repeat):
+        arg = setup() if setup else None
+        start = time.perf_counter()
+        func(arg) if setup else func()
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+def _summary(timings):
+    ordered = sorted(timings)
+    return {
+        "median_ms": statistics.median(ordered),
+        "p95_ms": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+        "min_ms": ordered[0],
+        "repeat": len(ordered),
+    }
+
+
+def _new_cluster(client):
+    # without rate limit, to measure control plane overhead
+    return core.YarnCluster(environment=_ENVIRONMENT, skein_client=client, scale_interval=0)
+
+
+def _scale_concurrently(cluster, n, threads):
+    """threads scale the cluster at once, to sizes evenly spread up to n"""
+    workers = [threading.Thread(target=cluster.scale, args=(n * (i + 1) // threads,)) for i in range(threads)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+
+
+def run(args):
+    def client():
+        return testing.FakeSkeinClient(submit_latency=args.submit_latency, rpc_latency=args.rpc_latency,
+                                       kv_latency=args.kv_latency, allocation_latency=args.allocation_latency,
+                                       hosts=["host%d" % i for i in range(args.hosts)])
+
+    results = {}
+    cfg = core.RayRuntimeConfig()
+    results["make_specification"] = _summary(_measure(
+        lambda: core._make_specification(ray_runtime_cfg=cfg, environment=_ENVIRONMENT), args.repeat * 10))
+    results["cluster_start"] = _summary(_measure(lambda: _new_cluster(client()).shutdown(), args.repeat))
+    results["head_address_discovery"] = _summary(_measure(
+        lambda cluster: cluster.get_home_ip(), args.repeat, setup=lambda: _new_cluster(client())))
+
+    for n in args.scale:
+        results["scale_to_%d" % n] = _summary(_measure(
+            lambda cluster: cluster.scale(n), args.repeat, setup=lambda: _new_cluster(client())))
+
+        def scale_by_steps(cluster, n=n):
+            for i in range(args.step, n + 1, args.step):
+                cluster.scale(i)
+        results["scale_to_%d_by_%d" % (n, args.step)] = _summary(_measure(
+            scale_by_steps, max(1, args.repeat // 5), setup=lambda: _new_cluster(client())))
+
+        results["scale_to_%d_from_%d_threads" % (n, args.threads)] = _summary(_measure(
+            lambda cluster, n=n: _scale_concurrently(cluster, n, args.threads), max(1, args.repeat // 5),
+            setup=lambda: _new_cluster(client())))
+
+        cluster = _new_cluster(client())
+        cluster.scale(n)
+        results["workers_%d" % n] = _summary(_measure(cluster.workers, args.repeat))
+        cluster.shutdown()
+
+    start_args = ["start", "--head", "--block", "--num-cpus", "4", "--port", "0",
+                  "--resources", '{"res1": 1.0}', "--object-store-memory", "1000000000"]
+    results["cli_parse_start"] = _summary(_measure(lambda: cli.yarn_parser.parse_args(start_args), args.repeat * 10))
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Compare medians with baseline, returns list of regression messages"""
+    regressions = []
+    for name, summary in sorted(results.items()):
+        base = baseline.get("results", {}).get(name)
+        if base is None:
+            print("%-32s %10.3f ms   (new)" % (name, summary["median_ms"]))
+            continue
+        ratio = summary["median_ms"] / base["median_ms"] if base["median_ms"] else float("inf")
+        regressed = ratio > threshold and summary["median_ms"] - base["median_ms"] > _NOISE_FLOOR_MS
+        print("%-32s %10.3f ms   baseline %10.3f ms   x%.2f%s"
+              % (name, summary["median_ms"], base["median_ms"], ratio, "   REGRESSION" if regressed else ""))
+        if regressed:
+            regressions.append("%s is x%.2f of baseline" % (name, ratio))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--scale", type=int, nargs="+", default=[10, 100, 1000, 5000])
+    parser.add_argument("--step", type=int, default=10, help="workers added per scale call in stepwise scaling")
+    parser.add_argument("--threads", type=int, default=32, help="threads calling scale at once")
+    parser.add_argument("--hosts", type=int, default=100)
+    parser.add_argument("--submit-latency", type=float, default=0, help="seconds per submit")
+    parser.add_argument("--rpc-latency", type=float, default=0, help="seconds per application master call")
+    parser.add_argument("--kv-latency", type=float, default=0, help="seconds per kv get")
+    parser.add_argument("--allocation-latency", type=float, default=0, help="seconds to allocate a container")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    parser.add_argument("--baseline", help="JSON results to compare with, exit 1 on regression")
+    parser.add_argument("--threshold", type=float, default=_DEFAULT_THRESHOLD)
+    args = parser.parse_args(argv)
+
+    results = run(args)
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "params": {k: v for k, v in vars(args).items() if k not in ("output", "baseline", "threshold")},
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        if regressions:
+            print("\n".join(regressions), file=sys.stderr)
+            sys.exit(1)
+    elif not args.output:
+        print(json.dumps(report, indent=2, sort_keys=True))
+
+
+if __name__ == "__main__":
+    main()
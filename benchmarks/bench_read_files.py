@@ -0,0 +1,89 @@
+"""Benchmark ``ray_yarn.data.read_files`` through local filesystem stand-in.
+
+A local ray instance plays several hosts with "node:<hostname>" custom resources, and block
+locations come from ``locality.local_block_locations``. Compares parallel read with reading
+the same files sequentially in driver.
+
+$ python benchmarks/bench_read_files.py --num-files 8 --rows 2000000
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+from collections import namedtuple
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pyarrow.fs import LocalFileSystem
+import ray
+
+from ray_yarn import data, locality
+
+_FakeContainer = namedtuple("_FakeContainer", ["id", "yarn_node_http_address"])
+
+
+class _FakeCluster(object):
+    def __init__(self, hosts):
+        self._hosts = hosts
+
+    def workers(self):
+        return [_FakeContainer("ray.worker_%d" % i, "%s:8042" % h) for i, h in enumerate(self._hosts)]
+
+
+def _write_files(directory, num_files, rows, row_group_size):
+    for i in range(num_files):
+        table = pa.table({"id": pa.array(range(rows), type=pa.int64()),
+                          "value": pa.array([float(r) for r in range(rows)])})
+        pq.write_table(table, os.path.join(directory, "part-%05d.parquet" % i), row_group_size=row_group_size)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--num-files", type=int, default=8)
+    parser.add_argument("--rows", type=int, default=1000000)
+    parser.add_argument("--row-group-size", type=int, default=100000)
+    parser.add_argument("--block-size", type=int, default=4 * 2 ** 20)
+    parser.add_argument("--hosts", type=int, default=4)
+    parser.add_argument("--num-cpus", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    hosts = ["host%d" % i for i in range(args.hosts)]
+    ray.init(num_cpus=args.num_cpus, resources={"node:" + h: 1.0 for h in hosts})
+    with tempfile.TemporaryDirectory() as directory:
+        _write_files(directory, args.num_files, args.rows, args.row_group_size)
+        total_bytes = sum(os.path.getsize(os.path.join(directory, f)) for f in os.listdir(directory))
+
+        def provider(paths):
+            return locality.local_block_locations(paths, args.block_size, hosts)
+
+        start = time.perf_counter()
+        rows = 0
+        for f in sorted(os.listdir(directory)):
+            rows += pq.read_table(os.path.join(directory, f)).num_rows
+        sequential = time.perf_counter() - start
+
+        start = time.perf_counter()
+        batches = 0
+        parallel_rows = 0
+        for ref in data.read_files([directory], _FakeCluster(hosts), filesystem=LocalFileSystem(),
+                                   block_location_provider=provider):
+            parallel_rows += ray.get(ref).num_rows
+            batches += 1
+        parallel = time.perf_counter() - start
+        assert parallel_rows == rows, "read %d rows, expect %d" % (parallel_rows, rows)
+
+    print(json.dumps({
+        "benchmark": "read_files",
+        "bytes": total_bytes,
+        "rows": rows,
+        "batches": batches,
+        "sequential_seconds": sequential,
+        "parallel_seconds": parallel,
+        "parallel_mb_per_second": total_bytes / parallel / 2 ** 20,
+    }, indent=2))
+    ray.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+"""Code of jobs shipped to containers through YARN localization.
+
+Ray uploads ``runtime_env`` working_dir and py_modules to GCS on every job, and each node
+downloads them from the head, which is slow and size limited for large code bundles. Instead,
+``localize`` packs them once and adds them to container files, so that NodeManagers localize
+them in parallel at container start.
+
+A directory is packed into a zip archive with fixed timestamps, so that its content, and the
+digest ``envcache`` caches it by, only changes with the code. Packed archives are kept in a
+per-user cache directory by a fingerprint of file paths, sizes and modification times, and
+reused while the code is unchanged.
+"""
+import hashlib
+import os
+import shutil
+import tempfile
+import zipfile
+from urllib.parse import urlparse
+
+import skein
+
+from . import envcache
+
+WORKING_DIR = "working_dir"
+PY_MODULES_DIR = "py_modules"
+# localized as they are and put on the path themselves, like wheels
+_IMPORTABLE_ARCHIVES = (".zip", ".whl", ".egg")
+_EXCLUDED_DIRS = {"__pycache__", ".git", ".hg", ".svn", ".ipynb_checkpoints"}
+_EXCLUDED_SUFFIXES = (".pyc", ".pyo")
+# zip can't store times before 1980
+_ZIP_TIME = (1980, 1, 1, 0, 0, 0)
+
+
+def _bundle_dir():
+    """Cache of packed archives, private to the user, rather than shared one others could write to"""
+    cache = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache, "ray-yarn", "bundles")
+
+
+def _walk(sources):
+    """Files of sources, pairs of path in archive and local directory or file, in sorted order"""
+    for prefix, source in sources:
+        if os.path.isfile(source):
+            yield prefix, source
+            continue
+        for root, dirs, files in os.walk(source):
+            dirs[:] = sorted(d for d in dirs if d not in _EXCLUDED_DIRS)
+            for name in sorted(files):
+                if not name.endswith(_EXCLUDED_SUFFIXES):
+                    path = os.path.join(root, name)
+                    yield os.path.join(prefix, os.path.relpath(path, source)), path
+
+
+def _fingerprint(sources):
+    h = hashlib.sha256()
+    for arcname, path in _walk(sources):
+        st = os.stat(path)
+        h.update(("%s:%s:%d:%d\n" % (arcname, os.path.abspath(path), st.st_size, st.st_mtime_ns)).encode())
+    return h.hexdigest()[:16]
+
+
+def pack(name, sources):
+    """Zip archive of sources, packed unless an archive of unchanged content exists.
+
+    ``sources`` are pairs of path in archive, empty for its root, and local directory or file.
+    """
+    target = os.path.join(_bundle_dir(), "%s-%s.zip" % (name, _fingerprint(sources)))
+    if os.path.exists(target):
+        return target
+    os.makedirs(_bundle_dir(), mode=0o700, exist_ok=True)
+    # written aside and renamed, so that concurrent packs of same code don't see partial archives
+    fd, partial = tempfile.mkstemp(suffix=".zip", dir=_bundle_dir())
+    with os.fdopen(fd, "wb") as f, zipfile.ZipFile(f, "w", zipfile.ZIP_DEFLATED) as archive:
+        for arcname, path in _walk(sources):
+            info = zipfile.ZipInfo(arcname, _ZIP_TIME)
+            info.external_attr = (os.stat(path).st_mode & 0o777) << 16
+            info.compress_type = zipfile.ZIP_DEFLATED
+            with open(path, "rb") as source, archive.open(info, "w") as target_file:
+                shutil.copyfileobj(source, target_file)
+    os.replace(partial, target)
+    return target
+
+
+def _file(path, cache_dir, archive):
+    if cache_dir and not urlparse(path).scheme:
+        return skein.File(envcache.cached_archive(path, cache_dir), type="archive" if archive else "file",
+                          visibility="public")
+    return skein.File(path, type="archive" if archive else "file")
+
+
+def localize(working_dir=None, py_modules=None, cache_dir=None):
+    """Container files and python path entries, relative to container directory, of job code.
+
+    Parameters
+    ----------
+    working_dir : str, optional
+        Local directory, unpacked to ``working_dir`` in containers.
+    py_modules : List[str], optional
+        Local package directories and python files, packed together and unpacked to
+        ``py_modules`` in containers, and local or remote wheel, zip and egg files, put on the
+        path themselves.
+    cache_dir : str, optional
+        Directory on HDFS to cache packed code in by content, see ``envcache``.
+    """
+    files = {}
+    path = []
+    if working_dir:
+        if not os.path.isdir(working_dir):
+            raise ValueError("working_dir should be a local directory, got %s" % working_dir)
+        files[WORKING_DIR] = _file(pack(WORKING_DIR, [("", working_dir)]), cache_dir, True)
+        path.append(WORKING_DIR)
+    modules = []
+    names = set()
+    for module in py_modules or []:
+        name = os.path.basename(os.path.normpath(module))
+        if name in names:
+            raise ValueError("py_modules should have distinct names, %s is given twice" % name)
+        names.add(name)
+        if os.path.isdir(module) or (name.endswith(".py") and os.path.isfile(module)):
+            modules.append((name, module))
+        elif name.endswith(_IMPORTABLE_ARCHIVES) and (urlparse(module).scheme or os.path.isfile(module)):
+            files[name] = _file(module, cache_dir, False)
+            path.append(name)
+        else:
+            raise ValueError("py_modules should be package directories, python files, or wheel, zip or egg "
+                             "files, got %s" % module)
+    if modules:
+        files[PY_MODULES_DIR] = _file(pack(PY_MODULES_DIR, modules), cache_dir, True)
+        path.insert(1 if working_dir else 0, PY_MODULES_DIR)
+    return files, path
@@ -0,0 +1,108 @@
+"""Queue capacity and headroom checks before submitting an application.
+
+YARN reports queue capacities in percent. They are taken as shares of the total resources of
+running nodes, which is exact for top-level queues and an upper bound for nested ones. Queue
+capacities don't account for what other queues use beyond their guaranteed capacity, so
+headroom is also bounded by the free resources of nodes. A container can't be larger than the
+largest node, containers above it are never allocated.
+"""
+import warnings
+from collections import namedtuple
+
+from skein.model import Resources
+
+Headroom = namedtuple("Headroom", ["queue", "memory", "vcores", "percent_used"])
+Headroom.__doc__ = """Resources a queue can still allocate, in MiB and vcores, up to its maximum capacity"""
+
+CAPACITY_CHECKS = ("warn", "cap")
+
+
+def _total(resources):
+    resources = list(resources)
+    return Resources(memory=sum(r.memory for r in resources), vcores=sum(r.vcores for r in resources))
+
+
+def _free(node):
+    """Resources of ``skein.model.NodeReport`` not used by any application"""
+    total, used = node.total_resources, node.used_resources
+    return Resources(memory=max(total.memory - used.memory, 0), vcores=max(total.vcores - used.vcores, 0))
+
+
+def max_allocation(nodes):
+    """Largest container that can be allocated on given ``skein.model.NodeReport``"""
+    return Resources(memory=max((n.total_resources.memory for n in nodes), default=0),
+                     vcores=max((n.total_resources.vcores for n in nodes), default=0))
+
+
+def headroom(queue, total, free=None):
+    """Headroom of ``skein.model.Queue`` in cluster of total resources, up to free resources if given"""
+    free = free or total
+
+    def room(amount, bound):
+        # percent_used is relative to guaranteed capacity, and may exceed 100 with elasticity
+        used = amount * queue.capacity / 100 * queue.percent_used / 100
+        return min(max(int(amount * queue.max_capacity / 100 - used), 0), bound)
+    return Headroom(queue.name, room(total.memory, free.memory), room(total.vcores, free.vcores), queue.percent_used)
+
+
+def fits(room, resources):
+    """Number of containers of resources fitting in headroom"""
+    return min(room.memory // max(resources.memory, 1), room.vcores // max(resources.vcores, 1))
+
+
+def check_allocation(spec, limit):
+    """Raise ValueError if a service of ``skein.ApplicationSpec`` asks for more than limit per container"""
+    asks = [("application master", spec.master.resources)]
+    asks += [("service " + name, service.resources) for name, service in spec.services.items()]
+    for name, resources in asks:
+        if resources.memory > limit.memory or resources.vcores > limit.vcores:
+            raise ValueError("container of %s asks for %d MiB and %d vcores, above maximum allocation of "
+                             "%d MiB and %d vcores" % (name, resources.memory, resources.vcores, limit.memory,
+                                                       limit.vcores))
+
+
+def fit(skein_client, spec, worker_service, queues=None, check="warn"):
+    """Fit ``skein.ApplicationSpec`` in cluster capacity before submitting it, in place.
+
+    Rejects containers above maximum allocation, and submits to the queue among ``queues`` (by
+    default, the spec's queue) with room for most workers. Workers above its headroom are warned
+    about, or dropped from initial instances if check is "cap". Returns headroom of the queue.
+    """
+    if check not in CAPACITY_CHECKS:
+        raise ValueError("capacity check should be one of %s, got %s" % (", ".join(CAPACITY_CHECKS), check))
+    nodes = skein_client.get_nodes(states=["RUNNING"])
+    check_allocation(spec, max_allocation(nodes))
+    total = _total(n.total_resources for n in nodes)
+    free = _total(_free(n) for n in nodes)
+    rooms = []
+    for name in queues or [spec.queue]:
+        queue = skein_client.get_queue(name)
+        if str(queue.state) == "RUNNING":
+            rooms.append(headroom(queue, total, free))
+    if not rooms:
+        raise ValueError("none of queues %s is running" % ", ".join(queues or [spec.queue]))
+    workers = spec.services[worker_service]
+    others = _total([spec.master.resources] + [s.resources for name, s in spec.services.items()
+                                                if name != worker_service for _ in range(s.instances)])
+
+    def worker_room(room):
+        rest = room._replace(memory=room.memory - others.memory, vcores=room.vcores - others.vcores)
+        if rest.memory < 0 or rest.vcores < 0:
+            return -1
+        return fits(rest, workers.resources)
+
+    room = max(rooms, key=lambda r: (worker_room(r), -r.percent_used))
+    spec.queue = room.queue
+    available = worker_room(room)
+    if available < 0:
+        warnings.warn("queue %s has no room for application master and head, the application waits until "
+                      "resources are freed" % room.queue)
+    elif workers.instances > available:
+        if check == "cap":
+            warnings.warn("initial instances capped from %d to %d, the headroom of queue %s"
+                          % (workers.instances, available, room.queue))
+            workers.instances = available
+        else:
+            warnings.warn("queue %s has room for %d of %d initial instances, the rest wait until resources "
+                          "are freed" % (room.queue, available, workers.instances))
+    return room
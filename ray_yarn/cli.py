@@ -1,4 +1,6 @@
 import os
+import json
+import shutil
 from inspect import signature, Parameter
 from collections import OrderedDict
 import sys
@@ -9,13 +11,31 @@ import signal
 import psutil
 from pydoc import locate
 import socket
-import errno
-from ray.ray_constants import DEFAULT_PORT, REDIS_DEFAULT_PASSWORD
+import functools
+import ipaddress
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from ray.ray_constants import REDIS_DEFAULT_PASSWORD, DEFAULT_OBJECT_STORE_MEMORY_PROPORTION
 import skein
 from skein.utils import humanize_timedelta, format_table
+import ray
 import ray_yarn
-from ray_yarn import core
-from .core import _append_args, _get_skein_client, _RAY_HEAD_ADDRESS, _get_or_wait_kv
+from ray_yarn import core, config
+from ray_yarn import pool as cluster_pool
+from ray_yarn import idle
+from ray_yarn import planner
+from ray_yarn import schema
+from ray_yarn import spill
+from ray_yarn import topology
+from ray_yarn import usage
+from .core import _append_args, _get_skein_client, _RAY_HEAD_ADDRESS, _RAY_CLIENT_ADDRESS, _RAY_PORTS_PREFIX, \
+    _HOST_RESOURCE_PREFIX, _RAY_SHUTDOWN, _DRAIN_PREFIX, _DRAINING_PREFIX, _WORKER_SERVICE, _get_or_wait_kv, \
+    _ENV_NODE_IP_INTERFACE, _ENV_NODE_IP_CIDR, _ENV_SPILL_DIR, _DRIVERS_PREFIX, _ENV_DRIVER_ID, \
+    _ENV_USAGE_INTERVAL, _ENV_IDLE_TIMEOUT, _ENV_IDLE_SHUTDOWN_TIMEOUT, _IDLE, \
+    _RELEASED_PREFIX, _HEAD_SERVICE
+from .config import parse_memory
 
 # search type from annotation in format "typing.Union[...]", "<class '...'>", or "typing...."
 # E.g., typing.Union[str, NoneType], <class 'int'> and typing.Dict
@@ -33,6 +53,45 @@ _RAY_STARTED_MSG = "Ray runtime started"
 
 _PATTERN_RAY_CONNECT_INFO = r"ray\s+start\s+--address='([^']+)'\s+--redis-password='([^']+)'"
 
+_SHM_DIR = "/dev/shm"
+_RAY_TEMP_SUBDIR = "ray"
+_RAY_PLASMA_SUBDIR = "ray_plasma"
+_RAY_SPILL_SUBDIR = "ray_spill"
+# AF_UNIX path limit minus what ray appends to temp dir for its socket files, like
+# "/session_2021-01-01_00-00-00_000000_12345/sockets/plasma_store.1"
+_MAX_SOCKET_PATH_LEN = 107
+_RAY_SOCKET_SUFFIX_LEN = 66
+
+# ports allocated in container if not given or given as 0
+_NODE_PORT_ARGS = ["object_manager_port", "node_manager_port"]
+_HEAD_PORT_ARGS = ["port", "gcs_server_port", "dashboard_port", "ray_client_server_port"]
+_WORKER_PORT_ARGS = ["min_worker_port", "max_worker_port", "worker_port_list"]
+_MIN_NUM_WORKER_PORTS = 100
+_NUM_WORKER_PORTS_PER_CPU = 16
+
+# seconds to let running tasks finish when draining a worker. NodeManager should wait at least as long
+# before SIGKILL, see yarn.nodemanager.sleep-delay-before-sigkill.ms
+_DRAIN_GRACE_PERIOD = 30
+_DRAIN_POLL_INTERVAL = 0.5
+# process title of ray worker without running task
+_RAY_IDLE_WORKER = "ray::IDLE"
+# custom resource of ray node for its container, like "node:container:ray.worker_0", which pins placement groups
+# reserving the node while it drains
+_CONTAINER_RESOURCE_PREFIX = "node:container:"
+# share of container resource each of those takes
+_RESERVATION_PIN = 0.001
+
+_ADDRESS_ARG = "--%s=" % _RAY_HEAD_ADDRESS
+
+# concurrent resource manager calls of list and kill
+_MAX_REPORT_THREADS = 16
+# sleep between polls of list --watch, replaced in tests rather than time.sleep itself
+_watch_sleep = time.sleep
+# largest chunk of driver output published to kv at once
+_OUTPUT_CHUNK_SIZE = 64 * 2 ** 10
+# driver output published to kv in total, the rest is only in container log
+_MAX_DRIVER_OUTPUT = 64 * 2 ** 20
+
 
 def extract_type(annotation):
     m = _PATTERN_TYPE.match(annotation)
@@ -169,27 +228,350 @@ def _construct_args(is_head, app_client, args_list, **kwargs):
         _append_args(_RAY_HEAD_ADDRESS, value.decode(), args_list)
 
 
-def _get_ip_address():
-    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+def _get_local_dirs():
+    """YARN local dirs of current container. They are cleaned up by YARN when application finishes."""
+    return [d for d in os.environ.get("LOCAL_DIRS", "").split(',') if d]
+
+
+def _object_store_memory(kwargs):
+    if "object_store_memory" in kwargs:
+        return parse_memory(kwargs["object_store_memory"])
+    return psutil.virtual_memory().total * DEFAULT_OBJECT_STORE_MEMORY_PROPORTION
+
+
+def _place_in_local_dirs(is_head, kwargs, local_dirs, system_config):
+    """Place ray temp dir, plasma directory and spilled objects in YARN local dirs
+
+    Options already set by user are kept untouched.
+    - temp dir goes to the first local dir. Socket files are moved out of it if the path would be too long.
+    - plasma uses /dev/shm if it has enough space for object store. Otherwise, the first local dir.
+    - object spilling is configured with all local dirs so that ray spills to them in round-robin.
+      Spilling config is cluster-wide and set on head only. It assumes NodeManagers have same
+      local dirs layout which is the common case.
+    """
+    if not local_dirs:
+        return
+    container_id = os.environ.get("CONTAINER_ID", str(os.getpid()))
+    # ray workers take temp dir from head. It's the same path on all nodes given same layout.
+    temp_dir = kwargs.get("temp_dir", os.path.join(local_dirs[0], _RAY_TEMP_SUBDIR))
+    if "temp_dir" not in kwargs and is_head:
+        kwargs["temp_dir"] = temp_dir
+    if len(temp_dir) + _RAY_SOCKET_SUFFIX_LEN > _MAX_SOCKET_PATH_LEN:
+        socket_dir = os.path.join("/tmp", "ray-" + container_id)
+        kwargs.setdefault("plasma_store_socket_name", os.path.join(socket_dir, "plasma_store"))
+        kwargs.setdefault("raylet_socket_name", os.path.join(socket_dir, "raylet"))
+    if "plasma_directory" not in kwargs:
+        try:
+            shm_free = shutil.disk_usage(_SHM_DIR).free
+        except OSError:
+            shm_free = 0
+        if shm_free >= _object_store_memory(kwargs):
+            kwargs["plasma_directory"] = _SHM_DIR
+        else:
+            kwargs["plasma_directory"] = os.path.join(local_dirs[0], _RAY_PLASMA_SUBDIR, container_id)
+            os.makedirs(kwargs["plasma_directory"], exist_ok=True)
+    if is_head and "object_spilling_config" not in system_config:
+        spill_dirs = [os.path.join(d, _RAY_SPILL_SUBDIR) for d in local_dirs]
+        system_config["object_spilling_config"] = json.dumps(
+            {"type": "filesystem", "params": {"directory_path": spill_dirs}})
+
+
+def _add_node_resources(kwargs):
+    """Add custom resources of container host, like "node:<hostname>", so that tasks can be placed by host, and
+    of the container itself"""
+    names = [_CONTAINER_RESOURCE_PREFIX + os.environ["SKEIN_CONTAINER_ID"]] if "SKEIN_CONTAINER_ID" in os.environ \
+        else []
+    if os.environ.get("NM_HOST"):
+        names.append(_HOST_RESOURCE_PREFIX + os.environ["NM_HOST"])
+    if not names:
+        return
+    resources = kwargs.get("resources") or {}
+    if isinstance(resources, str):
+        resources = json.loads(resources)
+    for name in names:
+        resources.setdefault(name, 1.0)
+    # no space so that it's passed to ray as one unquoted argument
+    kwargs["resources"] = json.dumps(resources, separators=(',', ':'))
+
+
+def _get_free_ports(n):
+    """Get n distinct free ports by binding them at the same time"""
+    sockets = []
+    try:
+        for _ in range(n):
+            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sockets.append(s)
+            s.bind(("", 0))
+        return [s.getsockname()[1] for s in sockets]
+    finally:
+        for s in sockets:
+            s.close()
+
+
+def _allocate_ports(is_head, kwargs):
+    """Allocate free ports for ray processes in current container
+
+    Ports not given or given as 0 are allocated so that multiple ray nodes can share same host.
+    Worker ports are allocated as 'worker_port_list' if none of worker port options is given, by
+    vcores of the container, as ``num_cpus`` is not passed to ``ray-yarn start``.
+
+    Returns
+    -------
+    Dict of allocated port name to port
+    """
+    names = [n for n in (_HEAD_PORT_ARGS + _NODE_PORT_ARGS if is_head else _NODE_PORT_ARGS) if not kwargs.get(n)]
+    num_worker_ports = 0
+    if not any(kwargs.get(n) for n in _WORKER_PORT_ARGS):
+        vcores = int(os.environ.get("SKEIN_RESOURCE_VCORES") or 1)
+        num_worker_ports = max(_MIN_NUM_WORKER_PORTS, vcores * _NUM_WORKER_PORTS_PER_CPU)
+    free_ports = _get_free_ports(len(names) + num_worker_ports)
+    ports = dict(zip(names, free_ports))
+    if num_worker_ports:
+        for n in _WORKER_PORT_ARGS:
+            kwargs.pop(n, None)
+        ports["worker_port_list"] = ",".join(str(p) for p in free_ports[len(names):])
+    kwargs.update(ports)
+    return ports
+
+
+def _get_container_id():
+    """Skein container id, like ray.worker_0"""
+    return os.environ.get("SKEIN_CONTAINER_ID", str(os.getpid()))
+
+
+def _ports(kwargs):
+    names = _HEAD_PORT_ARGS + _NODE_PORT_ARGS + _WORKER_PORT_ARGS
+    return {n: kwargs[n] for n in names if kwargs.get(n)}
+
+
+def _publish_ports(app_client, kwargs):
+    """Publish real ports of current container to kv"""
+    app_client.kv[_RAY_PORTS_PREFIX + _get_container_id()] = json.dumps(_ports(kwargs)).encode()
+
+
+def _publish_node(app_client, gcs_address, kwargs):
+    """Publish ``topology.NodeInfo`` of current container to kv once its ray node registered with GCS"""
+    ip = kwargs["node_ip_address"]
+    try:
+        node_id = topology.find_node_id(gcs_address, ip, kwargs["node_manager_port"])
+    except TimeoutError as e:
+        print(e)
+        return
+    host = os.environ.get("NM_HOST") or socket.gethostname()
+    topology.publish(app_client.kv, topology.NodeInfo(_get_container_id(), node_id, host, ip, _ports(kwargs)))
+    print("ray node %s registered" % node_id)
+    sys.stdout.flush()
+
+
+def _busy_workers(pid):
+    """Number of ray worker processes running tasks under process pid"""
+    try:
+        parent = psutil.Process(pid)
+    except psutil.NoSuchProcess:
+        return 0
+    busy = 0
+    for process in parent.children(recursive=True):
+        try:
+            cmdline = process.cmdline()
+        except psutil.Error:
+            continue
+        if cmdline and cmdline[0].startswith("ray::") and not cmdline[0].startswith(_RAY_IDLE_WORKER):
+            busy += 1
+    return busy
+
+
+def _refuse_new_tasks(gcs_address, kwargs):
+    """Reserve free CPU and GPU of ray node of current container so that no new task is scheduled to it.
+
+    Returns a callable reserving what running tasks freed since. Ray 1.13 dropped dynamic resources,
+    like ``ray.experimental.set_resource``, so they're reserved in placement groups of a driver of
+    this process, pinned to the node by its container resource. They go with the driver, see
+    ``ray.shutdown``. Best-effort, a queued task may take freed resources first. Objects are not
+    moved, ray spills or reconstructs them as usual.
+    """
+    from ray.util.placement_group import placement_group
+    pin = _CONTAINER_RESOURCE_PREFIX + _get_container_id()
     try:
-        # This command will raise an exception if there is no internet
-        # connection.
-        s.connect(("8.8.8.8", 53))
-        node_ip_address = s.getsockname()[0]
-    except OSError as e:
-        node_ip_address = "127.0.0.1"
-        # [Errno 101] Network is unreachable
-        if e.errno == errno.ENETUNREACH:
-            try:
-                # try get node ip address from host name
-                host_name = socket.getfqdn(socket.gethostname())
-                node_ip_address = socket.gethostbyname(host_name)
-            except Exception:
-                pass
+        # the cluster of this container and its own node, other clusters may run on same host
+        node_id = topology.find_node_id(gcs_address, kwargs["node_ip_address"], kwargs["node_manager_port"],
+                                        timeout=0)
+        state = topology.gcs_state(gcs_address)
+        ray.init(address=gcs_address, _redis_password=kwargs.get("redis_password") or REDIS_DEFAULT_PASSWORD,
+                 logging_level=logging.ERROR)
+    except Exception as e:
+        print("failed to refuse new tasks: %s" % e)
+        return lambda: None
+
+    def reserve():
+        try:
+            available = state._available_resources_per_node().get(node_id, {})
+            bundle = {r: available[r] for r in ["CPU", "GPU"] if available.get(r, 0) > 0}
+            if bundle and available.get(pin, 0) >= _RESERVATION_PIN:
+                bundle[pin] = _RESERVATION_PIN
+                placement_group([bundle])
+        except Exception as e:
+            print("failed to refuse new tasks: %s" % e)
+    reserve()
+    return reserve
+
+
+def _drain(app_client, pid, replace, gcs_address, kwargs, grace_period=_DRAIN_GRACE_PERIOD):
+    """Drain ray worker before its container is killed
+
+    Publishes draining state to kv, requests a replacement container ahead of the kill if asked
+    and the container is preempted, rather than released on purpose, shut down or scaled down for
+    idleness, stops accepting new tasks, and waits until running tasks finish or grace period ends.
+    """
+    container_id = _get_container_id()
+    print("draining container %s" % container_id)
+    sys.stdout.flush()
+    app_client.kv[_DRAINING_PREFIX + container_id] = str(time.time()).encode()
+    deliberate = [_RAY_SHUTDOWN, _IDLE, _RELEASED_PREFIX + container_id]
+    if replace and all(app_client.kv.get(key) is None for key in deliberate):
+        app_client.scale(_WORKER_SERVICE, delta=1)
+    reserve = _refuse_new_tasks(gcs_address, kwargs)
+    try:
+        deadline = time.time() + grace_period
+        while _busy_workers(pid) > 0 and time.time() < deadline:
+            time.sleep(_DRAIN_POLL_INTERVAL)
+            reserve()
     finally:
-        s.close()
+        # disconnected before ray of the container stops, which would end this process with its driver
+        ray.shutdown()
+
+
+class _RayProcess(object):
+    """``ray start --block`` process of container. Worker restarts it in place when head moves."""
+
+    def __init__(self, command_list, log_file):
+        self.command_list = command_list
+        self.log_file = log_file
+        self.proc = None
+        self._reconnecting = None
+
+    @property
+    def pid(self):
+        return self.proc.pid
+
+    @property
+    def address(self):
+        """Head address the process connects to, None for head"""
+        for arg in self.command_list:
+            if arg.startswith(_ADDRESS_ARG):
+                return arg[len(_ADDRESS_ARG):]
+        return None
+
+    def start(self):
+        self.proc = subprocess.Popen(self.command_list, bufsize=1, universal_newlines=True, stdout=self.log_file,
+                                     stderr=subprocess.STDOUT)
+        print("ray process pid: %d" % self.proc.pid)
+        sys.stdout.flush()
+
+    def kill(self, sig, frame):
+        try:
+            parent = psutil.Process(self.proc.pid)
+        except psutil.NoSuchProcess:
+            return
+        children = parent.children(recursive=False)
+        for process in children:
+            print("terminating process: %d" % process.pid)
+            process.send_signal(sig)
+
+    def reconnect(self, address):
+        """Stop ray processes and start them again with new head address"""
+        print("ray head moved to %s, reconnecting" % address)
+        self.command_list[:] = [_ADDRESS_ARG + address if arg.startswith(_ADDRESS_ARG) else arg
+                                for arg in self.command_list]
+        self._reconnecting = time.time()
+        self.kill(signal.SIGTERM, None)
+
+    def wait(self):
+        """Wait until process exits other than for reconnection, returns exit code"""
+        while True:
+            self.proc.wait()
+            if self._reconnecting is None:
+                return self.proc.returncode
+            started = self._reconnecting
+            self._reconnecting = None
+            self.start()
+            print("reconnected to ray head in %.2f seconds" % (time.time() - started))
+
+
+def _watch_head_address(app_client, address, on_change):
+    """Call ``on_change`` with new address each time a restarted head publishes it to kv"""
+    events = app_client.kv.events(key=_RAY_HEAD_ADDRESS, event_type="PUT")
+    # head may have moved before subscription
+    current = app_client.kv.get(_RAY_HEAD_ADDRESS)
+    if current is not None and current.decode() != address:
+        address = current.decode()
+        on_change(address)
+    for event in events:
+        value = event.result.value.decode()
+        if value != address:
+            address = value
+            on_change(address)
 
-    return node_ip_address
+
+def _local_addresses():
+    """IPv4 addresses of network interfaces which are up, by interface name in sorted order"""
+    stats = psutil.net_if_stats()
+    addresses = OrderedDict()
+    for name, addrs in sorted(psutil.net_if_addrs().items()):
+        if name in stats and not stats[name].isup:
+            continue
+        ips = [a.address for a in addrs if a.family == socket.AF_INET]
+        if ips:
+            addresses[name] = ips
+    return addresses
+
+
+def _resolve_ip_address(environ, addresses):
+    """Pick IP address of this node from interface addresses, without external traffic.
+
+    In order: address of interface configured by RAY_YARN_NODE_IP_INTERFACE, first address in
+    RAY_YARN_NODE_IP_CIDR, NM_HOST if it's a local IP address, first address of a non-loopback
+    interface, then 127.0.0.1. A NM_HOST host name isn't looked up, resolvers can block container
+    start for long, configure the interface or CIDR to pick among several interfaces instead.
+    """
+    interface = environ.get(_ENV_NODE_IP_INTERFACE)
+    if interface:
+        if interface in addresses:
+            return addresses[interface][0]
+        print("network interface %s is not found or down" % interface)
+    cidr = environ.get(_ENV_NODE_IP_CIDR)
+    if cidr:
+        network = ipaddress.ip_network(cidr, strict=False)
+        for ips in addresses.values():
+            for ip in ips:
+                if ipaddress.ip_address(ip) in network:
+                    return ip
+        print("no local address is in %s" % cidr)
+    local = [ip for ips in addresses.values() for ip in ips]
+    try:
+        nm_host = str(ipaddress.ip_address(environ.get("NM_HOST", "")))
+    except ValueError:
+        nm_host = None
+    if nm_host in local:
+        return nm_host
+    for ip in local:
+        address = ipaddress.ip_address(ip)
+        if not address.is_loopback and not address.is_link_local:
+            return ip
+    return "127.0.0.1"
+
+
+@functools.lru_cache(maxsize=None)
+def _get_ip_address():
+    """IP address of this node, resolved once per process"""
+    return _resolve_ip_address(os.environ, _local_addresses())
+
+
+def _pycache_warning(environ, version_info):
+    """Warning for container log if bytecode cache is configured but interpreter doesn't support it"""
+    if "PYTHONPYCACHEPREFIX" in environ and version_info < (3, 8):
+        return ("warning: python %d.%d ignores PYTHONPYCACHEPREFIX, read-only environment compiles modules at "
+                "each start. Use python 3.8 or later, or activate-environment: true" % tuple(version_info[:2]))
+    return None
 
 
 # sub-parser for ray start and stop
@@ -224,43 +606,138 @@ def start(*args, **kwargs):
     app_client = skein.ApplicationClient.from_current()
     is_head = "head" in kwargs
     command_list = ["ray", "start"]
+    system_config = {}
+    # objects spill to cluster filesystem if configured, otherwise to local dirs
+    spill_dir = os.environ.get(_ENV_SPILL_DIR)
+    spill.configure(is_head, kwargs, system_config, spill_dir, app_client.id)
+    _place_in_local_dirs(is_head, kwargs, _get_local_dirs(), system_config)
+    _allocate_ports(is_head, kwargs)
+    _add_node_resources(kwargs)
+    # ray would probe with traffic to 8.8.8.8 otherwise
+    kwargs.setdefault("node_ip_address", _get_ip_address())
     _construct_args(is_head, app_client, command_list, **kwargs)
+    if system_config:
+        command_list.append("--system-config=" + json.dumps(system_config, separators=(',', ':')))
 
     print("ray start argument line: " + " ".join(command_list))
+    warning = _pycache_warning(os.environ, sys.version_info)
+    if warning:
+        print(warning)
 
+    _publish_ports(app_client, kwargs)
     if is_head:
-        port = DEFAULT_PORT if "port" not in kwargs else kwargs["port"]
-        value = "%s:%s" % (_get_ip_address(), port)
-        app_client.kv[_RAY_HEAD_ADDRESS] = value.encode()
+        ip = kwargs["node_ip_address"]
+        app_client.kv[_RAY_CLIENT_ADDRESS] = ("%s:%s" % (ip, kwargs["ray_client_server_port"])).encode()
+        app_client.kv[_RAY_HEAD_ADDRESS] = ("%s:%s" % (ip, kwargs["port"])).encode()
 
     log_dir = "." if "LOG_DIRS" not in os.environ else os.environ["LOG_DIRS"].split(',')[0]
     with open(log_dir + "/runtime.log", "wb") as log_file:
-        proc = subprocess.Popen(command_list, bufsize=1, universal_newlines=True, stdout=log_file,
-                                stderr=subprocess.STDOUT)
-        pid = proc.pid
-        print("ray process pid: %d" % pid)
-
-        def kill(sig, frame):
-            try:
-                parent = psutil.Process(pid)
-            except psutil.NoSuchProcess:
-                return
-            children = parent.children(recursive=False)
-            for process in children:
-                print("terminating process: %d" % process.pid)
-                process.send_signal(sig)
-
-        for sig in [signal.SIGINT, signal.SIGTERM]:
-            signal.signal(sig, kill)
+        process = _RayProcess(command_list, log_file)
+        process.start()
+        kill = process.kill
+        usage_interval = float(os.environ.get(_ENV_USAGE_INTERVAL) or 0)
+        if usage_interval > 0:
+            sampler = usage.Sampler(app_client.kv, _get_container_id(), lambda: process.pid, usage_interval)
+            threading.Thread(target=sampler.run, args=(threading.Event(),), daemon=True).start()
+
+        def publish_node(gcs_address):
+            threading.Thread(target=_publish_node, args=(app_client, gcs_address, kwargs), daemon=True).start()
+
+        signal.signal(signal.SIGINT, kill)
+        if is_head:
+            def on_head_sigterm(sig, frame):
+                kill(sig, frame)
+                _remove_spilled(app_client, spill_dir)
+
+            signal.signal(signal.SIGTERM, on_head_sigterm if spill_dir else kill)
+            head_address = "%s:%s" % (kwargs["node_ip_address"], kwargs["port"])
+            publish_node(head_address)
+            _start_reaper(app_client, head_address)
+        else:
+            drain_lock = threading.Lock()
+
+            def drain_and_stop(replace):
+                # once only, for both SIGTERM and drain request
+                if drain_lock.acquire(blocking=False):
+                    _drain(app_client, process.pid, replace, process.address, kwargs)
+                    kill(signal.SIGTERM, None)
+
+            def on_sigterm(sig, frame):
+                # skein restarts failed container itself unless max_restarts is 0. Replacing it
+                # ahead of the kill as well would leave one worker too many.
+                replace = app_client.get_specification().services[_WORKER_SERVICE].max_restarts == 0
+                threading.Thread(target=drain_and_stop, args=(replace,), daemon=True).start()
+
+            def on_drain_request():
+                app_client.kv.wait(_DRAIN_PREFIX + _get_container_id())
+                # leaves before the kill and exits 0, so skein doesn't restart it
+                drain_and_stop(True)
+
+            def on_head_moved(address):
+                process.reconnect(address)
+                # node rejoins restarted head with a new id
+                publish_node(address)
+
+            signal.signal(signal.SIGTERM, on_sigterm)
+            threading.Thread(target=on_drain_request, daemon=True).start()
+            publish_node(process.address)
+            threading.Thread(target=_watch_head_address, args=(app_client, process.address, on_head_moved),
+                             daemon=True).start()
 
         sys.stdout.flush()
-        proc.wait()
+        returncode = process.wait()
 
-    print("exit code: %d" % proc.returncode)
-    if proc.returncode != 0:
+    try:
+        topology.withdraw(app_client.kv, _get_container_id())
+    except skein.ConnectionError:
+        pass  # application is shut down
+    if is_head and spill_dir:
+        _remove_spilled(app_client, spill_dir)
+    print("exit code: %d" % returncode)
+    if returncode != 0:
         kill(signal.SIGTERM, None)
 
 
+def _application_ending(app_client):
+    """Whether head exits with the application, rather than to be restarted in place"""
+    try:
+        if app_client.kv.get(_RAY_SHUTDOWN) is not None:
+            return True
+        return app_client.get_specification().services[_HEAD_SERVICE].max_restarts == 0
+    except skein.ConnectionError:
+        # application master is gone, like killed with "ray-yarn kill"
+        return True
+
+
+def _remove_spilled(app_client, spill_dir):
+    """Remove spilled objects as head exits with the application.
+
+    Application side counterpart of ``YarnCluster.shutdown``, for applications killed or shut
+    down otherwise, like by the finalizer.
+    """
+    if not _application_ending(app_client):
+        return
+    try:
+        if spill.remove(spill_dir, app_client.id):
+            print("removed spilled objects in %s" % spill.storage_uri(spill_dir, app_client.id))
+    except Exception as e:
+        print("failed to remove spilled objects: %s" % e)
+    sys.stdout.flush()
+
+
+def _start_reaper(app_client, gcs_address):
+    """Scale down and shut down application when ray is idle, if idle timeouts are set"""
+    scale_down_after = float(os.environ.get(_ENV_IDLE_TIMEOUT) or 0)
+    shutdown_after = float(os.environ.get(_ENV_IDLE_SHUTDOWN_TIMEOUT) or 0)
+    if scale_down_after <= 0 and shutdown_after <= 0:
+        return
+    spill_dir = os.environ.get(_ENV_SPILL_DIR)
+    on_shutdown = (lambda: spill.remove(spill_dir, app_client.id)) if spill_dir else None
+    reaper = idle.Reaper(app_client, idle.gcs_activity(gcs_address), scale_down_after, shutdown_after,
+                         _WORKER_SERVICE, on_shutdown)
+    threading.Thread(target=reaper.run, args=(threading.Event(),), daemon=True).start()
+
+
 @subcommand(sub_parser, "stop", "Stop Ray Head or Worker", [],
             arg(
                 "-f", "--force",
@@ -274,39 +751,332 @@ def stop(*args, **kwargs):
 app_id = arg("app_id", help="The application id", metavar="APP_ID")
 
 
+_REPORT_HEADER = [
+    "application_id",
+    "name",
+    "state",
+    "status",
+    "containers",
+    "vcores",
+    "memory",
+    "runtime",
+]
+
+
+def _report_row(report):
+    return (
+        report.id,
+        report.name,
+        report.state,
+        report.final_status,
+        report.usage.num_used_containers,
+        report.usage.used_resources.vcores,
+        report.usage.used_resources.memory,
+        humanize_timedelta(report.runtime),
+    )
+
+
+def _report_dict(report):
+    return {
+        "application_id": report.id,
+        "name": report.name,
+        "user": report.user,
+        "queue": report.queue,
+        "tags": sorted(report.tags),
+        "state": str(report.state),
+        "status": str(report.final_status),
+        "containers": report.usage.num_used_containers,
+        "vcores": report.usage.used_resources.vcores,
+        "memory": report.usage.used_resources.memory,
+        "runtime": report.runtime.total_seconds(),
+    }
+
+
+def _fetch_reports(skein_client, app_ids=None, tags=None, name=None, queue=None, user=None, states=None):
+    """Reports of given applications, fetched concurrently, or of all applications matching filters.
+
+    Filters other than tags are applied by resource manager in a single call.
+    """
+    if app_ids:
+        with ThreadPoolExecutor(max_workers=min(len(app_ids), _MAX_REPORT_THREADS)) as executor:
+            reports = list(executor.map(skein_client.application_report, app_ids))
+        reports = [r for r in reports if (not states or str(r.state) in states)
+                   and (name is None or r.name == name) and (queue is None or r.queue == queue)
+                   and (user is None or r.user == user)]
+    else:
+        reports = skein_client.get_applications(states=states or None, name=name, queue=queue, user=user)
+    if tags:
+        reports = [r for r in reports if set(tags).issubset(r.tags)]
+    return sorted(reports, key=lambda r: r.id)
+
+
+def _print_reports(reports, as_json):
+    if as_json:
+        print(json.dumps([_report_dict(r) for r in reports], indent=2))
+    else:
+        print(format_table(_REPORT_HEADER, [_report_row(r) for r in reports]))
+    sys.stdout.flush()
+
+
 @subcommand(
     sub_parser, "status", "Check the status of a submitted Ray application", [], app_id
 )
 def status(app_id):
     report = _get_skein_client().application_report(app_id)
-    header = [
-        "application_id",
-        "name",
-        "state",
-        "status",
-        "containers",
-        "vcores",
-        "memory",
-        "runtime",
-    ]
-    data = [
-        (
-            report.id,
-            report.name,
-            report.state,
-            report.final_status,
-            report.usage.num_used_containers,
-            report.usage.used_resources.vcores,
-            report.usage.used_resources.memory,
-            humanize_timedelta(report.runtime),
-        )
-    ]
-    print(format_table(header, data))
+    print(format_table(_REPORT_HEADER, [_report_row(report)]))
+
+
+_USAGE_HEADER = ["container", "host", "vcores", "cpu", "cpu_max", "memory", "rss", "rss_max", "shared"]
+
+
+def _percent(used, allocated):
+    if used is None:
+        return "-"
+    return "%s (%d%%)" % (used, round(100.0 * used / allocated)) if allocated else str(used)
+
+
+def _usage_row(u):
+    return (u.container, u.host or "-", u.vcores, _percent(u.cpu, u.vcores), _percent(u.cpu_max, u.vcores),
+            u.memory, _percent(u.rss, u.memory), _percent(u.rss_max, u.memory),
+            "-" if u.shared is None else u.shared)
+
+
+@subcommand(sub_parser, "usage", "Compare allocated with used CPU and memory (MiB) of containers", [], app_id,
+            arg("--json", action="store_true", dest="as_json", help="Print JSON instead of table"),
+            )
+def usage_report(app_id, as_json=False):
+    app_client = _get_skein_client().connect(app_id)
+    usages = sorted(usage.resource_usage(app_client), key=lambda u: u.container)
+    if as_json:
+        print(json.dumps([u._asdict() for u in usages], indent=2))
+    else:
+        print(format_table(_USAGE_HEADER, [_usage_row(u) for u in usages]))
+
+
+_PLAN_HEADER = ["vcores", "memory", "count", "total_vcores", "total_memory", "waste", "fragmentation"]
 
 
-@subcommand(sub_parser, "kill", "Kill a Ray application", [], app_id)
-def kill(app_id):
-    _get_skein_client().kill_application(app_id)
+def _plan_row(p):
+    return (p.vcores, p.memory, p.count, p.vcores * p.count, p.memory * p.count, "%.1f%%" % (100 * p.waste),
+            "%.1f%%" % (100 * p.fragmentation))
+
+
+@subcommand(sub_parser, "plan", "Plan worker container shape for total resources", [],
+            arg("--vcores", type=int, required=True, help="Total vcores of workers"),
+            arg("--memory", required=True, help="Total memory of workers, like 3TiB"),
+            arg("--node-vcores", type=int, help="Vcores of each NodeManager. By default, nodes of the cluster."),
+            arg("--node-memory", help="Memory of each NodeManager, like 256GiB"),
+            arg("--nodes", type=int, default=1, help="Number of NodeManagers of given size"),
+            arg("--memory-increment", type=int,
+                help="Memory allocation increment in MiB. Defaults to memory-increment in yarn.yaml"),
+            arg("--vcores-increment", type=int,
+                help="Vcores allocation increment. Defaults to vcores-increment in yarn.yaml"),
+            arg("--top", type=int, default=5, help="Number of plans to show"),
+            )
+def plan(vcores, memory, node_vcores=None, node_memory=None, nodes=1, memory_increment=None,
+         vcores_increment=None, top=5):
+    if (node_vcores is None) != (node_memory is None):
+        fail("--node-vcores and --node-memory go together")
+    if node_vcores is not None:
+        node_resources = [skein.Resources(memory=node_memory, vcores=node_vcores)] * nodes
+    else:
+        node_resources = [n.total_resources for n in _get_skein_client().get_nodes(states=["RUNNING"])]
+    plans = planner.plan(vcores, skein.Resources(memory=memory, vcores=1).memory, node_resources,
+                         memory_increment or config.yarn_configs.get("memory_increment"),
+                         vcores_increment or config.yarn_configs.get("vcores_increment"))
+    print(format_table(_PLAN_HEADER, [_plan_row(p) for p in plans[:top]]))
+
+
+@subcommand(sub_parser, "validate", "Check a yarn.yaml against typed schema of configurations", [],
+            arg("path", nargs="?", help="The yarn.yaml to check. By default, the one configurations are loaded from."),
+            )
+def validate(path=None):
+    path = path or config.find_config_file()
+    try:
+        problems = schema.validate(config.read_config(path))
+    except (OSError, config.ConfigError) as e:
+        fail("%s: %s" % (path, e))
+    if problems:
+        fail("\n".join("%s: %s" % (path, p) for p in problems))
+    print("%s: ok" % path)
+
+
+def _upper(value):
+    return value.upper()
+
+
+@subcommand(sub_parser, "list", "List Ray applications", [],
+            arg("app_ids", nargs="*", metavar="APP_ID",
+                help="Application ids to report. By default, all applications matching filters."),
+            arg("--tag", action="append", dest="tags", help="Only applications with this tag, may repeat"),
+            arg("--name", help="Only applications with this name"),
+            arg("--queue", help="Only applications in this queue"),
+            arg("--user", help="Only applications of this user"),
+            arg("--state", action="append", dest="states", type=_upper,
+                help="Only applications in this state, may repeat. By default, SUBMITTED, ACCEPTED and RUNNING."),
+            arg("--json", action="store_true", dest="as_json", help="Print JSON instead of table"),
+            arg("--watch", type=float, metavar="SECONDS",
+                help="Refresh every SECONDS seconds, printing only when something changed"),
+            )
+def list_applications(app_ids=None, tags=None, name=None, queue=None, user=None, states=None, as_json=False,
+                      watch=None):
+    skein_client = _get_skein_client()
+    last = None
+    while True:
+        reports = _fetch_reports(skein_client, app_ids, tags, name, queue, user, states)
+        # runtime changes every time, compare the rest
+        current = [_report_row(r)[:-1] for r in reports]
+        if current != last:
+            _print_reports(reports, as_json)
+            last = current
+        if not watch:
+            return
+        _watch_sleep(watch)
+
+
+@subcommand(sub_parser, "kill", "Kill Ray applications", [],
+            arg("app_id", nargs="?", metavar="APP_ID", help="The application id"),
+            arg("--tag", action="append", dest="tags",
+                help="Kill all active applications with this tag, may repeat"),
+            )
+def kill(app_id=None, tags=None):
+    if app_id is None and not tags:
+        fail("either APP_ID or --tag is required")
+    skein_client = _get_skein_client()
+    app_ids = [r.id for r in _fetch_reports(skein_client, tags=tags)] if tags else []
+    if app_id is not None and app_id not in app_ids:
+        app_ids.append(app_id)
+    if not app_ids:
+        print("no active application with tags %s" % ",".join(tags))
+        return
+    with ThreadPoolExecutor(max_workers=min(len(app_ids), _MAX_REPORT_THREADS)) as executor:
+        futures = {executor.submit(skein_client.kill_application, i): i for i in app_ids}
+    failed = []
+    for future, i in futures.items():
+        if future.exception() is None:
+            print("killed %s" % i)
+        else:
+            failed.append(i)
+            print("failed to kill %s: %s" % (i, future.exception()))
+    if failed:
+        sys.exit(1)
+
+
+@subcommand(sub_parser, "pool", "Run a pool of pre-started Ray clusters leased to jobs", [],
+            arg("--port", type=int, help="The port to serve leases on. Defaults to port of pool in yarn.yaml"),
+            arg("--addr", help="The address to bind to. By default, all interfaces."),
+            arg("--max-leases", type=int, help="Retire a cluster after this many leases"),
+            arg("--max-idle-time", type=float, help="Retire a cluster idle for this many seconds"),
+            )
+def run_pool(port=None, addr=None, max_leases=None, max_idle_time=None):
+    pool_configs = config.yarn_configs.get("pool") or {}
+    shapes = cluster_pool.shapes_from_config(pool_configs)
+    if not shapes:
+        fail("no cluster shapes configured in pool section of yarn.yaml")
+    options = {k: v for k, v in [("max_leases", max_leases or pool_configs.get("max_leases")),
+                                 ("max_idle_time", max_idle_time or pool_configs.get("max_idle_time")),
+                                 ("reset_timeout", pool_configs.get("reset_timeout"))] if v}
+    pool = cluster_pool.ClusterPool(shapes, **options)
+    pool.start()
+    server = cluster_pool.serve(pool, port if port is not None else pool_configs.get("port", 0),
+                                addr or pool_configs.get("addr", ""))
+    print("serving cluster pool of shapes %s at http://%s:%d"
+          % (", ".join(s.name for s in shapes), _get_ip_address(), server.server_port))
+    sys.stdout.flush()
+
+    stopped = threading.Event()
+    signal.signal(signal.SIGINT, lambda sig, frame: stopped.set())
+    signal.signal(signal.SIGTERM, lambda sig, frame: stopped.set())
+    while not stopped.wait(1):
+        pass
+    server.shutdown()
+    pool.shutdown()
+
+
+def _run_script(app_client, driver_id, env=None):
+    """Run driver script published to kv in current directory and publish its output and exit code.
+
+    Output is written to container log, and published to kv up to ``_MAX_DRIVER_OUTPUT`` bytes.
+    """
+    key = _DRIVERS_PREFIX + driver_id
+    driver = json.loads(app_client.kv[key].decode())
+    with open(driver["script"], "w") as f:
+        f.write(driver["source"])
+    env = dict(env or os.environ, PYTHONUNBUFFERED="1")
+    proc = subprocess.Popen([sys.executable, driver["script"]] + driver["args"], stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT, env=env)
+    seq = 0
+    published = 0
+    # whatever is available up to chunk size, so that a burst of output is published at once
+    for chunk in iter(lambda: os.read(proc.stdout.fileno(), _OUTPUT_CHUNK_SIZE), b""):
+        sys.stdout.write(chunk.decode(errors="replace"))
+        if published >= _MAX_DRIVER_OUTPUT:
+            continue
+        chunk = chunk[:_MAX_DRIVER_OUTPUT - published]
+        published += len(chunk)
+        if published >= _MAX_DRIVER_OUTPUT:
+            chunk += ("\n[output beyond %d bytes is in the log of driver container %s]\n"
+                      % (_MAX_DRIVER_OUTPUT, _get_container_id())).encode()
+        app_client.kv["%s/output/%08d" % (key, seq)] = chunk
+        seq += 1
+    returncode = proc.wait()
+    sys.stdout.flush()
+    app_client.kv[key + "/exit"] = str(returncode).encode()
+    return returncode
+
+
+@subcommand(sub_parser, "driver", "Run a driver in its container, started by ray-yarn run", [])
+def run_driver_container():
+    app_client = skein.ApplicationClient.from_current()
+    # ray drivers need a ray node on their host, it takes no tasks
+    kwargs = {"num_cpus": 0}
+    system_config = {}
+    spill.configure(False, kwargs, system_config, os.environ.get(_ENV_SPILL_DIR), app_client.id)
+    _place_in_local_dirs(False, kwargs, _get_local_dirs(), system_config)
+    _allocate_ports(False, kwargs)
+    kwargs.setdefault("node_ip_address", _get_ip_address())
+    command_list = ["ray", "start"]
+    _construct_args(False, app_client, command_list, **kwargs)
+    print("ray start argument line: " + " ".join(command_list))
+    sys.stdout.flush()
+    subprocess.check_call(command_list)
+    address = app_client.kv[_RAY_HEAD_ADDRESS].decode()
+    try:
+        returncode = _run_script(app_client, os.environ[_ENV_DRIVER_ID], dict(os.environ, RAY_ADDRESS=address))
+    finally:
+        subprocess.call(["ray", "stop"])
+    print("exit code: %d" % returncode)
+    sys.exit(returncode)
+
+
+@subcommand(sub_parser, "run", "Run a driver script in a Ray application on YARN", [],
+            arg("script", help="Python script of the driver"),
+            arg("script_args", nargs=argparse.REMAINDER, metavar="...", help="Arguments of the script"),
+            arg("--app-id", help="Run in this running application instead of starting a new one"),
+            arg("--environment", help="Path to the Python environment of a new application"),
+            arg("--name", help="The application name"),
+            arg("--queue", help="The queue to deploy to"),
+            arg("--workers", type=int, help="Number of workers to start before running the driver"),
+            arg("--keep", action="store_true", help="Keep the new application running after the driver exits"),
+            arg("--timeout", type=float, help="Seconds to wait for the driver to exit"),
+            )
+def run(script, script_args=None, app_id=None, environment=None, name=None, queue=None, workers=None,
+        keep=False, timeout=None):
+    if app_id is not None:
+        app_client = _get_skein_client().connect(app_id)
+        returncode = core.run_driver(app_client, script, script_args or [], timeout=timeout)
+    else:
+        cluster = core.YarnCluster(environment=environment, name=name, queue=queue)
+        print("started application %s" % cluster.app_id)
+        sys.stdout.flush()
+        if workers:
+            cluster.scale(workers)
+        if keep:
+            cluster.detach()
+        returncode = cluster.run_driver(script, script_args or [], shutdown=not keep, timeout=timeout)
+        if keep:
+            print("application %s is kept running" % cluster.app_id)
+    sys.exit(returncode)
 
 
 def main(args=None):
@@ -53,29 +53,41 @@ def replace_hyphen_with_dash(dct: Dict[str, Any]):
     return new
 
 
-def load_config():
-    global yarn_configs
-    if yarn_configs:
-        return
-
+def find_config_file():
+    """Path of yarn.yaml in ~/.config/ray/, /etc/ray/ or package, in this order"""
     for path in PATHS:
         yarn_file = path + "/" + YARN_CONFIG_FILE_NAME
         if os.path.isfile(yarn_file):
             break
+    return yarn_file
 
-    if not yarn_file.startswith(USER_CONFIG_LOC):
-        os.makedirs(USER_CONFIG_LOC, exist_ok=True)
-        shutil.copy(yarn_file, USER_CONFIG_LOC)
-        yarn_file = USER_CONFIG_LOC + "/" + YARN_CONFIG_FILE_NAME
 
+def read_config(yarn_file):
+    """``yarn`` section of yaml file, with hyphens in names replaced by underscores"""
     with open(yarn_file) as f:
         data = f.read()
 
-    root_configs = yaml.safe_load(data)
-    if CONFIG_NAME_ROOT not in root_configs:
+    try:
+        root_configs = yaml.safe_load(data)
+    except yaml.YAMLError as e:
+        raise ConfigError("bad yaml in %s: %s" % (yarn_file, e))
+    if not isinstance(root_configs, dict) or CONFIG_NAME_ROOT not in root_configs:
         raise ConfigError("Expect " + CONFIG_NAME_ROOT + " in first level in yarn.yaml")
-    yarn_configs = root_configs[CONFIG_NAME_ROOT]
-    yarn_configs = replace_hyphen_with_dash(yarn_configs)
+    return replace_hyphen_with_dash(root_configs[CONFIG_NAME_ROOT]) or {}
+
+
+def load_config():
+    global yarn_configs
+    if yarn_configs:
+        return
+
+    yarn_file = find_config_file()
+    if not yarn_file.startswith(USER_CONFIG_LOC):
+        os.makedirs(USER_CONFIG_LOC, exist_ok=True)
+        shutil.copy(yarn_file, USER_CONFIG_LOC)
+        yarn_file = USER_CONFIG_LOC + "/" + YARN_CONFIG_FILE_NAME
+
+    yarn_configs = read_config(yarn_file)
     if CONFIG_NAME_HEAD in yarn_configs and yarn_configs[CONFIG_NAME_HEAD] is not None:
         global head_configs
         head_configs = yarn_configs[CONFIG_NAME_HEAD]
@@ -1,13 +1,29 @@
+import os
+import sys
 import weakref
-from typing import Optional, Dict, List
+from typing import Optional, Dict, List, Callable
 from inspect import signature, Parameter
 from copy import deepcopy
 import time
 import warnings
 from urllib.parse import urlparse
 import json
+import uuid
+import queue
+import threading
+from collections import namedtuple
 from . import config
 from .config import CONFIG_NAME_HEAD, CONFIG_NAME_WORKER
+from . import bundle
+from . import capacity
+from . import envcache
+from . import locality
+from . import metrics
+from . import planner
+from . import schema
+from . import spill
+from . import topology
+from . import usage
 import skein
 
 _EXCLUDE_ARG_LIST = ["self", "num_cpus", "num_gpus", "memory", "initial_instances", "max_restarts"]
@@ -16,15 +32,74 @@ _EXCLUDE_ARG_LIST_WORKER = _EXCLUDE_ARG_LIST + ["gcs_server_port", "port", "incl
 _IGNORE_ARG_VALUE_LIST = ["head", "block"]
 
 _RAY_HEAD_ADDRESS = "address"
+_RAY_CLIENT_ADDRESS = "client_address"
+_RAY_PORTS_PREFIX = "ports/"
+_RAY_SHUTDOWN = "shutdown"
+# set by head while workers are scaled to zero for idleness, see idle.Reaper
+_IDLE = "idle"
+# drain requests of containers, and containers being drained, like "drain/ray.worker_0"
+_DRAIN_PREFIX = "drain/"
+_DRAINING_PREFIX = "draining/"
+# written before a worker is killed on purpose, so that it doesn't request a replacement as it drains
+_RELEASED_PREFIX = "released/"
+_WORKER_SERVICE = "ray.worker"
+# custom resource each ray node gets for its host, like "node:host1.example.com"
+_HOST_RESOURCE_PREFIX = "node:"
+_HEAD_SERVICE = "ray.head"
+# drivers run in the application by run_driver. "drivers/<id>" holds the script and its args,
+# "drivers/<id>/output/<seq>" chunks of its output and "drivers/<id>/exit" its exit code.
+_DRIVER_SERVICE = "ray.driver"
+_DRIVERS_PREFIX = "drivers/"
+_ENV_DRIVER_ID = "RAY_YARN_DRIVER_ID"
+# environment of ray head for GCS fault tolerance, cluster metadata is kept in external redis
+_ENV_GCS_REDIS_ADDRESS = "RAY_REDIS_ADDRESS"
+# how ray nodes pick their IP address among container's interfaces
+_ENV_NODE_IP_INTERFACE = "RAY_YARN_NODE_IP_INTERFACE"
+_ENV_NODE_IP_CIDR = "RAY_YARN_NODE_IP_CIDR"
+# directory on cluster filesystem that ray nodes spill objects to, see spill.py
+_ENV_SPILL_DIR = "RAY_YARN_SPILL_DIR"
+# seconds between resource usage summaries of containers, see usage.py
+_ENV_USAGE_INTERVAL = "RAY_YARN_USAGE_INTERVAL"
+_ENV_IDLE_TIMEOUT = "RAY_YARN_IDLE_TIMEOUT"
+_ENV_IDLE_SHUTDOWN_TIMEOUT = "RAY_YARN_IDLE_SHUTDOWN_TIMEOUT"
+
+# a host is bad once its worker containers failed this many times within the window, its workers are
+# drained once then
+_BAD_HOST_FAILURES = 3
+_BAD_HOST_WINDOW = 600
+# failed workers are replaced by at most this many container requests per reconciliation
+_REPLACE_BATCH_SIZE = 50
+# minimum seconds between scale calls to application master. Scale requests arriving meanwhile
+# are merged into one call for the largest size.
+_SCALE_INTERVAL = 0.2
+# gang scaling polls for joined workers at this interval, and gives up after the timeout by default
+_GANG_POLL_INTERVAL = 0.5
+_GANG_TIMEOUT = 300
+_DRIVER_POLL_INTERVAL = 0.5
+# how often the head address metric checks if the cluster shut down while no address arrives
+_HEAD_ADDRESS_POLL_INTERVAL = 1
+_ACTIVE_STATES = ["WAITING", "REQUESTED", "RUNNING"]
+_FINISHED_STATES = ["SUCCEEDED", "FAILED", "KILLED"]
+_ALL_STATES = _ACTIVE_STATES + _FINISHED_STATES
+
+ClusterHealth = namedtuple("ClusterHealth", ["target", "active", "failed", "replaced", "host_failures",
+                                             "bad_hosts", "reconciled_at"])
+ClusterHealth.__doc__ = """Worker health of ``YarnCluster`` as of last reconciliation.
+
+``failed`` and ``replaced`` are totals, ``host_failures`` counts failures within the bad host window.
+"""
 
 
 def _get_or_wait_kv(app_client, key, timeout):
+    start = time.perf_counter()
     stime = 1
     value = app_client.kv.get(key)
     while value is None and timeout > 0:
         time.sleep(stime)
         value = app_client.kv.get(key)
         timeout -= stime
+    # label by prefix of per-container keys like "ports/ray.worker_0"
+    metrics.KV_WAIT_SECONDS.observe(time.perf_counter() - start, key=key.split('/')[0])
     if value is None:
         raise ValueError("cannot get key %s from kv store" % key)
     return value
@@ -72,26 +147,43 @@ def lookup(kwargs, name, prefix):
     return kwargs[name] if kwargs.get(name) is not None else lookup_yarn_config(name, prefix)
 
 
-def _files_and_build_script(environment):
+def _files_and_build_script(environment, cache_dir=None, activate=True, python_path=()):
+    """Files to localize and function building container script for the environment.
+
+    Activation script of environment is run unless ``activate`` is False, which puts it on PATH
+    directly instead and caches bytecode per application and host, on Python 3.8 or later.
+    Archives are cached in ``cache_dir`` on HDFS and localized as public resources, so each
+    NodeManager unpacks them once. ``python_path`` entries, relative to container directory, are
+    put on PYTHONPATH.
+    """
     parsed = urlparse(environment)
     scheme = parsed.scheme
 
     if scheme in {"conda", "venv", "python"}:
         path = environment[len(scheme) + 3:]
         files = {}
-        if scheme == "conda":
-            setup = "conda activate %s" % path
-            cli = "ray-yarn"
-        elif scheme == "venv":
-            setup = "source %s/bin/activate" % path
-            cli = "ray-yarn"
-        else:
+        if scheme == "python":
             setup = ""
             cli = "%s -m ray_yarn.cli" % path
+        elif activate:
+            setup = "conda activate %s" % path if scheme == "conda" else "source %s/bin/activate" % path
+            cli = "ray-yarn"
+        else:
+            setup = 'export PATH="%s/bin:$PATH"' % path
+            cli = "%s/bin/python -m ray_yarn.cli" % path
     else:
-        files = {"environment": environment}
-        setup = "source environment/bin/activate"
+        if cache_dir:
+            source = environment if scheme == "hdfs" else envcache.cached_archive(environment, cache_dir)
+            files = {"environment": skein.File(source, type="archive", visibility="public")}
+        else:
+            files = {"environment": environment}
+        setup = "source environment/bin/activate" if activate else 'export PATH="$PWD/environment/bin:$PATH"'
         cli = "environment/bin/python -m ray_yarn.cli"
+    if not activate:
+        setup = "\n".join(filter(None, [setup, 'export PYTHONPYCACHEPREFIX="%s"' % envcache.pycache_dir()]))
+    if python_path:
+        entries = ":".join('$PWD/%s' % p for p in python_path)
+        setup = "\n".join(filter(None, [setup, 'export PYTHONPATH="%s${PYTHONPATH:+:$PYTHONPATH}"' % entries]))
 
     def build_script(cmd):
         command = "%s %s" % (cli, cmd)
@@ -142,30 +234,85 @@ def _make_specification(**kwargs):
         )
         raise ValueError(msg)
 
-    files, build_script = _files_and_build_script(environment)
+    cache_dir = lookup(kwargs, "environment_cache", None)
+    # job code arrives by localization with environment, instead of through GCS
+    code_files, python_path = bundle.localize(lookup(kwargs, "working_dir", None),
+                                              lookup(kwargs, "py_modules", None), cache_dir)
+    activate = lookup(kwargs, "activate_environment", None)
+    files, build_script = _files_and_build_script(environment, cache_dir, activate is None or bool(activate),
+                                                  python_path)
+    files.update(code_files)
+
+    worker_nodes = None
+    input_paths = kwargs.get("input_paths")
+    if input_paths:
+        provider = kwargs.get("block_location_provider") or locality.get_block_locations
+        worker_nodes = locality.preferred_hosts(provider(input_paths)) or None
+
+    # head restarts in place of resubmitting application. Without GCS fault tolerance, the restarted
+    # head starts an empty cluster which workers rejoin.
+    head_max_restarts = kwargs.get("head_max_restarts")
+    if head_max_restarts is None:
+        head_max_restarts = config.head_configs.get("max_restarts") or 0
+    gcs_redis_address = kwargs.get("gcs_redis_address") or config.head_configs.get("gcs_redis_address")
+    node_env = {}
+    for option, key in [("node_ip_interface", _ENV_NODE_IP_INTERFACE), ("node_ip_cidr", _ENV_NODE_IP_CIDR),
+                        ("usage_interval", _ENV_USAGE_INTERVAL)]:
+        if config.yarn_configs.get(option):
+            node_env[key] = str(config.yarn_configs[option])
+    spill_dir = lookup(kwargs, "spill_dir", None)
+    if spill_dir:
+        node_env[_ENV_SPILL_DIR] = spill_dir
+    head_env = dict(node_env)
+    for option, key in [("idle_timeout", _ENV_IDLE_TIMEOUT), ("idle_shutdown_timeout", _ENV_IDLE_SHUTDOWN_TIMEOUT)]:
+        value = lookup(kwargs, option, None)
+        if value:
+            head_env[key] = str(value)
+    if gcs_redis_address:
+        head_env[_ENV_GCS_REDIS_ADDRESS] = gcs_redis_address
 
     cfg = kwargs['ray_runtime_cfg']
     head_cfg = cfg.to_head_cfg()
-    services = {"ray.head": skein.Service(
+    worker_cfg = cfg.to_worker_cfg()
+    # ray start would reject them in containers, after submission
+    schema.check_runtime(head_cfg, worker_cfg)
+    services = {_HEAD_SERVICE: skein.Service(
         instances=1,
         resources=skein.Resources(
             vcores=head_cfg.num_cpus, memory=head_cfg.memory, gpus=head_cfg.num_gpus
         ),
-        max_restarts=0,
+        max_restarts=head_max_restarts,
+        env=head_env,
         files=files,
         script=build_script("start --head --block " + " ".join(_construct_args(head_cfg, True))),
     )}
-    worker_cfg = cfg.to_worker_cfg()
-    services["ray.worker"] = skein.Service(
+    services[_WORKER_SERVICE] = skein.Service(
         instances=worker_cfg.initial_instances,
         resources=skein.Resources(
             vcores=worker_cfg.num_cpus, memory=worker_cfg.memory, gpus=worker_cfg.num_gpus
         ),
         max_restarts=worker_cfg.max_restarts,
-        depends=["ray.head"],
+        env=node_env,
+        depends=[_HEAD_SERVICE],
+        nodes=worker_nodes,
+        relax_locality=worker_nodes is not None,
         files=files,
         script=build_script("start --block " + " ".join(_construct_args(worker_cfg, False)))
     )
+    # containers are added by run_driver. Skein can't add services to running applications.
+    driver_cfg = config.yarn_configs.get("driver") or {}
+    services[_DRIVER_SERVICE] = skein.Service(
+        instances=0,
+        resources=skein.Resources(
+            vcores=driver_cfg.get("num_cpus") or 1, memory=driver_cfg.get("memory") or "2GiB"
+        ),
+        max_restarts=0,
+        allow_failures=True,
+        env=node_env,
+        depends=[_HEAD_SERVICE],
+        files=files,
+        script=build_script("driver")
+    )
     spec = skein.ApplicationSpec(
         name=name, queue=queue, tags=tags, user=user, services=services
     )
@@ -231,8 +378,8 @@ class RayRuntimeConfig(Value):
     memory: Optional[int] = None
         Amount of memory.
     port: Optional[int] = None
-        The port of the head ray process. If not provided, defaults to 6379; if port is set
-        to 0, we will allocate an available port.
+        The port of the head ray process. If not provided or set to 0, we will allocate an
+        available port in head container.
     initial_instances: Optional[int] = None
         Number of workers to start on initialization.
     object_store_memory: Optional[int] = None
@@ -248,18 +395,19 @@ class RayRuntimeConfig(Value):
     dashboard_port: Optional[int] = None
         The port to bind the dashboard server to. Defaults to 8265.
     object_manager_port: Optional[int] = None
-        The port to use for starting the object manager.
+        The port to use for starting the object manager. Allocated in container if not provided.
     node_manager_port: Optional[int] = None
-        The port to use for starting the node manager.
+        The port to use for starting the node manager. Allocated in container if not provided.
     gcs_server_port: Optional[int] = None
-        Port for the server.
+        Port for the server. Allocated in container if not provided.
     min_worker_port: Optional[int] = None
         The lowest port number that workers will bind on.
     max_worker_port: Optional[int] = None
         The highest port number that workers will bind on.
     worker_port_list: Optional[str] = None
         A comma-separated list of open ports for workers to bind on. Overrides 'min-worker-port'
-        and 'max-worker-port'.
+        and 'max-worker-port'. If none of worker port options is provided, a list of free ports
+        is allocated in container.
     max_restarts: Optional[int] = None
         Allowed number of worker restarts, -1 for unlimited.
     autoscaling_config: Optional[str] = None
@@ -357,6 +505,7 @@ class RayYarnError(skein.SkeinError):
     pass
 
 
+@metrics.SUBMIT_SECONDS.time()
 def submit_and_handle_failures(skein_client, spec):
     app_id = skein_client.submit(spec)
     try:
@@ -377,6 +526,128 @@ def submit_and_handle_failures(skein_client, spec):
         )
 
 
+def _shutdown_application(app_client, status="SUCCEEDED", diagnostics=None):
+    # containers terminated by shutdown don't request replacements, and head removes spilled objects
+    app_client.kv[_RAY_SHUTDOWN] = status.encode()
+    app_client.shutdown(status=status, diagnostics=diagnostics)
+    metrics.HEAD_ADDRESS_SECONDS.remove(app_id=app_client.id)
+    metrics.CONTAINERS.remove(app_id=app_client.id)
+
+
+def run_driver(app_client, script, args=(), output=None, timeout=None):
+    """Run python script as driver in a new container of the application, returns its exit code.
+
+    The driver container starts a ray node joining the cluster and runs the script there, so
+    that the driver talks to ray directly instead of through ray client. Output of the script is
+    written to ``output``, ``sys.stdout`` by default, as it comes. It's passed through kv, where
+    each chunk is deleted once written, and output beyond a limit is only in the driver
+    container's log. Raises TimeoutError and kills the driver if it doesn't exit in ``timeout``
+    seconds, and RayYarnError if its container exits without an exit code.
+    """
+    output = output or sys.stdout
+    key = _DRIVERS_PREFIX + uuid.uuid4().hex
+    exit_key = key + "/exit"
+    with open(script) as f:
+        source = f.read()
+    app_client.kv[key] = json.dumps({"script": os.path.basename(script), "source": source,
+                                     "args": [str(a) for a in args]}).encode()
+    deadline = None if timeout is None else time.time() + timeout
+    try:
+        # subscribed before the driver starts, so that no output is missed
+        with app_client.kv.events(prefix=key + "/", event_type="PUT") as events:
+            container = app_client.add_container(_DRIVER_SERVICE, env={_ENV_DRIVER_ID: key[len(_DRIVERS_PREFIX):]})
+            while True:
+                try:
+                    event = events.get(timeout=_DRIVER_POLL_INTERVAL)
+                except queue.Empty:
+                    event = None
+                if event is not None and event.key == exit_key:
+                    return int(event.result.value.decode())
+                if event is not None:
+                    output.write(event.result.value.decode(errors="replace"))
+                    output.flush()
+                    app_client.kv.discard(event.key)
+                elif app_client.kv.get(exit_key) is None:
+                    finished = [c for c in app_client.get_containers(services=[_DRIVER_SERVICE],
+                                                                     states=_FINISHED_STATES) if c.id == container.id]
+                    # exit code may be published between the reads
+                    if finished and app_client.kv.get(exit_key) is None:
+                        raise RayYarnError("driver container %s exited without exit code, %s. See the application "
+                                           "logs." % (container.id, finished[0].exit_message or finished[0].state))
+                if deadline is not None and time.time() >= deadline:
+                    app_client.kill_container(container.id)
+                    raise TimeoutError("driver %s didn't exit in %s seconds, killed" % (container.id, timeout))
+    finally:
+        try:
+            for k in list(app_client.kv.get_prefix(key)):
+                app_client.kv.discard(k)
+        except skein.ConnectionError:
+            pass  # application is gone
+
+
+class _RateLimiter(object):
+    """Spaces contended calls at least ``interval`` seconds apart, thread-safe"""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._next = 0
+
+    def wait(self, contended=True):
+        """Wait for the next slot, or take the call now if not contended"""
+        with self._lock:
+            now = time.time()
+            delay = max(self._next - now, 0) if contended else 0
+            self._next = max(self._next, now) + self.interval
+        if delay:
+            time.sleep(delay)
+
+
+class _ScaleBatch(object):
+    def __init__(self):
+        self.n = None
+        self.done = False
+        self.error = None
+
+
+def _observe_head_address(app_client, submit_time, stopped):
+    """Set HEAD_ADDRESS_SECONDS when head address appears in kv, rather than when it's first read"""
+    try:
+        # subscribed before the check so that an address published meanwhile is seen
+        with app_client.kv.events(key=_RAY_HEAD_ADDRESS, event_type="PUT") as events:
+            appeared = app_client.kv.get(_RAY_HEAD_ADDRESS) is not None
+            while not appeared and not stopped.is_set():
+                try:
+                    events.get(timeout=_HEAD_ADDRESS_POLL_INTERVAL)
+                    appeared = True
+                except queue.Empty:
+                    pass
+    except skein.ConnectionError:
+        return
+    if appeared:
+        metrics.HEAD_ADDRESS_SECONDS.set(time.time() - submit_time, app_id=app_client.id)
+
+
+def _reconcile_loop(cluster_ref, stopped, interval):
+    while not stopped.wait(interval):
+        cluster = cluster_ref()
+        if cluster is None:
+            return
+        try:
+            cluster.reconcile()
+        except skein.ApplicationNotRunningError:
+            return
+        except Exception as e:
+            warnings.warn("reconciliation of %s failed: %s" % (cluster, e))
+        del cluster
+
+
+def _host_of(container):
+    """Host of container from its NodeManager address, None until allocated"""
+    address = container.yarn_node_http_address
+    return address.rsplit(':', 1)[0] if address else None
+
+
 class YarnCluster(object):
 
     """Start a Ray cluster on YARN.
@@ -410,6 +681,61 @@ class YarnCluster(object):
         the YARN documentation for more information.
     skein_client: Optional[skein.Client] = None
         The ``skein.Client`` to use. If not provided, one will be started.
+    input_paths: List[str] = None
+        Input data paths on HDFS. If provided, worker containers are requested on the hosts
+        holding the most bytes of them, with relaxed locality as fallback.
+    block_location_provider: Optional[Callable] = None
+        Callable taking ``input_paths`` and returning a list of ``locality.BlockLocation``.
+        Defaults to ``locality.get_block_locations`` which runs ``hdfs fsck``.
+    head_max_restarts: Optional[int] = None
+        Allowed number of ray head restarts, -1 for unlimited. Defaults to ``max-restarts`` of head
+        in ``yarn.yaml``, or 0. Workers reconnect to restarted head in their containers.
+    gcs_redis_address: Optional[str] = None
+        Address of external redis, like ``redis-host:6379``, to keep cluster metadata in for GCS fault
+        tolerance, so that actors, placement groups and jobs survive head restarts. Defaults to
+        ``gcs-redis-address`` of head in ``yarn.yaml``. Ray 1.x doesn't namespace its keys, so the redis
+        must be dedicated to the cluster, and require its ``redis-password``.
+    reconcile_interval: Optional[float] = None
+        Seconds between worker reconciliations in a background thread. Each one replaces failed
+        workers to hold the scaled size and drains workers off hosts that fail repeatedly.
+        Disabled if not provided, call ``reconcile()`` instead.
+    scale_interval: Optional[float] = None
+        Minimum seconds between scale calls to application master while ``scale()`` calls
+        overlap, those arriving meanwhile are merged into one for the largest size. A call while
+        none is in flight goes at once. Defaults to ``scale-interval``
+        in ``yarn.yaml``.
+    spill_dir: Optional[str] = None
+        Directory on cluster filesystem, like ``hdfs:///tmp/ray-spill``, to spill objects to
+        instead of YARN local dirs. Objects of the cluster go to its subdirectory named by
+        application id, which is removed on shutdown. Defaults to ``spill-dir`` in ``yarn.yaml``.
+    idle_timeout: Optional[float] = None
+        Seconds ray may have no running tasks, actors or connected drivers before the application
+        scales workers to zero by itself. Defaults to ``idle-timeout`` in ``yarn.yaml``, disabled if
+        not set.
+    idle_shutdown_timeout: Optional[float] = None
+        Seconds ray may stay idle with workers scaled to zero before the application shuts down by
+        itself, with the reason in its diagnostics. Counted from when ray became idle if
+        ``idle_timeout`` is not set. Defaults to ``idle-shutdown-timeout`` in ``yarn.yaml``.
+    queues: List[str] = None
+        Queues allowed to deploy to. Before submitting, the one with headroom for most workers is
+        picked in place of ``queue``. Defaults to ``queues`` in ``yarn.yaml``.
+    capacity_check: Optional[str] = None
+        Check queue headroom before submitting, "warn" to warn about initial instances that don't
+        fit, or "cap" to drop them. Containers larger than any node are rejected with ValueError
+        either way. Defaults to ``capacity-check`` in ``yarn.yaml``, or "warn" if ``queues`` is
+        given.
+    working_dir: Optional[str] = None
+        Local directory of job code, like ``runtime_env`` working_dir but shipped to containers by
+        YARN localization at their start rather than through GCS. It is packed once, unpacked in
+        each container and put on ``PYTHONPATH``. Defaults to ``working-dir`` in ``yarn.yaml``.
+    py_modules: List[str] = None
+        Local package directories and python files, and local or HDFS wheel, zip or egg files,
+        shipped like ``working_dir`` and put on ``PYTHONPATH``. Defaults to ``py-modules`` in
+        ``yarn.yaml``.
+    target_resources: Optional[Dict] = None
+        Total resources of workers, like ``{"vcores": 400, "memory": "1600GiB"}``. Worker container
+        shape and initial instances are planned for it with least rounding waste and node
+        fragmentation, see ``planner.plan``, overriding ``ray_runtime_cfg``.
     ----------
     """
     def __init__(
@@ -420,7 +746,21 @@ class YarnCluster(object):
         queue: Optional[str] = None,
         tags: List[str] = None,
         user: Optional[str] = None,
-        skein_client: Optional[skein.Client] = None
+        skein_client: Optional[skein.Client] = None,
+        input_paths: List[str] = None,
+        block_location_provider: Optional[Callable] = None,
+        head_max_restarts: Optional[int] = None,
+        gcs_redis_address: Optional[str] = None,
+        reconcile_interval: Optional[float] = None,
+        scale_interval: Optional[float] = None,
+        spill_dir: Optional[str] = None,
+        queues: List[str] = None,
+        capacity_check: Optional[str] = None,
+        target_resources: Optional[Dict] = None,
+        idle_timeout: Optional[float] = None,
+        idle_shutdown_timeout: Optional[float] = None,
+        working_dir: Optional[str] = None,
+        py_modules: List[str] = None
     ):
         self.spec = _make_specification(
             ray_runtime_cfg=ray_runtime_cfg,
@@ -428,61 +768,434 @@ class YarnCluster(object):
             name=name,
             queue=queue,
             tags=tags,
-            user=user
+            user=user,
+            input_paths=input_paths,
+            block_location_provider=block_location_provider,
+            head_max_restarts=head_max_restarts,
+            gcs_redis_address=gcs_redis_address,
+            spill_dir=spill_dir,
+            idle_timeout=idle_timeout,
+            idle_shutdown_timeout=idle_shutdown_timeout,
+            working_dir=working_dir,
+            py_modules=py_modules
         )
+        self._spill_dir = self.spec.services[_WORKER_SERVICE].env.get(_ENV_SPILL_DIR)
+        self._queues = lookup({"queues": queues}, "queues", None)
+        self._capacity_check = lookup({"capacity_check": capacity_check}, "capacity_check", None)
+        if self._queues and not self._capacity_check:
+            self._capacity_check = "warn"
         self._requested = set()
+        self._lock = threading.Lock()
+        # scale requests, see _scale
+        self._scale_cond = threading.Condition()
+        self._scale_batch = None
+        self._scaling = False
+        scale_interval = lookup({"scale_interval": scale_interval}, "scale_interval", None)
+        self._rate_limiter = _RateLimiter(_SCALE_INTERVAL if scale_interval is None else scale_interval)
+        self._failed = set()
+        self._host_failures = {}
+        # bad hosts whose workers were drained, until they're no longer bad
+        self._drained_hosts = set()
+        self._replaced = 0
+        self._reconciled_at = None
         self._skein_client = skein_client
+        if target_resources:
+            self._skein_client = _get_skein_client(skein_client)
+            self._plan_workers(target_resources)
+        self._submit_time = time.time()
         self._start_cluster()
+        self._target = self.spec.services[_WORKER_SERVICE].instances
         self._home_ip = None
         self._redis_password = None
-        self._finalizer = weakref.finalize(self, self.application_client.shutdown)
+        self._finalizer = weakref.finalize(self, _shutdown_application, self.application_client)
+        self._detached = False
+        self._stopped = threading.Event()
+        self._topology = None
+        if metrics.is_enabled():
+            threading.Thread(target=_observe_head_address,
+                             args=(self.application_client, self._submit_time, self._stopped),
+                             name="ray-yarn-head-address", daemon=True).start()
+        if reconcile_interval:
+            # by weak reference, so that the finalizer still shuts down clusters which are dropped
+            threading.Thread(target=_reconcile_loop, args=(weakref.ref(self), self._stopped, reconcile_interval),
+                             name="ray-yarn-reconciler", daemon=True).start()
 
     @property
     def app_id(self):
         return self.application_client.id
 
-    def get_home_ip(self, timeout=30):
-        if self._home_ip is not None:
+    def get_home_ip(self, timeout=30, refresh=False):
+        """IP of ray head. Use ``refresh`` to read it again after head restarts."""
+        if self._home_ip is not None and not refresh:
             return self._home_ip
         value = _get_or_wait_kv(self.application_client, _RAY_HEAD_ADDRESS, timeout)
         self._home_ip = value.decode().split(':')[0]
         return self._home_ip
 
+    def get_client_address(self, timeout=30):
+        """Address of ray client server on head, in format of ``ray://<ip>:<port>``"""
+        value = _get_or_wait_kv(self.application_client, _RAY_CLIENT_ADDRESS, timeout)
+        return "ray://" + value.decode()
+
+    def get_ports(self, container_id, timeout=30):
+        """Ports of ray processes in given container which are allocated at container start.
+
+        Parameters
+        ----------
+        container_id : str
+            Skein container id, like ``ray.worker_0``.
+        """
+        value = _get_or_wait_kv(self.application_client, _RAY_PORTS_PREFIX + container_id, timeout)
+        return json.loads(value.decode())
+
+    def _plan_workers(self, target_resources):
+        """Size worker service by the best plan for target resources, returns the plan"""
+        target = skein.Resources(**target_resources)
+        nodes = [n.total_resources for n in self._skein_client.get_nodes(states=["RUNNING"])]
+        best = planner.plan(target.vcores, target.memory, nodes, config.yarn_configs.get("memory_increment"),
+                            config.yarn_configs.get("vcores_increment"))[0]
+        workers = self.spec.services[_WORKER_SERVICE]
+        workers.resources = skein.Resources(memory=best.memory, vcores=best.vcores)
+        workers.instances = best.count
+        return best
+
     def _start_cluster(self):
         """Start the cluster and initialize state"""
         skein_client = _get_skein_client(self._skein_client)
+        if self._capacity_check:
+            capacity.fit(skein_client, self.spec, _WORKER_SERVICE, self._queues, self._capacity_check)
         self.application_client = submit_and_handle_failures(skein_client, self.spec)
 
+    @metrics.SCALE_SECONDS.time()
     def _scale_up(self, n):
-        if n > len(self._requested):
-            containers = self.application_client.scale("ray.worker", n)
-            self._requested.update(c.id for c in containers)
+        if n <= len(self._requested):
+            return set()
+        added = {c.id for c in self.application_client.scale(_WORKER_SERVICE, n)}
+        self._requested.update(added)
+        return added
+
+    def _apply_scale(self, n):
+        """Scale up to n, returns ids of workers added"""
+        with self._lock:
+            if n > 0 and self.application_client.kv.get(_IDLE) is not None:
+                # head scaled workers to zero for idleness, scale up from there
+                self.application_client.kv.discard(_IDLE)
+                self._requested = {c.id for c in self._workers()}
+            if n < len(self._requested):
+                return set()
+            self._target = n
+            return self._scale_up(n)
 
     def _scale(self, n):
-        if n >= len(self._requested):
-            return self._scale_up(n)
+        """Scale to n, merged with concurrent requests.
 
-    def scale(self, n):
+        Requests join a batch until the rate limit lets a call to application master go, and the
+        batch is applied in one call for its largest size. One batch is applied at a time. A
+        request which arrives while none is in flight goes at once, there is nothing to merge.
+        """
+        with self._scale_cond:
+            contended = self._scaling
+            if self._scale_batch is None:
+                self._scale_batch = _ScaleBatch()
+            batch = self._scale_batch
+            # scale only grows, the largest size serves all requests of the batch
+            batch.n = max(batch.n or 0, n)
+            while not batch.done and self._scaling:
+                self._scale_cond.wait()
+            if batch.done:
+                if batch.error is not None:
+                    raise batch.error
+                return
+            self._scaling = True
+        try:
+            self._rate_limiter.wait(contended)
+            with self._scale_cond:
+                # later requests go to next batch
+                self._scale_batch = None
+                n = batch.n
+            self._apply_scale(n)
+        except Exception as e:
+            batch.error = e
+            raise
+        finally:
+            with self._scale_cond:
+                if self._scale_batch is batch:
+                    self._scale_batch = None
+                batch.done = True
+                self._scaling = False
+                self._scale_cond.notify_all()
+
+    def _joined(self):
+        """Ids of running workers whose ray node registered with GCS, as they published it to kv"""
+        published = self.application_client.kv.get_prefix(topology._NODES_PREFIX)
+        return {c.id for c in self._workers()
+                if c.state == skein.model.ContainerState.RUNNING and topology._NODES_PREFIX + c.id in published}
+
+    def _gang_scale(self, n, timeout):
+        """Scale to n and wait until n workers joined, or release workers added and raise TimeoutError"""
+        with self._lock:
+            target = self._target
+        # not merged with concurrent requests, so that exactly the workers added for this call are known
+        added = self._apply_scale(n)
+        deadline = time.time() + timeout
+        while True:
+            joined = len(self._joined())
+            if joined >= n:
+                return
+            if time.time() >= deadline:
+                break
+            time.sleep(min(_GANG_POLL_INTERVAL, max(deadline - time.time(), 0)))
+        with self._lock:
+            for container_id in added:
+                self._release(container_id)
+            self._requested -= added
+            if self._target == n:
+                # unless scaled by others meanwhile
+                self._target = target
+        raise TimeoutError("%d of %d workers joined in %s seconds, released %d added workers"
+                           % (joined, n, timeout, len(added)))
+
+    def scale(self, n, gang=False, timeout=None):
         """Scale cluster to n workers.
 
         Parameters
         ----------
         n : int
             Target number of workers
+        gang : bool, optional
+            All or nothing. Wait until n workers joined, that is running with ray started. If they
+            don't join in time, workers added by this call are released and TimeoutError is raised,
+            so that partial allocations don't hold capacity.
+        timeout : float, optional
+            Seconds to wait for workers to join with ``gang``. Defaults to 300.
 
         Examples
         --------
         >>> cluster.scale(10)  # scale cluster to ten workers
+        >>> cluster.scale(8, gang=True, timeout=600)  # eight workers or none of them
         """
+        if gang:
+            return self._gang_scale(n, _GANG_TIMEOUT if timeout is None else timeout)
         return self._scale(n)
 
+    def resize(self, n):
+        """Scale cluster to exactly n workers, down as well as up.
+
+        Unlike ``scale``, workers above n are released, those added last first, and the scaled
+        size that ``reconcile()`` holds is reset to n.
+
+        Parameters
+        ----------
+        n : int
+            Target number of workers
+        """
+        with self._lock:
+            if n > 0:
+                self.application_client.kv.discard(_IDLE)
+            workers = sorted(self._workers(), key=lambda c: c.instance)
+            for c in workers[n:]:
+                self._release(c.id)
+            self._requested = {c.id for c in workers[:n]}
+            self._target = n
+            if len(workers) < n:
+                added = self.application_client.scale(_WORKER_SERVICE, delta=n - len(workers))
+                self._requested.update(c.id for c in added)
+
+    def run_driver(self, script, args=(), resources=None, shutdown=False, timeout=None, output=None):
+        """Run python script as driver in a container of the cluster, returns its exit code.
+
+        See ``run_driver`` of the module.
+
+        Parameters
+        ----------
+        script : str
+            Path of the python script.
+        args : List[str], optional
+            Arguments of the script.
+        resources : dict, optional
+            Container resources the driver needs, like ``{"memory": "4GiB", "vcores": 2}``. Driver
+            containers are sized by ``driver`` in ``yarn.yaml`` at submission, ValueError is
+            raised if they're smaller.
+        shutdown : bool, optional
+            Shut the cluster down when the driver exits, failed unless it exits with 0.
+        timeout : float, optional
+            Seconds to wait for the driver to exit. Waits forever by default.
+        output : file-like, optional
+            Where driver's output is written to, ``sys.stdout`` by default.
+
+        Examples
+        --------
+        >>> cluster.run_driver("train.py", ["--epochs", "10"], shutdown=True)
+        """
+        if resources:
+            needed = skein.Resources(**resources)
+            sized = self.spec.services[_DRIVER_SERVICE].resources
+            if needed.memory > sized.memory or needed.vcores > sized.vcores:
+                raise ValueError("driver needs %d MiB and %d vcores, driver containers have %d MiB and %d vcores. "
+                                 "Configure driver in yarn.yaml." % (needed.memory, needed.vcores, sized.memory,
+                                                                     sized.vcores))
+        status = "FAILED"
+        try:
+            code = run_driver(self.application_client, script, args, output, timeout)
+            if code == 0:
+                status = "SUCCEEDED"
+            return code
+        finally:
+            if shutdown:
+                self.shutdown(status)
+
+    def resource_usage(self):
+        """Allocated and used resources of each active container, a list of ``usage.ContainerUsage``.
+
+        Containers publish usage every ``usage-interval`` seconds of ``yarn.yaml``. Used fields
+        are None until they did.
+
+        Examples
+        --------
+        >>> for u in cluster.resource_usage():
+        ...     print(u.container, u.cpu, u.vcores, u.rss_max, u.memory)
+        """
+        return usage.resource_usage(self.application_client)
+
+    def topology(self):
+        """``topology.Topology`` of ray nodes of containers, indexed by container id, ray node id and host.
+
+        Containers publish their ray node once it registered with GCS and withdraw it when they
+        exit. The index follows kv from the first call on until ``shutdown()``. Ray nodes of
+        containers gone without exiting, like killed ones, are withdrawn by ``reconcile()``.
+
+        Examples
+        --------
+        >>> nodes = cluster.topology()
+        >>> nodes.by_node_id(ray.get_runtime_context().node_id.hex()).container
+        'ray.worker_3'
+        >>> [n.container for n in nodes.on_host("host-17")]
+        ['ray.worker_3', 'ray.worker_8']
+        """
+        with self._lock:
+            if self._topology is None:
+                self._topology = topology.Topology()
+                threading.Thread(target=self._topology.watch, args=(self.application_client.kv, self._stopped),
+                                 name="ray-yarn-topology", daemon=True).start()
+            return self._topology
+
+    def _release(self, container_id):
+        """Kill worker on purpose, so that it doesn't request a replacement"""
+        self.application_client.kv[_RELEASED_PREFIX + container_id] = str(time.time()).encode()
+        try:
+            self.application_client.kill_container(container_id)
+        except ValueError:
+            pass  # already gone
+        self._forget(container_id)
+
+    def _forget(self, container_id):
+        """Withdraw ray node of container which is gone from topology"""
+        topology.withdraw(self.application_client.kv, container_id)
+        if self._topology is not None:
+            self._topology.discard(container_id)
+
     def workers(self):
         """A list of all currently running worker containers."""
         return self._workers()
 
+    @metrics.WORKERS_SECONDS.time()
     def _workers(self):
-        return self.application_client.get_containers(services=["ray.worker"])
+        containers = self.application_client.get_containers(services=[_WORKER_SERVICE])
+        if metrics.is_enabled():
+            for state in skein.model.ContainerState:
+                count = sum(1 for c in containers if c.state == state)
+                metrics.CONTAINERS.set(count, app_id=self.app_id, state=str(state))
+        return containers
+
+    def _bad_hosts(self, now):
+        for host, failures in list(self._host_failures.items()):
+            self._host_failures[host] = [t for t in failures if now - t < _BAD_HOST_WINDOW]
+            if not self._host_failures[host]:
+                del self._host_failures[host]
+        return {h for h, failures in self._host_failures.items() if len(failures) >= _BAD_HOST_FAILURES}
+
+    def reconcile(self):
+        """Replace failed workers and drain workers off bad hosts.
+
+        Worker failures are counted per container and per host, and hosts with repeated failures
+        are reported in ``bad_hosts``. Running workers on a host are drained once as it turns bad,
+        so that they finish their tasks and leave for replacements. Skein can't keep requests off
+        hosts once the application is submitted, so replacements could land there again, those
+        are kept until the host's failures age out and it turns bad again. Missing workers are
+        requested in batches until the scaled size is reached again. Returns ``health()``.
+        """
+        with self._lock:
+            now = time.time()
+            containers = self.application_client.get_containers(services=[_WORKER_SERVICE], states=_ALL_STATES)
+            for c in containers:
+                if str(c.state) == "FAILED" and c.id not in self._failed:
+                    self._failed.add(c.id)
+                    if _host_of(c):
+                        self._host_failures.setdefault(_host_of(c), []).append(now)
+            bad_hosts = self._bad_hosts(now)
+            turned_bad = bad_hosts - self._drained_hosts
+            self._drained_hosts = bad_hosts
+            active = set()
+            published = self.application_client.kv.get_prefix(topology._NODES_PREFIX)
+            for c in containers:
+                if str(c.state) in _ACTIVE_STATES:
+                    active.add(c.id)
+                    if str(c.state) == "RUNNING" and _host_of(c) in turned_bad:
+                        # requests its replacement as it leaves
+                        self.drain(c.id)
+                elif topology._NODES_PREFIX + c.id in published:
+                    # gone without withdrawing its ray node, like killed ones
+                    self._forget(c.id)
+            self._requested = active
+            if self._target and self.application_client.kv.get(_IDLE) is not None:
+                # head scaled workers to zero, they're not replaced
+                self._target = 0
+            missing = min(self._target - len(active), _REPLACE_BATCH_SIZE)
+            if missing > 0:
+                added = self.application_client.scale(_WORKER_SERVICE, delta=missing)
+                self._requested.update(c.id for c in added)
+                self._replaced += len(added)
+            self._reconciled_at = now
+            return self._health(bad_hosts)
+
+    def _health(self, bad_hosts):
+        return ClusterHealth(target=self._target, active=len(self._requested), failed=len(self._failed),
+                             replaced=self._replaced,
+                             host_failures={h: len(f) for h, f in self._host_failures.items()},
+                             bad_hosts=sorted(bad_hosts), reconciled_at=self._reconciled_at)
+
+    def health(self):
+        """``ClusterHealth`` of workers as of last reconciliation."""
+        with self._lock:
+            return self._health(self._bad_hosts(time.time()))
+
+    def drain(self, container_id):
+        """Drain a worker ahead of its preemption or removal.
+
+        The worker requests a replacement container, stops accepting new tasks, waits for running
+        ones to finish, then exits.
+
+        Parameters
+        ----------
+        container_id : str
+            Skein container id, like ``ray.worker_0``.
+        """
+        self.application_client.kv[_DRAIN_PREFIX + container_id] = str(time.time()).encode()
+
+    def draining(self):
+        """Ids of worker containers being drained."""
+        return [k[len(_DRAINING_PREFIX):] for k in self.application_client.kv.get_prefix(_DRAINING_PREFIX)]
 
+    def detach(self):
+        """Keep the application running once this object is dropped or the interpreter exits.
+
+        ``shutdown()`` still stops it, so does ``ray-yarn kill`` with its id once this process is gone.
+        """
+        if self._finalizer is not None:
+            self._finalizer.detach()
+            self._detached = True
+
+    @metrics.SHUTDOWN_SECONDS.time()
     def shutdown(self, status="SUCCEEDED", diagnostics=None):
         """Shutdown the application.
 
@@ -495,11 +1208,20 @@ class YarnCluster(object):
             Can be seen in the YARN Web UI for completed applications under
             "diagnostics". If not provided, a default will be used.
         """
-        if self._finalizer is not None and self._finalizer.peek() is not None:
-            self.application_client.shutdown(status=status, diagnostics=diagnostics)
+        self._stopped.set()
+        if self._finalizer is not None and (self._detached or self._finalizer.peek() is not None):
+            _shutdown_application(self.application_client, status, diagnostics)
             self._finalizer.detach()  # don't run the finalizer later
+            if self._spill_dir:
+                self._remove_spilled()
         self._finalizer = None
 
+    def _remove_spilled(self):
+        try:
+            spill.remove(self._spill_dir, self.app_id)
+        except Exception as e:
+            warnings.warn("failed to remove spilled objects of %s in %s: %s" % (self.app_id, self._spill_dir, e))
+
     def __enter__(self):
         return self
 
@@ -0,0 +1,165 @@
+import itertools
+from collections import namedtuple
+from typing import List, Dict, Optional, Callable
+import ray
+from . import locality
+from .core import _HOST_RESOURCE_PREFIX
+
+try:
+    from ray.util.scheduling_strategies import NodeAffinitySchedulingStrategy
+except ImportError:
+    # ray < 1.12, read tasks are not pinned
+    NodeAffinitySchedulingStrategy = None
+
+FORMAT_PARQUET = "parquet"
+FORMAT_BINARY = "binary"
+
+Split = namedtuple("Split", ["path", "offset", "length", "host", "node_id"])
+Split.__doc__ = """A block to read by one task, soft-pinned to ray node ``node_id`` on ``host`` if not None"""
+
+
+def _container_host(container):
+    return container.yarn_node_http_address.split(':')[0]
+
+
+def nodes_by_host(cluster) -> Dict[str, List[str]]:
+    """Ray node ids of this application, keyed by host of their containers.
+
+    Hosts come from ``cluster.workers()``. Ray nodes are matched by the "node:<hostname>" custom
+    resource that each container registers in ``cli.start``.
+    """
+    hosts = {_container_host(c) for c in cluster.workers()}
+    nodes = {}
+    for node in ray.nodes():
+        if not node.get("Alive"):
+            continue
+        for r in node.get("Resources", {}):
+            host = r[len(_HOST_RESOURCE_PREFIX):] if r.startswith(_HOST_RESOURCE_PREFIX) else None
+            if host in hosts:
+                nodes.setdefault(host, []).append(node["NodeID"])
+    return nodes
+
+
+def plan_splits(blocks: List[locality.BlockLocation], nodes: Dict[str, List[str]]) -> List[Split]:
+    """Assign each block to a co-located ray node.
+
+    Among replica hosts running a ray node of this application, the one with fewest splits so far is
+    picked, and ray nodes on the same host are used in round-robin. Blocks without co-located node
+    are not pinned.
+    """
+    load = {h: 0 for h in nodes}
+    rotations = {h: itertools.cycle(ids) for h, ids in nodes.items()}
+    splits = []
+    for b in blocks:
+        candidates = [h for h in b.hosts if h in load]
+        if candidates:
+            host = min(candidates, key=lambda h: load[h])
+            load[host] += 1
+            splits.append(Split(b.path, b.offset, b.length, host, next(rotations[host])))
+        else:
+            splits.append(Split(b.path, b.offset, b.length, None, None))
+    return splits
+
+
+def _row_group_offset(row_group):
+    column = row_group.column(0)
+    if column.has_dictionary_page and column.dictionary_page_offset:
+        return min(column.dictionary_page_offset, column.data_page_offset)
+    return column.data_page_offset
+
+
+def read_split(split: Split, filesystem, format=FORMAT_PARQUET, columns=None, batch_size=65536):
+    """Read one split as an iterator of ``pyarrow.RecordBatch``.
+
+    For parquet, row groups starting inside the split are read, like Hadoop input splits, one
+    batch at a time. For binary, the byte range is read as one batch with a single "bytes" column.
+    """
+    if format not in (FORMAT_PARQUET, FORMAT_BINARY):
+        raise ValueError("unsupported format, " + format)
+    if format == FORMAT_BINARY:
+        return _read_binary(split, filesystem)
+    return _read_parquet(split, filesystem, columns, batch_size)
+
+
+def _read_binary(split, filesystem):
+    import pyarrow as pa
+
+    with filesystem.open_input_file(split.path) as f:
+        f.seek(split.offset)
+        data = f.read(split.length)
+    yield pa.RecordBatch.from_arrays([pa.array([data], type=pa.binary())], names=["bytes"])
+
+
+def _read_parquet(split, filesystem, columns, batch_size):
+    import pyarrow.parquet as pq
+
+    with filesystem.open_input_file(split.path) as f:
+        pf = pq.ParquetFile(f)
+        end = split.offset + split.length
+        row_groups = [i for i in range(pf.metadata.num_row_groups)
+                      if split.offset <= _row_group_offset(pf.metadata.row_group(i)) < end]
+        if row_groups:
+            yield from pf.iter_batches(batch_size=batch_size, row_groups=row_groups, columns=columns)
+
+
+@ray.remote
+def _read_split_remote(split, filesystem, format, columns, batch_size):
+    # each batch is put to the object store as it's read, rather than the split returned whole, so
+    # that a task holds one batch at a time
+    return [ray.put(batch) for batch in read_split(split, filesystem, format=format, columns=columns,
+                                                   batch_size=batch_size)]
+
+
+def _as_completed(refs):
+    """Refs of batches of read tasks, task by task in order of completion"""
+    while refs:
+        ready, refs = ray.wait(refs, num_returns=1)
+        yield from ray.get(ready[0])
+
+
+def read_files(
+    paths: List[str],
+    cluster,
+    format: str = FORMAT_PARQUET,
+    columns: Optional[List[str]] = None,
+    filesystem=None,
+    block_location_provider: Optional[Callable] = None,
+    batch_size: int = 65536
+):
+    """Read files in parallel with one ray task per block, each soft-pinned to a co-located ray node.
+
+    Parameters
+    ----------
+    paths : List[str]
+        Files or directories to read.
+    cluster : YarnCluster
+        The cluster whose worker containers the read tasks are placed on.
+    format : {'parquet', 'binary'}, optional
+        File format. Binary reads raw byte ranges of blocks.
+    columns : List[str], optional
+        Columns to read from parquet files.
+    filesystem : pyarrow.fs.FileSystem, optional
+        Filesystem to read with. Defaults to ``pyarrow.fs.HadoopFileSystem("default")``.
+    block_location_provider : Callable, optional
+        Callable taking ``paths`` and returning a list of ``locality.BlockLocation``. Defaults to
+        ``locality.get_block_locations``.
+    batch_size : int, optional
+        Maximum rows of record batches read from parquet.
+
+    Returns
+    -------
+    Iterator of ``ObjectRef`` to ``pyarrow.RecordBatch``, split by split in order of completion.
+    """
+    if filesystem is None:
+        from pyarrow.fs import HadoopFileSystem
+        filesystem = HadoopFileSystem("default")
+    provider = block_location_provider or locality.get_block_locations
+    splits = plan_splits(provider(paths), nodes_by_host(cluster))
+    pending = []
+    for split in splits:
+        options = {}
+        if split.node_id is not None and NodeAffinitySchedulingStrategy is not None:
+            options["scheduling_strategy"] = NodeAffinitySchedulingStrategy(split.node_id, soft=True)
+        pending.append(_read_split_remote.options(**options).remote(
+            split, filesystem, format=format, columns=columns, batch_size=batch_size))
+    return _as_completed(pending)
@@ -0,0 +1,89 @@
+"""Cache of packed Python environments on HDFS, keyed by archive content.
+
+An archive in the cache is localized as a YARN public resource. NodeManagers unpack public
+resources once per host and share the copy with all containers and applications, instead of
+unpacking the archive into each container. Public localization needs the archive and all its
+parent directories to be readable by everyone, which ``cached_archive`` takes care of for the
+directories it creates.
+"""
+import hashlib
+import json
+import os
+import subprocess
+
+from . import config
+
+_CHUNK_SIZE = 8 * 2 ** 20
+_DIGESTS_FILE = "environment-digests.json"
+# bytecode cache in first YARN local dir, shared by containers of the application on a host
+_PYCACHE_DIR = "${LOCAL_DIRS%%,*}/ray-yarn-pycache"
+
+
+def _hdfs(*args):
+    """Run ``hdfs dfs`` with args, returns exit code"""
+    return subprocess.call(["hdfs", "dfs"] + list(args), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def _digests_path():
+    return os.path.join(config.USER_CONFIG_LOC, _DIGESTS_FILE)
+
+
+def _load_digests():
+    try:
+        with open(_digests_path()) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def archive_digest(path):
+    """SHA-256 of archive content. Remembered by path, size and mtime so that it's hashed once."""
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    key = "%s:%d:%d" % (path, st.st_size, st.st_mtime_ns)
+    digests = _load_digests()
+    if key in digests:
+        return digests[key]
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(_CHUNK_SIZE), b""):
+            h.update(chunk)
+    digests = {k: v for k, v in digests.items() if not k.startswith(path + ":")}
+    digests[key] = h.hexdigest()
+    try:
+        os.makedirs(config.USER_CONFIG_LOC, exist_ok=True)
+        with open(_digests_path(), "w") as f:
+            json.dump(digests, f)
+    except OSError:
+        pass
+    return digests[key]
+
+
+def cached_archive(path, cache_dir):
+    """Upload archive to ``<cache_dir>/<digest>/<name>`` unless it's there, returns the cached path"""
+    digest = archive_digest(path)
+    directory = "%s/%s" % (cache_dir.rstrip('/'), digest)
+    target = "%s/%s" % (directory, os.path.basename(path))
+    if _hdfs("-test", "-e", target) == 0:
+        return target
+    _hdfs("-mkdir", "-p", directory)
+    _hdfs("-chmod", "755", cache_dir, directory)
+    # "-put" copies to a temporary file and renames it, concurrent uploads of same archive are safe
+    if _hdfs("-put", path, target) != 0 and _hdfs("-test", "-e", target) != 0:
+        raise IOError("failed to upload %s to %s" % (path, target))
+    _hdfs("-chmod", "644", target)
+    return target
+
+
+def pycache_dir():
+    """Bytecode cache directory of containers, see ``PYTHONPYCACHEPREFIX``. A shell expression.
+
+    Environments unpacked by NodeManager are read-only to containers, so bytecode can't be written
+    next to sources. The first container of the application on a host compiles modules it imports
+    into this directory, later ones start with bytecode. It's in the application's local dir,
+    which only the application user can write to and which NodeManager removes with the
+    application, rather than in a shared directory where others could plant bytecode. So each
+    application compiles modules again on each host, archives aren't precompiled. Python before
+    3.8 ignores ``PYTHONPYCACHEPREFIX``, containers warn about it in their log.
+    """
+    return _PYCACHE_DIR
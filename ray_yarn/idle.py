@@ -0,0 +1,154 @@
+"""Idle timeout of clusters, enforced by the application itself.
+
+``Reaper`` runs in the head container next to ray. Clusters started from notebooks are often
+forgotten, and the client only shuts them down when its process exits cleanly. When ray has no
+running tasks, actors or connected drivers for ``scale_down_after`` seconds, the reaper scales
+workers to zero, and if it stays idle for ``shutdown_after`` more seconds, shuts the application
+down with the reason in its diagnostics.
+
+While workers are scaled down for idleness, ``idle`` in application kv holds the time they were,
+so that clients don't replace them.
+"""
+import time
+from collections import namedtuple
+
+from . import topology
+from .core import _IDLE, _RAY_SHUTDOWN
+
+# seconds between checks of ray activity
+_POLL_INTERVAL = 10
+# resources taken by scheduling rather than by tasks and actors
+_IGNORED_RESOURCES = ("object_store_memory",)
+
+Activity = namedtuple("Activity", ["drivers", "actors", "busy_resources"])
+Activity.__doc__ = """Connected drivers, alive actors, and names of resources in use by tasks or actors"""
+
+
+def _is_idle(activity):
+    return not (activity.drivers or activity.actors or activity.busy_resources)
+
+
+def _describe(activity):
+    return "%d drivers, %d actors, resources in use: %s" % (activity.drivers, activity.actors,
+                                                            ", ".join(activity.busy_resources) or "none")
+
+
+def gcs_activity(gcs_address):
+    """Callable returning ``Activity`` of the ray cluster of GCS at address.
+
+    It reads GCS tables without connecting as a driver, so that it doesn't keep the cluster busy.
+    They're opened on first call, which raises ImportError if this ray version can't read them.
+    """
+    states = []
+
+    def activity():
+        if not states:
+            states.append(topology.gcs_state(gcs_address))
+        state = states[0]
+        drivers = sum(1 for job in state.job_table() if not job["IsDead"])
+        actors = sum(1 for actor in state.actor_table(None).values() if actor["State"] != "DEAD")
+        available = state.available_resources()
+        busy = sorted(name for name, total in state.cluster_resources().items()
+                      if name not in _IGNORED_RESOURCES and not name.startswith("node:")
+                      and available.get(name, 0) < total)
+        return Activity(drivers, actors, busy)
+    return activity
+
+
+class Reaper(object):
+    """Scales workers to zero and shuts the application down when ray is idle.
+
+    Parameters
+    ----------
+    app_client : skein.ApplicationClient
+        Client of the application, from its head container.
+    activity : callable
+        Returns ``Activity`` of ray, like ``gcs_activity(address)``. ImportError from it disables
+        the reaper, ray can't tell its activity then.
+    scale_down_after : float
+        Seconds ray is idle before workers are scaled to zero, 0 to never.
+    shutdown_after : float
+        Seconds ray is idle with workers scaled to zero before the application shuts down, 0 to
+        never.
+    worker_service : str
+        Name of the worker service.
+    on_shutdown : callable, optional
+        Called before the application shuts down, like to remove spilled objects.
+    """
+
+    def __init__(self, app_client, activity, scale_down_after, shutdown_after, worker_service, on_shutdown=None,
+                 clock=time):
+        self.app_client = app_client
+        self.activity = activity
+        self.scale_down_after = scale_down_after
+        self.shutdown_after = shutdown_after
+        self.worker_service = worker_service
+        self.on_shutdown = on_shutdown
+        self.clock = clock
+        self._idle_since = None
+        self._scaled_down_at = None
+
+    def _active_workers(self):
+        return self.app_client.get_containers(services=[self.worker_service])
+
+    def check(self):
+        """Check ray activity once, scaling down or shutting down if idle long enough.
+
+        Returns "scale-down" or "shutdown" when it did, otherwise None.
+        """
+        now = self.clock.time()
+        activity = self.activity()
+        if not _is_idle(activity):
+            self._idle_since = None
+            if self._scaled_down_at is not None:
+                # in use again, clients may scale workers up
+                print("ray in use again, %s" % _describe(activity))
+                self._scaled_down_at = None
+                self.app_client.kv.discard(_IDLE)
+            return None
+        if self._idle_since is None:
+            self._idle_since = now
+        if self._scaled_down_at is not None and self._active_workers():
+            # scaled up by a client meanwhile, idle from now on
+            self._scaled_down_at = None
+            self._idle_since = now
+            self.app_client.kv.discard(_IDLE)
+        idle = now - self._idle_since
+        if self._scaled_down_at is None:
+            if self.scale_down_after and idle >= self.scale_down_after:
+                self._scaled_down_at = now
+                # published before the scale so that killed workers aren't replaced
+                self.app_client.kv[_IDLE] = str(now).encode()
+                self.app_client.scale(self.worker_service, count=0)
+                print("scaled workers to zero, ray idle for %d seconds" % idle)
+                return "scale-down"
+            if not self.scale_down_after and self.shutdown_after and idle >= self.shutdown_after:
+                return self._shutdown(idle)
+        elif self.shutdown_after and now - self._scaled_down_at >= self.shutdown_after:
+            return self._shutdown(idle)
+        return None
+
+    def _shutdown(self, idle):
+        diagnostics = ("shut down by idle timeout: no running tasks, actors or connected drivers for %d seconds"
+                       % idle)
+        if self.on_shutdown is not None:
+            try:
+                self.on_shutdown()
+            except Exception as e:
+                print("failed before idle shutdown: %s" % e)
+        # workers terminated by shutdown don't request replacements
+        self.app_client.kv[_RAY_SHUTDOWN] = b"SUCCEEDED"
+        self.app_client.shutdown(status="SUCCEEDED", diagnostics=diagnostics)
+        return "shutdown"
+
+    def run(self, stopped):
+        """Check every few seconds until ``stopped`` event is set or the application shut down"""
+        while not stopped.wait(_POLL_INTERVAL):
+            try:
+                if self.check() == "shutdown":
+                    return
+            except ImportError as e:
+                print("idle timeout disabled: %s" % e)
+                return
+            except Exception as e:
+                print("idle check failed: %s" % e)
@@ -0,0 +1,103 @@
+import os
+import re
+import socket
+import subprocess
+from collections import namedtuple, OrderedDict
+from typing import List, Dict
+
+BlockLocation = namedtuple("BlockLocation", ["path", "offset", "length", "hosts"])
+BlockLocation.__doc__ = """A block of file, [offset, offset + length), and hosts holding its replicas"""
+
+# "/data/part-0.parquet 268435456 bytes, replicated: replication=3, 2 block(s):  OK"
+_PATTERN_FSCK_FILE = re.compile(r"^(/\S*|\w+://\S*) (\d+) bytes")
+# "0. BP-929597290-172.17.0.2-1634:blk_1073741825_1001 len=134217728 Live_repl=3
+#  [DatanodeInfoWithStorage[172.18.0.3:9866,DS-5e1d,DISK], DatanodeInfoWithStorage[172.18.0.4:9866,DS-8a0c,DISK]]"
+_PATTERN_FSCK_BLOCK = re.compile(r"^\d+\.\s+\S+\s+len=(\d+).*?\[(.*)\]\s*$")
+_PATTERN_FSCK_DATANODE = re.compile(r"([\w.-]+):\d+")
+
+
+def _resolve_host(address, cache):
+    if address not in cache:
+        try:
+            cache[address] = socket.gethostbyaddr(address)[0]
+        except OSError:
+            cache[address] = address
+    return cache[address]
+
+
+def parse_fsck(output):
+    """Parse output of ``hdfs fsck <path> -files -blocks -locations`` to list of ``BlockLocation``"""
+    blocks = []
+    path = None
+    offset = 0
+    resolved = {}
+    for line in output.splitlines():
+        line = line.strip()
+        m = _PATTERN_FSCK_FILE.match(line)
+        if m:
+            path = m.group(1)
+            offset = 0
+            continue
+        m = _PATTERN_FSCK_BLOCK.match(line)
+        if m and path is not None:
+            length = int(m.group(1))
+            hosts = [_resolve_host(a, resolved) for a in _PATTERN_FSCK_DATANODE.findall(m.group(2))]
+            blocks.append(BlockLocation(path, offset, length, hosts))
+            offset += length
+    return blocks
+
+
+def get_block_locations(paths: List[str]) -> List[BlockLocation]:
+    """Get block locations of files under given HDFS paths with ``hdfs fsck``
+
+    This is the default block location provider. Any callable with the same signature can be
+    used in place of it.
+    """
+    output = subprocess.check_output(["hdfs", "fsck"] + list(paths) + ["-files", "-blocks", "-locations"],
+                                     stderr=subprocess.DEVNULL)
+    return parse_fsck(output.decode())
+
+
+def bytes_by_host(blocks: List[BlockLocation]) -> Dict[str, int]:
+    """Bytes held by each host, in descending order"""
+    held = {}
+    for b in blocks:
+        for h in b.hosts:
+            held[h] = held.get(h, 0) + b.length
+    return OrderedDict(sorted(held.items(), key=lambda kv: (-kv[1], kv[0])))
+
+
+def preferred_hosts(blocks: List[BlockLocation], max_hosts=None) -> List[str]:
+    """Hosts to request containers on so that every block has a replica local to one of them.
+
+    Hosts are picked greedily by bytes of blocks not yet covered, so the ones holding the most
+    bytes come first.
+    """
+    uncovered = [b for b in blocks if b.hosts]
+    hosts = []
+    while uncovered and (max_hosts is None or len(hosts) < max_hosts):
+        host = next(iter(bytes_by_host(uncovered)))
+        hosts.append(host)
+        uncovered = [b for b in uncovered if host not in b.hosts]
+    return hosts
+
+
+def local_block_locations(paths: List[str], block_size: int, hosts: List[str]) -> List[BlockLocation]:
+    """Block locations of local files split by ``block_size``, assigned to ``hosts`` in round-robin.
+
+    A stand-in of ``get_block_locations`` for local filesystem.
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(os.path.join(path, f) for f in os.listdir(path)
+                                if os.path.isfile(os.path.join(path, f))))
+        else:
+            files.append(path)
+    blocks = []
+    for f in files:
+        size = os.path.getsize(f)
+        for offset in range(0, size, block_size):
+            host = hosts[len(blocks) % len(hosts)] if hosts else None
+            blocks.append(BlockLocation(f, offset, min(block_size, size - offset), [host] if host else []))
+    return blocks
@@ -0,0 +1,185 @@
+"""Metrics of ray-yarn control plane in Prometheus text format.
+
+Metrics are off by default and instrumented code only checks a flag then. Turn them on and
+either scrape ``REGISTRY.render()`` from host application or start an HTTP endpoint.
+
+>>> from ray_yarn import metrics
+>>> metrics.enable()
+>>> server = metrics.start_http_server(9090)  # serves /metrics
+"""
+import bisect
+import functools
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+_enabled = False
+
+_DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def enable():
+    global _enabled
+    _enabled = True
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def is_enabled():
+    return _enabled
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('%s="%s"' % (k, str(v).replace('"', '\\"')) for k, v in labels) + "}"
+
+
+class _Metric(object):
+    type = None
+
+    def __init__(self, name, documentation, registry=None):
+        self.name = name
+        self.documentation = documentation
+        self._lock = threading.Lock()
+        self._values = {}
+        (registry if registry is not None else REGISTRY).register(self)
+
+    def _samples(self):
+        raise NotImplementedError()
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.documentation), "# TYPE %s %s" % (self.name, self.type)]
+        with self._lock:
+            lines.extend(self._samples())
+        return lines
+
+
+class Gauge(_Metric):
+    """Gauge with optional labels, like ``CONTAINERS.set(3, state="RUNNING")``"""
+    type = "gauge"
+
+    def set(self, value, **labels):
+        if not _enabled:
+            return
+        with self._lock:
+            self._values[tuple(sorted(labels.items()))] = value
+
+    def get(self, **labels):
+        return self._values.get(tuple(sorted(labels.items())))
+
+    def remove(self, **labels):
+        """Drop samples with labels, like all those of ``app_id`` once it's shut down"""
+        with self._lock:
+            for key in [k for k in self._values if set(labels.items()) <= set(k)]:
+                del self._values[key]
+
+    def _samples(self):
+        return ["%s%s %s" % (self.name, _format_labels(k), v) for k, v in self._values.items()]
+
+
+class Histogram(_Metric):
+    """Histogram of observed values, in seconds for timings"""
+    type = "histogram"
+
+    def __init__(self, name, documentation, buckets=_DEFAULT_BUCKETS, registry=None):
+        super(Histogram, self).__init__(name, documentation, registry)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        if not _enabled:
+            return
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    def count(self, **labels):
+        value = self._values.get(tuple(sorted(labels.items())))
+        return sum(value[0]) if value else 0
+
+    def time(self, **labels):
+        """Decorator observing duration of each call"""
+        def decorate(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if not _enabled:
+                    return func(*args, **kwargs)
+                start = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.observe(time.perf_counter() - start, **labels)
+            return wrapper
+        return decorate
+
+    def _samples(self):
+        lines = []
+        for key, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append("%s_bucket%s %d" % (self.name, _format_labels(key + (("le", le),)), cumulative))
+            lines.append("%s_sum%s %s" % (self.name, _format_labels(key), total))
+            lines.append("%s_count%s %d" % (self.name, _format_labels(key), cumulative))
+        return lines
+
+
+class Registry(object):
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+
+    def render(self):
+        """All metrics in Prometheus text exposition format"""
+        lines = []
+        for m in self._metrics:
+            lines.extend(m.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+SUBMIT_SECONDS = Histogram("ray_yarn_submit_seconds", "Time to submit application and connect to it")
+HEAD_ADDRESS_SECONDS = Gauge("ray_yarn_head_address_seconds",
+                             "Time from submission until ray head address appears in kv")
+KV_WAIT_SECONDS = Histogram("ray_yarn_kv_wait_seconds", "Time waiting for a key in application kv")
+SCALE_SECONDS = Histogram("ray_yarn_scale_seconds", "Time of scaling ray workers up")
+WORKERS_SECONDS = Histogram("ray_yarn_workers_seconds", "Time of listing worker containers")
+CONTAINERS = Gauge("ray_yarn_containers", "Number of worker containers by state")
+SHUTDOWN_SECONDS = Histogram("ray_yarn_shutdown_seconds", "Time of shutting application down")
+
+
+def start_http_server(port, addr="", registry=None):
+    """Serve metrics at ``http://<addr>:<port>/metrics`` in a daemon thread.
+
+    Returns the server, call its ``shutdown()`` to stop. Use port 0 for a free port, see
+    ``server.server_port``.
+    """
+    registry = registry if registry is not None else REGISTRY
+
+    class _Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = registry.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", _CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((addr, port), _Handler)
+    thread = threading.Thread(target=server.serve_forever, name="ray-yarn-metrics", daemon=True)
+    thread.start()
+    return server
@@ -0,0 +1,101 @@
+"""Container shapes for a target total of worker resources.
+
+YARN rounds each container request up to a multiple of the scheduler's minimum allocation, like
+``yarn.scheduler.minimum-allocation-mb``, and places whole containers on NodeManagers. A shape
+is good when little is added by rounding and containers fill nodes without leftovers.
+
+>>> from ray_yarn import planner
+>>> from skein.model import Resources
+>>> nodes = [Resources(memory=256 * 1024, vcores=64)] * 20
+>>> planner.plan(400, 1600 * 1024, nodes)[0]
+Plan(vcores=16, memory=65536, count=25, waste=0.0, fragmentation=0.0)
+"""
+import math
+from collections import Counter, namedtuple
+
+Plan = namedtuple("Plan", ["vcores", "memory", "count", "waste", "fragmentation"])
+Plan.__doc__ = """``count`` containers of ``vcores`` and ``memory`` (MiB).
+
+``waste`` is the fraction of allocated resources above the target, and ``fragmentation`` the
+fraction of node resources left over once nodes are filled with containers, both averaged over
+vcores and memory.
+"""
+
+_DEFAULT_MEMORY_INCREMENT = 1024
+_DEFAULT_VCORES_INCREMENT = 1
+
+
+def _round_up(value, increment):
+    return int(math.ceil(value / float(increment))) * increment
+
+
+def _round_down(value, increment):
+    return int(value // increment) * increment
+
+
+def _fragmentation(vcores, memory, sizes):
+    """Fraction of node resources left over when nodes are filled with containers, None if it fits no node.
+
+    ``sizes`` counts nodes by (vcores, memory).
+    """
+    left, nodes = 0.0, 0
+    for (node_vcores, node_memory), n in sizes.items():
+        k = min(node_vcores // vcores, node_memory // memory)
+        if k:
+            left += n * ((node_vcores - k * vcores) / float(node_vcores)
+                         + (node_memory - k * memory) / float(node_memory)) / 2
+            nodes += n
+    return left / nodes if nodes else None
+
+
+def _evaluate(vcores, memory, total_vcores, total_memory, sizes):
+    fragmentation = _fragmentation(vcores, memory, sizes)
+    if fragmentation is None:
+        return None
+    count = int(math.ceil(max(total_vcores / float(vcores), total_memory / float(memory))))
+    waste = ((count * vcores - total_vcores) / float(count * vcores)
+             + (count * memory - total_memory) / float(count * memory)) / 2
+    return Plan(vcores, memory, count, round(waste, 4), round(fragmentation, 4))
+
+
+def plan(total_vcores, total_memory, nodes, memory_increment=None, vcores_increment=None):
+    """Container shapes for total vcores and memory (MiB), best first.
+
+    Parameters
+    ----------
+    total_vcores : int
+        Target vcores of all containers.
+    total_memory : int
+        Target memory of all containers in MiB.
+    nodes : List[skein.model.Resources]
+        Resources of NodeManagers, like ``total_resources`` of ``skein.Client.get_nodes()``.
+    memory_increment, vcores_increment : int, optional
+        Allocation increments of the scheduler, 1024 MiB and 1 vcore by default.
+
+    Returns
+    -------
+    List of ``Plan``, by waste plus fragmentation, then by fewer containers.
+    """
+    if total_vcores <= 0 or total_memory <= 0:
+        raise ValueError("target resources should be positive, got %s vcores and %s MiB"
+                         % (total_vcores, total_memory))
+    memory_increment = memory_increment or _DEFAULT_MEMORY_INCREMENT
+    vcores_increment = vcores_increment or _DEFAULT_VCORES_INCREMENT
+    sizes = Counter((n.vcores, n.memory) for n in nodes if n.vcores > 0 and n.memory > 0)
+    if not sizes:
+        raise ValueError("no NodeManager to place containers on")
+    ratio = total_memory / float(total_vcores)
+    plans = {}
+    for vcores in range(vcores_increment, max(v for v, _ in sizes) + 1, vcores_increment):
+        # memory in proportion to the target, and memory filling nodes with as many containers
+        candidates = {max(_round_up(ratio * vcores, memory_increment), memory_increment)}
+        for node_vcores, node_memory in sizes:
+            per_node = node_vcores // vcores
+            if per_node:
+                candidates.add(_round_down(node_memory / per_node, memory_increment))
+        for memory in candidates:
+            if memory > 0:
+                p = _evaluate(vcores, memory, total_vcores, total_memory, sizes)
+                if p is not None:
+                    plans[(vcores, memory)] = p
+    return sorted(plans.values(), key=lambda p: (p.waste + p.fragmentation, p.count))
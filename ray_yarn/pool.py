@@ -0,0 +1,355 @@
+"""Pool of pre-started ray clusters on YARN leased to short jobs.
+
+``ClusterPool`` keeps a number of idle ``YarnCluster`` of each configured shape running. A lease
+hands out an idle cluster at once, and release resets it and puts it back into the pool, so jobs
+skip application submission and container allocation. Clusters are retired after
+``max_leases`` leases or when idle for ``max_idle_time`` seconds, and replaced by new ones.
+
+The pool runs as a daemon with ``ray-yarn pool`` and serves leases over HTTP to ``PoolClient``.
+
+>>> from ray_yarn.pool import PoolClient
+>>> with PoolClient("http://pool-host:8787").leased("small") as lease:
+...     ray.init(address=lease.address)
+"""
+import collections
+import contextlib
+import json
+import threading
+import time
+import uuid
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from inspect import signature
+from typing import Dict, List
+from urllib import request as urllib_request
+from urllib.error import HTTPError
+
+from . import idle as ray_idle
+from .core import YarnCluster, RayRuntimeConfig, RayYarnError, _DRAIN_PREFIX, _DRAINING_PREFIX, _RAY_HEAD_ADDRESS, \
+    _get_or_wait_kv
+
+_DEFAULT_MAX_LEASES = 10
+_DEFAULT_MAX_IDLE_TIME = 3600
+_DEFAULT_LEASE_TIMEOUT = 60
+_MAINTAIN_INTERVAL = 5
+# concurrent cluster starts, resets and shutdowns
+_MAX_STARTING = 8
+# seconds a returned cluster has to become idle, like for drivers of the lease to disconnect, before it's retired
+_DEFAULT_RESET_TIMEOUT = 30
+_RESET_POLL_INTERVAL = 0.5
+
+Shape = collections.namedtuple("Shape", ["name", "idle", "workers", "options"])
+Shape.__doc__ = """Shape of pooled clusters: number of idle ones to keep, workers of each and
+``YarnCluster`` keyword arguments in ``options``"""
+
+Lease = collections.namedtuple("Lease", ["lease_id", "shape", "app_id", "address"])
+Lease.__doc__ = """A leased cluster. ``address`` is its ray client address, ``ray://<ip>:<port>``"""
+
+
+def shapes_from_config(pool_configs) -> List[Shape]:
+    """Shapes from ``pool`` section of ``yarn.yaml``
+
+    Each shape takes ``idle`` and ``workers``, ``YarnCluster`` arguments like ``queue``, and
+    ``RayRuntimeConfig`` arguments like ``num_cpus``.
+    """
+    cluster_args = set(signature(YarnCluster.__init__).parameters)
+    runtime_args = set(signature(RayRuntimeConfig.__init__).parameters)
+    shapes = []
+    for name, values in (pool_configs or {}).get("shapes", {}).items():
+        values = dict(values)
+        idle = values.pop("idle", 1)
+        workers = values.pop("workers", 0)
+        options = {k: values.pop(k) for k in list(values) if k in cluster_args}
+        runtime = {k: values.pop(k) for k in list(values) if k in runtime_args}
+        if values:
+            raise ValueError("unknown options of pool shape %s: %s" % (name, ", ".join(sorted(values))))
+        options["ray_runtime_cfg"] = RayRuntimeConfig(**runtime)
+        options.setdefault("name", "ray-pool-" + name)
+        shapes.append(Shape(name, idle, workers, options))
+    return shapes
+
+
+class _PooledCluster(object):
+    def __init__(self, cluster, shape, address, now):
+        self.cluster = cluster
+        self.shape = shape
+        self.address = address
+        self.leases = 0
+        self.idle_since = now
+        self.lease_id = None
+
+
+def _gcs_activity(cluster):
+    """``idle.gcs_activity`` of the cluster's head, read again in case it restarted"""
+    return ray_idle.gcs_activity(_get_or_wait_kv(cluster.application_client, _RAY_HEAD_ADDRESS, 30).decode())
+
+
+def _reset(pooled, activity, timeout):
+    """Bring cluster back to its shape after a lease.
+
+    Waits up to ``timeout`` seconds for ray to be idle: no running jobs, no alive actors, detached
+    and named ones included, and no resources in use, which placement groups reserve. Raises
+    RayYarnError if the lease left any of them, so that the next lessee doesn't inherit it. Then
+    workers added during the lease are removed and failed ones replaced. Raises
+    ``skein.ApplicationNotRunningError`` if the application is gone.
+    """
+    current = activity()
+    deadline = time.monotonic() + timeout
+    while not ray_idle._is_idle(current):
+        if time.monotonic() >= deadline:
+            raise RayYarnError("ray still in use after lease, %s" % ray_idle._describe(current))
+        time.sleep(_RESET_POLL_INTERVAL)
+        current = activity()
+    pooled.cluster.resize(pooled.shape.workers)
+    app_client = pooled.cluster.application_client
+    for prefix in [_DRAIN_PREFIX, _DRAINING_PREFIX]:
+        for key in app_client.kv.get_prefix(prefix):
+            del app_client.kv[key]
+
+
+class ClusterPool(object):
+    """Keep idle clusters of given shapes running and lease them.
+
+    Parameters
+    ----------
+    shapes : List[Shape]
+        Shapes of clusters to keep.
+    max_leases : int, optional
+        Retire a cluster after this many leases.
+    max_idle_time : float, optional
+        Retire a cluster idle for this many seconds.
+    cluster_factory : callable, optional
+        Creates a cluster of given shape, for tests. Defaults to ``YarnCluster(**shape.options)``.
+    activity : callable, optional
+        Takes a cluster and returns a callable returning ``idle.Activity`` of its ray, for tests.
+        Defaults to reading GCS tables of its head.
+    reset_timeout : float, optional
+        Seconds a released cluster has to become idle before it's retired instead of reused.
+    """
+
+    def __init__(self, shapes: List[Shape], max_leases=_DEFAULT_MAX_LEASES, max_idle_time=_DEFAULT_MAX_IDLE_TIME,
+                 cluster_factory=None, clock=time, activity=None, reset_timeout=_DEFAULT_RESET_TIMEOUT):
+        self.shapes = {s.name: s for s in shapes}
+        self.max_leases = max_leases
+        self.max_idle_time = max_idle_time
+        self._factory = cluster_factory or (lambda shape: YarnCluster(**shape.options))
+        self._activity = activity or _gcs_activity
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        self._cond = threading.Condition()
+        self._idle = {name: collections.deque() for name in self.shapes}
+        self._starting = collections.Counter()
+        self._leased = {}
+        self._executor = ThreadPoolExecutor(max_workers=_MAX_STARTING, thread_name_prefix="ray-yarn-pool")
+        self._stopped = threading.Event()
+        self.retired = 0
+
+    def _start(self, shape):
+        try:
+            cluster = self._factory(shape)
+        except Exception as e:
+            warnings.warn("failed to start cluster of shape %s: %s" % (shape.name, e))
+            with self._cond:
+                self._starting[shape.name] -= 1
+            return
+        try:
+            if shape.workers:
+                cluster.scale(shape.workers)
+            address = cluster.get_client_address()
+        except Exception as e:
+            warnings.warn("failed to start cluster %s: %s" % (cluster, e))
+            cluster.shutdown(status="FAILED", diagnostics=str(e))
+            with self._cond:
+                self._starting[shape.name] -= 1
+            return
+        with self._cond:
+            self._starting[shape.name] -= 1
+            stopped = self._stopped.is_set()
+            if not stopped:
+                self._idle[shape.name].append(_PooledCluster(cluster, shape, address, self._clock.time()))
+                self._cond.notify_all()
+        if stopped:
+            cluster.shutdown()
+
+    def _retire(self, pooled):
+        self.retired += 1
+        if self._stopped.is_set():
+            pooled.cluster.shutdown()
+        else:
+            self._executor.submit(pooled.cluster.shutdown)
+
+    def maintain(self):
+        """Retire clusters idle for too long or beyond the idle ones to keep of each shape, and start missing ones"""
+        with self._cond:
+            now = self._clock.time()
+            for name, idle in self._idle.items():
+                for pooled in [p for p in idle if now - p.idle_since > self.max_idle_time]:
+                    idle.remove(pooled)
+                    self._retire(pooled)
+                # most leased ones first, they're retired soonest anyway
+                for pooled in sorted(idle, key=lambda p: -p.leases)[:max(len(idle) - self.shapes[name].idle, 0)]:
+                    idle.remove(pooled)
+                    self._retire(pooled)
+                missing = self.shapes[name].idle - len(idle) - self._starting[name]
+                for _ in range(max(missing, 0)):
+                    self._starting[name] += 1
+                    self._executor.submit(self._start, self.shapes[name])
+
+    def start(self, interval=_MAINTAIN_INTERVAL):
+        """Fill the pool and keep maintaining it in a background thread"""
+        def loop():
+            while True:
+                self.maintain()
+                if self._stopped.wait(interval):
+                    return
+        threading.Thread(target=loop, name="ray-yarn-pool-maintain", daemon=True).start()
+
+    def lease(self, shape, timeout=_DEFAULT_LEASE_TIMEOUT) -> Lease:
+        """Lease an idle cluster of shape, waiting up to ``timeout`` seconds for one to start"""
+        if shape not in self.shapes:
+            raise KeyError("unknown shape %s" % shape)
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._idle[shape] or self._stopped.is_set(), timeout):
+                raise TimeoutError("no idle cluster of shape %s within %s seconds" % (shape, timeout))
+            if self._stopped.is_set():
+                raise RayYarnError("pool is shut down")
+            pooled = self._idle[shape].popleft()
+            pooled.lease_id = uuid.uuid4().hex
+            pooled.leases += 1
+            self._leased[pooled.lease_id] = pooled
+        # start a replacement of the leased one in the background
+        self._executor.submit(self.maintain)
+        return Lease(pooled.lease_id, shape, pooled.cluster.app_id, pooled.address)
+
+    def _return(self, pooled):
+        try:
+            reusable = pooled.leases < self.max_leases
+            if reusable:
+                _reset(pooled, self._activity(pooled.cluster), self.reset_timeout)
+        except Exception as e:
+            warnings.warn("failed to reset cluster %s, retiring it: %s" % (pooled.cluster, e))
+            reusable = False
+        with self._cond:
+            # a replacement was started at lease, retire the returned one if the pool is full again, or will be
+            # once clusters starting are up
+            name = pooled.shape.name
+            full = len(self._idle[name]) + self._starting[name] >= self.shapes[name].idle
+            if not reusable or full or self._stopped.is_set():
+                self._retire(pooled)
+                return
+            pooled.lease_id = None
+            pooled.idle_since = self._clock.time()
+            self._idle[pooled.shape.name].append(pooled)
+            self._cond.notify_all()
+
+    def release(self, lease_id):
+        """Return leased cluster. It's reset and put back into the pool in the background."""
+        with self._cond:
+            pooled = self._leased.pop(lease_id, None)
+        if pooled is None:
+            raise KeyError("unknown lease %s" % lease_id)
+        self._executor.submit(self._return, pooled)
+
+    def status(self) -> Dict[str, Dict[str, int]]:
+        """Number of idle, starting and leased clusters by shape"""
+        with self._cond:
+            leased = collections.Counter(p.shape.name for p in self._leased.values())
+            return {name: {"idle": len(self._idle[name]), "starting": self._starting[name], "leased": leased[name]}
+                    for name in self.shapes}
+
+    def shutdown(self, wait=True):
+        """Stop maintaining and shut all clusters down, leased ones included"""
+        with self._cond:
+            self._stopped.set()
+            pooled = [p for idle in self._idle.values() for p in idle] + list(self._leased.values())
+            for idle in self._idle.values():
+                idle.clear()
+            self._leased.clear()
+            self._cond.notify_all()
+        for p in pooled:
+            self._executor.submit(p.cluster.shutdown)
+        self._executor.shutdown(wait=wait)
+
+
+def serve(pool, port, addr=""):
+    """Serve leases of pool over HTTP in a daemon thread, returns the server.
+
+    ``POST /lease`` with ``{"shape": ..., "timeout": ...}``, ``POST /release`` with
+    ``{"lease_id": ...}`` and ``GET /status``.
+    """
+    class _Handler(BaseHTTPRequestHandler):
+        def _reply(self, code, body):
+            data = json.dumps(body).encode()
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == "/status":
+                self._reply(200, pool.status())
+            else:
+                self._reply(404, {"error": "not found"})
+
+        def do_POST(self):
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                if self.path == "/lease":
+                    lease = pool.lease(body["shape"], body.get("timeout", _DEFAULT_LEASE_TIMEOUT))
+                    self._reply(200, lease._asdict())
+                elif self.path == "/release":
+                    pool.release(body["lease_id"])
+                    self._reply(200, {})
+                else:
+                    self._reply(404, {"error": "not found"})
+            except KeyError as e:
+                self._reply(404, {"error": str(e)})
+            except TimeoutError as e:
+                self._reply(504, {"error": str(e)})
+            except Exception as e:
+                self._reply(500, {"error": str(e)})
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((addr, port), _Handler)
+    threading.Thread(target=server.serve_forever, name="ray-yarn-pool-server", daemon=True).start()
+    return server
+
+
+class PoolClient(object):
+    """Client of ``ray-yarn pool`` daemon at ``address``, like ``http://pool-host:8787``"""
+
+    def __init__(self, address):
+        self.address = address.rstrip("/")
+
+    def _call(self, path, body=None, timeout=None):
+        data = json.dumps(body).encode() if body is not None else None
+        req = urllib_request.Request(self.address + path, data=data,
+                                     headers={"Content-Type": "application/json"})
+        try:
+            with urllib_request.urlopen(req, timeout=timeout) as resp:
+                return json.loads(resp.read())
+        except HTTPError as e:
+            raise RayYarnError("pool request %s failed: %s" % (path, json.loads(e.read()).get("error")))
+
+    def lease(self, shape, timeout=_DEFAULT_LEASE_TIMEOUT) -> Lease:
+        return Lease(**self._call("/lease", {"shape": shape, "timeout": timeout}, timeout + 10))
+
+    def release(self, lease):
+        """Release a ``Lease`` or lease id"""
+        self._call("/release", {"lease_id": getattr(lease, "lease_id", lease)})
+
+    def status(self):
+        return self._call("/status")
+
+    @contextlib.contextmanager
+    def leased(self, shape, timeout=_DEFAULT_LEASE_TIMEOUT):
+        """Lease a cluster for the ``with`` block"""
+        lease = self.lease(shape, timeout)
+        try:
+            yield lease
+        finally:
+            self.release(lease)
@@ -0,0 +1,189 @@
+"""Typed schema of configurations, checked before anything is submitted.
+
+Options of ``RayRuntimeConfig`` are typed by its constructor signature. Memory sizes are parsed
+by ``config.parse_memory``, ports are checked for range, and string and dict values for what
+``core._append_args`` can't quote in container scripts. Otherwise ``ray start`` rejects them
+once containers are up, minutes after submission.
+
+>>> from ray_yarn import schema
+>>> schema.validate({"num_cpus": "four", "worker": {"memory": "2GB", "min_worker_port": 70000}})
+['num_cpus: expected int, got str four', 'worker.min_worker_port: expected port in 0-65535, got 70000']
+"""
+import json
+import re
+import typing
+from collections import OrderedDict
+from functools import lru_cache
+
+from .capacity import CAPACITY_CHECKS
+from .config import ConfigError, CONFIG_NAME_HEAD, CONFIG_NAME_WORKER, parse_memory
+
+_NUMBER = (int, float)
+_MEMORY_OPTIONS = ("memory", "object_store_memory", "redis_max_memory")
+_PORT_OPTIONS = ("port", "dashboard_port", "object_manager_port", "node_manager_port", "gcs_server_port",
+                 "min_worker_port", "max_worker_port")
+_PORT_LIST_OPTIONS = ("worker_port_list", "redis_shard_ports")
+_MAX_PORT = 65535
+# interpreted by shell in values which are not quoted, those without spaces
+_SHELL_CHARS = re.compile(r"[$`\"\\;&|<>*?!(){}\[\]#~]")
+
+# options of yarn section other than ray runtime ones
+YARN_OPTIONS = {
+    "specification": (str, dict),
+    "name": str,
+    "queue": str,
+    "queues": list,
+    "capacity_check": str,
+    "environment": str,
+    "environment_cache": str,
+    "scale_interval": _NUMBER,
+    "activate_environment": bool,
+    "spill_dir": str,
+    "working_dir": str,
+    "py_modules": list,
+    "usage_interval": _NUMBER,
+    "idle_timeout": _NUMBER,
+    "idle_shutdown_timeout": _NUMBER,
+    "memory_increment": int,
+    "vcores_increment": int,
+    "tags": list,
+    "user": str,
+    "node_ip_interface": str,
+    "node_ip_cidr": str,
+    "head": dict,
+    "worker": dict,
+    "driver": dict,
+    "pool": dict,
+}
+HEAD_OPTIONS = {"gcs_redis_address": str}
+DRIVER_OPTIONS = {"num_cpus": int, "memory": (int, str)}
+
+
+def _unwrap(annotation):
+    """Python type of annotation, like int of Optional[int] and dict of Dict[str, float]"""
+    args = [a for a in getattr(annotation, "__args__", None) or () if a is not type(None)]
+    if getattr(annotation, "__origin__", None) is typing.Union and len(args) == 1:
+        return _unwrap(args[0])
+    origin = getattr(annotation, "__origin__", None)
+    return origin if isinstance(origin, type) else annotation
+
+
+@lru_cache()
+def runtime_schema(cls):
+    """Option names of runtime config class by their type, from its constructor signature"""
+    hints = typing.get_type_hints(cls.__init__)
+    return OrderedDict((name, _unwrap(t)) for name, t in hints.items() if name != "return")
+
+
+def _runtime_class():
+    from .core import RayRuntimeConfig
+    return RayRuntimeConfig
+
+
+def _check_quoting(value):
+    if "'" in value or "\n" in value:
+        return "can't be quoted in container script, it has a single quote or newline"
+    if " " not in value and _SHELL_CHARS.search(value):
+        return "has shell characters but no space, it isn't quoted in container script"
+    return None
+
+
+def _check_port(value):
+    if isinstance(value, bool) or not isinstance(value, int) or not 0 <= value <= _MAX_PORT:
+        return "expected port in 0-%d, got %s" % (_MAX_PORT, value)
+    return None
+
+
+def _check_value(name, value, expected, quoted):
+    """Problem of value against expected type or types, None if fine.
+
+    Values which are ``quoted`` are checked for quoting in container scripts.
+    """
+    if name in _MEMORY_OPTIONS and isinstance(value, (str, int, float)) and not isinstance(value, bool):
+        try:
+            size = parse_memory(value)
+        except (ValueError, KeyError, IndexError):
+            return "bad memory size %s, expected a number with unit like 4GiB" % value
+        return None if size > 0 else "memory size should be positive, got %s" % value
+    if name in _PORT_OPTIONS:
+        return _check_port(value)
+    if name in _PORT_LIST_OPTIONS:
+        ports = [p.strip() for p in str(value).split(",")]
+        if not all(p.isdigit() and 0 < int(p) <= _MAX_PORT for p in ports):
+            return "expected comma-separated ports, got %s" % value
+        return None
+    types = expected if isinstance(expected, tuple) else (expected,)
+    if float in types:
+        types += (int,)
+    if isinstance(value, bool) and bool not in types:
+        return "expected %s, got bool %s" % (" or ".join(t.__name__ for t in types), value)
+    if not isinstance(value, types):
+        return "expected %s, got %s %s" % (" or ".join(t.__name__ for t in types), type(value).__name__, value)
+    if quoted and isinstance(value, str):
+        return _check_quoting(value)
+    if quoted and isinstance(value, dict):
+        return _check_quoting(json.dumps(value))
+    return None
+
+
+def _check_options(values, options, prefix, problems, quoted=()):
+    for name, value in values.items():
+        if name not in options:
+            problems.append("%s%s: unknown option" % (prefix, name))
+        elif value is not None:
+            problem = _check_value(name, value, options[name], name in quoted)
+            if problem:
+                problems.append("%s%s: %s" % (prefix, name, problem))
+
+
+def _check_runtime_values(values, prefix, problems):
+    """Checks across ray runtime options, of values which have the right types"""
+    resources = values.get("resources")
+    if isinstance(resources, dict):
+        for name, quantity in resources.items():
+            if isinstance(quantity, bool) or not isinstance(quantity, _NUMBER):
+                problems.append("%sresources.%s: expected number, got %s" % (prefix, name, quantity))
+    low, high = values.get("min_worker_port"), values.get("max_worker_port")
+    if not (low is None or high is None or _check_port(low) or _check_port(high)) and low > high:
+        problems.append("%smin_worker_port: %d is above max_worker_port %d" % (prefix, low, high))
+
+
+def validate_runtime(values, prefix=""):
+    """Problems of ray runtime option values, a dict by option name"""
+    problems = []
+    schema = runtime_schema(_runtime_class())
+    _check_options(values, schema, prefix, problems, schema)
+    _check_runtime_values(values, prefix, problems)
+    return problems
+
+
+def validate(yarn_configs):
+    """Problems of ``yarn`` section of ``yarn.yaml``, with hyphens in names replaced by underscores.
+
+    Unknown options and values of wrong type are reported where they're set, checks across
+    options are done for merged head and worker configurations.
+    """
+    problems = []
+    schema = runtime_schema(_runtime_class())
+    _check_options(yarn_configs, dict(schema, **YARN_OPTIONS), "", problems, schema)
+    if yarn_configs.get("capacity_check") and yarn_configs["capacity_check"] not in CAPACITY_CHECKS:
+        problems.append("capacity_check: expected one of %s, got %s" % (", ".join(CAPACITY_CHECKS),
+                                                                        yarn_configs["capacity_check"]))
+    for section, options in [(CONFIG_NAME_HEAD, dict(schema, **HEAD_OPTIONS)), (CONFIG_NAME_WORKER, schema),
+                             ("driver", DRIVER_OPTIONS)]:
+        values = yarn_configs.get(section)
+        if isinstance(values, dict):
+            _check_options(values, options, section + ".", problems, schema)
+    for section in [CONFIG_NAME_HEAD, CONFIG_NAME_WORKER]:
+        merged = {k: v for k, v in yarn_configs.items() if k in schema}
+        values = yarn_configs.get(section)
+        merged.update({k: v for k, v in values.items() if k in schema} if isinstance(values, dict) else {})
+        _check_runtime_values(merged, section + ".", problems)
+    return problems
+
+
+def check_runtime(head_cfg, worker_cfg):
+    """Raise ``ConfigError`` with all problems of head and worker ``RayRuntimeConfig``"""
+    problems = validate_runtime(vars(head_cfg), "head.") + validate_runtime(vars(worker_cfg), "worker.")
+    if problems:
+        raise ConfigError("invalid ray runtime configuration:\n  " + "\n  ".join(problems))
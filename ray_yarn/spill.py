@@ -0,0 +1,72 @@
+"""Spilling of ray objects to a per-application directory on the cluster filesystem, like HDFS.
+
+Ray nodes are started with ``<spill-dir>/<app_id>`` as ray storage and spill through ray's
+``ray_storage`` external storage. Each spill fuses objects into one file written sequentially
+through a large buffer, and an object is restored by reading its byte range of the file, from
+any node. Spills wait until enough bytes are pending to make large files.
+
+The directory can be anything ``pyarrow.fs`` opens, ``file://`` works as a local stand-in. pyarrow is
+needed on the client and in the environment of nodes.
+"""
+import json
+import os
+import subprocess
+
+# bytes buffered before writing to the filesystem
+_BUFFER_SIZE = 8 * 2 ** 20
+# bytes of objects fused into one spilled file, unless fewer objects are spillable
+_MIN_SPILLING_SIZE = 256 * 2 ** 20
+_HADOOP_SCHEMES = ("hdfs://", "viewfs://")
+
+
+def storage_uri(spill_dir, app_id):
+    """Spill directory of the application"""
+    return "%s/%s" % (spill_dir.rstrip('/'), app_id)
+
+
+def _set_hadoop_classpath():
+    """libhdfs needs hadoop jars in CLASSPATH, which YARN containers don't have by default"""
+    if ".jar" in os.environ.get("CLASSPATH", ""):
+        return
+    try:
+        classpath = subprocess.check_output(["hadoop", "classpath", "--glob"], universal_newlines=True)
+    except (OSError, subprocess.CalledProcessError):
+        return
+    os.environ["CLASSPATH"] = classpath.strip()
+
+
+def filesystem(uri):
+    """``pyarrow.fs`` filesystem and path of uri"""
+    import pyarrow.fs
+    if uri.startswith(_HADOOP_SCHEMES):
+        _set_hadoop_classpath()
+    return pyarrow.fs.FileSystem.from_uri(uri)
+
+
+def configure(is_head, kwargs, system_config, spill_dir, app_id):
+    """Set ray start options to spill objects to the application's directory in spill_dir.
+
+    Options already set by user are kept untouched. Spilling config is cluster-wide and set on
+    head only, storage is set on every node.
+    """
+    if not spill_dir:
+        return
+    uri = storage_uri(spill_dir, app_id)
+    if uri.startswith(_HADOOP_SCHEMES):
+        # inherited by ray processes
+        _set_hadoop_classpath()
+    kwargs.setdefault("storage", uri)
+    if is_head and "object_spilling_config" not in system_config:
+        system_config["object_spilling_config"] = json.dumps(
+            {"type": "ray_storage", "params": {"buffer_size": _BUFFER_SIZE}})
+        system_config.setdefault("min_spilling_size", _MIN_SPILLING_SIZE)
+
+
+def remove(spill_dir, app_id):
+    """Remove spilled objects of the application, returns whether the directory existed"""
+    import pyarrow.fs
+    fs, path = filesystem(storage_uri(spill_dir, app_id))
+    if fs.get_file_info(path).type == pyarrow.fs.FileType.NotFound:
+        return False
+    fs.delete_dir(path)
+    return True
@@ -0,0 +1,545 @@
+"""In-memory stand-ins of skein clients for tests and benchmarks.
+
+``FakeSkeinClient`` implements the ``skein.Client`` and ``skein.ApplicationClient`` calls used by
+``YarnCluster`` without YARN. RPC latencies are configurable and spent with ``clock.sleep``.
+Containers are allocated ``allocation_latency`` seconds after they are requested, and publish
+their ray node to kv as they run, like once it registered with GCS. The head publishes its
+address ``head_address_latency`` seconds after it runs.
+
+``SimulatedYarn`` is a discrete-event simulation on top of it, with queue capacity, allocation
+delays, container failures and preemption on simulated time.
+"""
+import collections
+import contextlib
+import functools
+import heapq
+import itertools
+import random
+import time
+from datetime import datetime
+from queue import Empty
+
+import skein
+from skein.model import Container, ContainerState, ApplicationReport, ApplicationState, FinalStatus, \
+    ResourceUsageReport, Resources, NodeReport, Queue
+
+from . import topology
+from .core import _RAY_HEAD_ADDRESS, _RAY_CLIENT_ADDRESS, _HEAD_SERVICE
+
+_HEAD_PORT = 6379
+_CLIENT_SERVER_PORT = 10001
+
+
+def _head_kv(container):
+    """Addresses a head container publishes. Each restarted head gets next ports, like newly allocated ones."""
+    return {_RAY_HEAD_ADDRESS: ("127.0.0.1:%d" % (_HEAD_PORT + container.instance)).encode(),
+            _RAY_CLIENT_ADDRESS: ("127.0.0.1:%d" % (_CLIENT_SERVER_PORT + container.instance)).encode()}
+
+
+def _node_kv(container):
+    """Key and value of ``topology.NodeInfo`` a container publishes once its ray node registered with GCS"""
+    info = topology.NodeInfo(container.id, "node-" + container.id, container.host, "127.0.0.1", {})
+    return topology._NODES_PREFIX + container.id, topology._dump(info)
+
+
+_ACTIVE_STATES = (ContainerState.WAITING, ContainerState.REQUESTED, ContainerState.RUNNING)
+
+
+class FakeKeyValueStore(dict):
+    """Application kv. Each ``get`` costs ``latency`` seconds, keys may be set to appear later."""
+
+    def __init__(self, clock, latency=0):
+        super(FakeKeyValueStore, self).__init__()
+        self._clock = clock
+        self._latency = latency
+        self._delayed = {}
+        self._subscribers = []
+
+    def _notify(self, key, event_type, value=None):
+        for k, prefix, types, queue in self._subscribers:
+            if (k is None or k == key) and (prefix is None or key.startswith(prefix)) and event_type in types:
+                result = skein.kv.ValueOwnerPair(value, None) if value is not None else None
+                queue.append(skein.kv.Event(key, result, skein.kv.EventType(event_type),
+                                            skein.kv.EventFilter(key=k, prefix=prefix, event_type=event_type)))
+
+    def __setitem__(self, key, value):
+        super(FakeKeyValueStore, self).__setitem__(key, value)
+        self._notify(key, "PUT", value)
+
+    def __delitem__(self, key):
+        super(FakeKeyValueStore, self).__delitem__(key)
+        self._notify(key, "DELETE")
+
+    def set_later(self, key, value, at):
+        self._delayed[key] = (value, at)
+
+    def _flush(self):
+        now = self._clock.time()
+        for key, (value, at) in list(self._delayed.items()):
+            if at <= now:
+                self[key] = value
+                del self._delayed[key]
+
+    def get(self, key, default=None):
+        if self._latency:
+            self._clock.sleep(self._latency)
+        self._flush()
+        return super(FakeKeyValueStore, self).get(key, default)
+
+    def get_prefix(self, prefix):
+        if self._latency:
+            self._clock.sleep(self._latency)
+        self._flush()
+        return {k: v for k, v in self.items() if k.startswith(prefix)}
+
+    def discard(self, key):
+        if key not in self:
+            return False
+        del self[key]
+        return True
+
+    def wait(self, key, poll_interval=0.1):
+        value = self.get(key)
+        while value is None:
+            self._clock.sleep(poll_interval)
+            value = self.get(key)
+        return value
+
+    def events(self, key=None, prefix=None, event_type=None, poll_interval=0.1):
+        """``_FakeEventQueue`` of ``skein.kv.Event`` for changes of ``key``, keys with ``prefix``, or all keys"""
+        types = ("PUT", "DELETE") if event_type in (None, "ALL") else (str(event_type),)
+        queue = collections.deque()
+        subscriber = (key, prefix, types, queue)
+        self._subscribers.append(subscriber)
+        return _FakeEventQueue(self, subscriber, poll_interval)
+
+
+class _FakeEventQueue(object):
+    """Like ``skein.kv.EventQueue``, polled every ``poll_interval`` seconds of kv's clock"""
+
+    def __init__(self, kv, subscriber, poll_interval):
+        self._kv = kv
+        self._subscriber = subscriber
+        self._poll_interval = poll_interval
+
+    def get(self, block=True, timeout=None):
+        queue = self._subscriber[-1]
+        deadline = None if timeout is None else self._kv._clock.time() + timeout
+        while True:
+            self._kv._flush()
+            if queue:
+                return queue.popleft()
+            if not block or (deadline is not None and self._kv._clock.time() >= deadline):
+                raise Empty()
+            self._kv._clock.sleep(self._poll_interval)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self.get()
+
+    def unsubscribe_all(self):
+        self._kv._subscribers = [s for s in self._kv._subscribers if s is not self._subscriber]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.unsubscribe_all()
+
+
+class _FakeContainer(object):
+    def __init__(self, service, instance, requested_at, ready_at, host):
+        self.service_name = service
+        self.instance = instance
+        self.requested_at = requested_at
+        self.ready_at = ready_at
+        self.host = host
+        self.allocated = False
+        self.final_state = None
+        self.exit_message = ""
+        self.env = {}
+
+    @property
+    def id(self):
+        return "%s_%d" % (self.service_name, self.instance)
+
+    def state(self, now):
+        if self.final_state is not None:
+            return self.final_state
+        return ContainerState.RUNNING if now >= self.ready_at else ContainerState.REQUESTED
+
+    def to_container(self, now):
+        state = self.state(now)
+        return Container(self.service_name, self.instance, state,
+                         "container_%s_%06d" % (self.service_name.replace('.', '_'), self.instance),
+                         "%s:8042" % self.host, None, None, self.exit_message)
+
+
+class FakeApplicationClient(object):
+    def __init__(self, app_id, spec, client):
+        self.id = app_id
+        self.spec = spec
+        self._client = client
+        self._clock = client.clock
+        self.kv = FakeKeyValueStore(self._clock, client.kv_latency)
+        self._containers = []
+        self._instances = {}
+        self.start_time = self._clock.time()
+        self.finish_time = None
+        self.finished = False
+        self.final_status = None
+        self.diagnostics = None
+        self.restarts = {}
+        for name, service in spec.services.items():
+            self._add(name, service.instances)
+
+    def _add(self, service, n):
+        now = self._clock.time()
+        added = []
+        for _ in range(n):
+            instance = self._instances.get(service, 0)
+            self._instances[service] = instance + 1
+            host = self._client.hosts[(len(self._containers)) % len(self._client.hosts)]
+            c = _FakeContainer(service, instance, now, float("inf"), host)
+            self._containers.append(c)
+            added.append(c)
+            self._client._request_container(self, c)
+        return added
+
+    def _rpc(self):
+        if self.finished:
+            raise skein.ApplicationNotRunningError("application %s is not running" % self.id)
+        if self._client.rpc_latency:
+            self._clock.sleep(self._client.rpc_latency)
+
+    def scale(self, service, count=None, delta=None):
+        self._rpc()
+        now = self._clock.time()
+        active = [c for c in self._containers if c.service_name == service and c.state(now) in _ACTIVE_STATES]
+        target = count if count is not None else max(len(active) + delta, 0)
+        if target > len(active):
+            changed = self._add(service, target - len(active))
+        else:
+            changed = active[target:]
+            for c in changed:
+                c.final_state = ContainerState.KILLED
+                self._client._release_container(self, c)
+        return [c.to_container(now) for c in changed]
+
+    def add_container(self, service, env=None):
+        self._rpc()
+        c = self._add(service, 1)[0]
+        c.env = dict(env or {})
+        return c.to_container(self._clock.time())
+
+    def kill_container(self, id):
+        self._rpc()
+        for c in self._containers:
+            if c.id == id:
+                c.final_state = ContainerState.KILLED
+                self._client._release_container(self, c)
+                return
+        raise ValueError("no such container, " + id)
+
+    def get_containers(self, services=None, states=None):
+        self._rpc()
+        now = self._clock.time()
+        states = set(states) if states is not None else set(_ACTIVE_STATES)
+        return [c.to_container(now) for c in self._containers
+                if (services is None or c.service_name in services) and c.state(now) in states]
+
+    def fail_container(self, id, exit_message="failed"):
+        """Fail a container, then restart it or fail application per service's ``max_restarts``"""
+        c = next(c for c in self._containers if c.id == id)
+        c.final_state = ContainerState.FAILED
+        c.exit_message = exit_message
+        self._client._release_container(self, c)
+        service = self.spec.services[c.service_name]
+        restarts = self.restarts.get(c.service_name, 0)
+        if service.max_restarts == -1 or restarts < service.max_restarts:
+            self.restarts[c.service_name] = restarts + 1
+            self._add(c.service_name, 1)
+        elif not service.allow_failures:
+            self.shutdown("FAILED", "Failure in service %s, see logs for more information." % c.service_name)
+
+    def get_specification(self):
+        return self.spec
+
+    def shutdown(self, status="SUCCEEDED", diagnostics=None):
+        if self.finished:
+            return
+        self.finished = True
+        self.finish_time = self._clock.time()
+        self.final_status = status
+        self.diagnostics = diagnostics
+        for c in self._containers:
+            if c.final_state is None:
+                c.final_state = ContainerState.KILLED
+                self._client._release_container(self, c)
+
+
+class FakeSkeinClient(object):
+    """In-memory ``skein.Client``. Latencies are in seconds of ``clock``, which defaults to ``time``.
+
+    Each host is a node of ``node_resources``, of which ``node_used`` are used by other
+    applications. ``queues`` are ``skein.model.Queue`` reported by ``get_queue``, a "default"
+    queue of whole cluster if not given.
+    """
+
+    def __init__(self, submit_latency=0, rpc_latency=0, kv_latency=0, allocation_latency=0,
+                 head_address_latency=0, hosts=("host0",), clock=time, node_resources=Resources(65536, 64),
+                 queues=None, node_used=Resources(0, 0)):
+        self.submit_latency = submit_latency
+        self.rpc_latency = rpc_latency
+        self.kv_latency = kv_latency
+        self.allocation_latency = allocation_latency
+        self.head_address_latency = head_address_latency
+        self.hosts = list(hosts)
+        self.clock = clock
+        self.node_resources = node_resources
+        self.node_used = node_used
+        self.queues = {q.name: q for q in queues or [Queue("default", "RUNNING", 100.0, 100.0, 0.0, {"*"}, "")]}
+        self.applications = {}
+        self._ids = itertools.count(1)
+
+    def _request_container(self, app, container):
+        container.ready_at = self.clock.time() + self.allocation_latency
+        app.kv.set_later(*_node_kv(container), container.ready_at)
+        if container.service_name == _HEAD_SERVICE:
+            for key, value in _head_kv(container).items():
+                app.kv.set_later(key, value, container.ready_at + self.head_address_latency)
+
+    def _release_container(self, app, container):
+        pass
+
+    def submit(self, spec):
+        if self.submit_latency:
+            self.clock.sleep(self.submit_latency)
+        app_id = "application_0000000000000_%04d" % next(self._ids)
+        self.applications[app_id] = FakeApplicationClient(app_id, spec, self)
+        return app_id
+
+    def connect(self, app_id, wait=True, security=None):
+        return self.applications[app_id]
+
+    def kill_application(self, app_id, user=""):
+        self.applications[app_id].shutdown("KILLED")
+
+    def application_report(self, app_id):
+        app = self.applications[app_id]
+        now = self.clock.time()
+        running = [c for c in app._containers if c.state(now) == ContainerState.RUNNING]
+        if app.finished:
+            state = ApplicationState.KILLED if app.final_status == "KILLED" else ApplicationState.FINISHED
+            final_status = FinalStatus(app.final_status)
+        else:
+            state = ApplicationState.RUNNING
+            final_status = FinalStatus.UNDEFINED
+        used = Resources(memory=sum(app.spec.services[c.service_name].resources.memory for c in running),
+                         vcores=sum(app.spec.services[c.service_name].resources.vcores for c in running))
+        usage = ResourceUsageReport(0, 0, len(running), Resources(0, 0), Resources(0, 0), used)
+        return ApplicationReport(app_id, app.spec.name, app.spec.user or "testuser", app.spec.queue,
+                                 app.spec.tags, "", 0, "", state, final_status, 0.0, usage,
+                                 app.diagnostics or "", datetime.fromtimestamp(app.start_time),
+                                 datetime.fromtimestamp(app.finish_time) if app.finish_time else None)
+
+    def get_nodes(self, states=None):
+        return [NodeReport("%s:8041" % host, "%s:8042" % host, "/default-rack", set(), "RUNNING", "",
+                           self.node_resources, self.node_used) for host in self.hosts]
+
+    def get_queue(self, name):
+        if name not in self.queues:
+            raise ValueError("queue %s does not exist" % name)
+        return self.queues[name]
+
+    def get_applications(self, states=None, name=None, user=None, queue=None, **kwargs):
+        states = {str(ApplicationState(s)) for s in (states or ["SUBMITTED", "ACCEPTED", "RUNNING"])}
+        reports = [self.application_report(app_id) for app_id in self.applications]
+        return [r for r in reports if str(r.state) in states and (name is None or r.name == name)
+                and (user is None or r.user == user) and (queue is None or r.queue == queue)]
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class _SimulatedTime(object):
+    """Replacement of ``time`` module backed by simulated clock"""
+
+    def __init__(self, sim):
+        self._sim = sim
+
+    def time(self):
+        return self._sim.time()
+
+    def perf_counter(self):
+        return self._sim.time()
+
+    def monotonic(self):
+        return self._sim.time()
+
+    def sleep(self, seconds):
+        self._sim.sleep(seconds)
+
+
+class SimulatedYarn(FakeSkeinClient):
+    """Discrete-event simulation of a YARN queue behind skein client calls used by ``YarnCluster``.
+
+    Time is simulated: ``sleep`` and ``run_until`` process events in order of simulated time without
+    waiting, so hours of cluster behaviour run in seconds. Containers are allocated in request order
+    when the queue has capacity, each after an allocation delay. Running containers fail at
+    ``failure_rate`` per hour and can be preempted. Failed containers are restarted per service's
+    ``max_restarts``, and the application fails when they run out, like skein's application master.
+
+    Parameters
+    ----------
+    vcores : int, optional
+        Queue capacity in vcores. Unlimited by default.
+    memory : int, optional
+        Queue capacity in MiB. Unlimited by default.
+    allocation_delay : float or callable, optional
+        Seconds from capacity being available to a container running. A callable takes
+        ``random.Random`` and returns seconds.
+    failure_rate : float, optional
+        Expected failures per container per hour of running.
+    seed : int, optional
+        Seed of random numbers for delays and failures.
+
+    Examples
+    --------
+    >>> sim = SimulatedYarn(vcores=100, allocation_delay=lambda rng: rng.uniform(1, 10))
+    >>> with sim.patch():
+    ...     cluster = YarnCluster(environment="python:///usr/bin/python", skein_client=sim)
+    ...     cluster.scale(50)
+    ...     sim.sleep(3600)
+    """
+
+    def __init__(self, vcores=None, memory=None, allocation_delay=0, failure_rate=0, hosts=("host0",),
+                 head_address_latency=0, seed=0):
+        super(SimulatedYarn, self).__init__(head_address_latency=head_address_latency, hosts=hosts, clock=self)
+        self.vcores = vcores
+        self.memory = memory
+        self.allocation_delay = allocation_delay
+        self.failure_rate = failure_rate
+        self.rng = random.Random(seed)
+        self.used_vcores = 0
+        self.used_memory = 0
+        self.preempted = 0
+        self._now = 0.0
+        self._events = []
+        self._seq = itertools.count()
+        self._pending = collections.deque()
+
+    # clock
+    def time(self):
+        return self._now
+
+    def sleep(self, seconds):
+        self.run_until(self._now + seconds)
+
+    def run_until(self, t):
+        """Process events up to simulated time t"""
+        while self._events and self._events[0][0] <= t:
+            at, _, callback = heapq.heappop(self._events)
+            self._now = max(self._now, at)
+            callback()
+        self._now = max(self._now, t)
+
+    def schedule(self, delay, callback):
+        """Call callback after delay seconds of simulated time"""
+        heapq.heappush(self._events, (self._now + delay, next(self._seq), callback))
+
+    @contextlib.contextmanager
+    def patch(self):
+        """Make ray-yarn use simulated time, so its waits and polls don't block"""
+        from . import core
+        original = core.time
+        core.time = _SimulatedTime(self)
+        try:
+            yield self
+        finally:
+            core.time = original
+
+    # queue
+    def _resources(self, app, container):
+        return app.spec.services[container.service_name].resources
+
+    def _fits(self, vcores, memory):
+        return (self.vcores is None or self.used_vcores + vcores <= self.vcores) and \
+               (self.memory is None or self.used_memory + memory <= self.memory)
+
+    def _delay(self):
+        return self.allocation_delay(self.rng) if callable(self.allocation_delay) else self.allocation_delay
+
+    def _request_container(self, app, container):
+        self._pending.append((app, container))
+        self._allocate()
+
+    def _allocate(self):
+        while self._pending:
+            app, c = self._pending[0]
+            if c.final_state is not None:
+                self._pending.popleft()
+                continue
+            resources = self._resources(app, c)
+            if not self._fits(resources.vcores, resources.memory):
+                break
+            self._pending.popleft()
+            self.used_vcores += resources.vcores
+            self.used_memory += resources.memory
+            c.allocated = True
+            self.schedule(self._delay(), functools.partial(self._start, app, c))
+
+    def _start(self, app, c):
+        if c.final_state is not None:
+            return
+        c.ready_at = self._now
+        key, value = _node_kv(c)
+        app.kv[key] = value
+        if c.service_name == _HEAD_SERVICE:
+            self.schedule(self.head_address_latency, functools.partial(self._publish_head, app, c))
+        if self.failure_rate:
+            self.schedule(self.rng.expovariate(self.failure_rate / 3600.0), functools.partial(self._fail, app, c))
+
+    def _publish_head(self, app, c):
+        for key, value in _head_kv(c).items():
+            app.kv[key] = value
+
+    def _fail(self, app, c, exit_message="Container failed"):
+        if c.final_state is None and not app.finished:
+            app.fail_container(c.id, exit_message)
+
+    def _release_container(self, app, container):
+        if container.allocated:
+            container.allocated = False
+            resources = self._resources(app, container)
+            self.used_vcores -= resources.vcores
+            self.used_memory -= resources.memory
+            self._allocate()
+
+    def preempt(self, n, service=None):
+        """Preempt n running containers, youngest first like YARN's capacity scheduler"""
+        running = [(c.ready_at, i, app, c) for app in self.applications.values() for i, c in enumerate(app._containers)
+                   if c.state(self._now) == ContainerState.RUNNING and (service is None or c.service_name == service)]
+        running.sort(key=lambda r: r[:2], reverse=True)
+        for _, _, app, c in running[:n]:
+            self.preempted += 1
+            self._fail(app, c, "Container preempted by scheduler")
+
+    def set_capacity(self, vcores=None, memory=None):
+        """Change queue capacity. Containers above a shrunk capacity are preempted."""
+        self.vcores = vcores
+        self.memory = memory
+        while not self._fits(0, 0):
+            before = (self.used_vcores, self.used_memory)
+            self.preempt(1)
+            if before == (self.used_vcores, self.used_memory):
+                break
+        self._allocate()
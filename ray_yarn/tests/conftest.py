@@ -4,6 +4,7 @@ import os
 import sys
 import time
 import subprocess
+from ray_yarn import config
 
 
 @pytest.fixture(scope="session")
@@ -21,6 +22,28 @@ def skein_client():
         yield client
 
 
+@pytest.fixture
+def load_config():
+    config.load_config()
+
+
+class Clock(object):
+    """Clock of code under test, set by hand through ``now``"""
+
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    assert condition()
+
+
 def check_is_shutdown(client, app_id, status="SUCCEEDED"):
     timeleft = 10
     report = client.application_report(app_id)
@@ -60,4 +83,4 @@ def get_logs(app_id, tries=3):
         except Exception:
             pass
         time.sleep(1)
-    return subprocess.check_output(command).decode()
\ No newline at end of file
+    return subprocess.check_output(command).decode()
@@ -0,0 +1,85 @@
+import os
+import subprocess
+import sys
+import zipfile
+import pytest
+from ray_yarn import bundle, core, envcache
+
+
+@pytest.fixture
+def code(tmp_path, monkeypatch):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    work = tmp_path / "project"
+    (work / "data").mkdir(parents=True)
+    (work / "data" / "config.json").write_text("{}")
+    (work / "train.py").write_text("EPOCHS = 10\n")
+    (work / "__pycache__").mkdir()
+    (work / "__pycache__" / "train.cpython-38.pyc").write_bytes(b"")
+    pkg = tmp_path / "mylib"
+    pkg.mkdir()
+    (pkg / "__init__.py").write_text("NAME = 'mylib'\n")
+    single = tmp_path / "helpers.py"
+    single.write_text("def double(x):\n    return 2 * x\n")
+    return work, pkg, single
+
+
+def test_pack_once(code, tmp_path):
+    work, pkg, single = code
+    archive = bundle.pack("working_dir", [("", str(work))])
+    assert os.path.dirname(archive) == str(tmp_path / "cache" / "ray-yarn" / "bundles")
+    assert sorted(zipfile.ZipFile(archive).namelist()) == ["data/config.json", "train.py"]
+    assert zipfile.ZipFile(archive).read("train.py") == b"EPOCHS = 10\n"
+    assert bundle.pack("working_dir", [("", str(work))]) == archive
+    # same content packs to same bytes, so cache digests don't change with repacking
+    digest = envcache.archive_digest(archive)
+    os.remove(archive)
+    assert envcache.archive_digest(bundle.pack("working_dir", [("", str(work))])) == digest
+    (work / "train.py").write_text("EPOCHS = 20\n")
+    assert bundle.pack("working_dir", [("", str(work))]) != archive
+    modules = bundle.pack("py_modules", [("mylib", str(pkg)), ("helpers.py", str(single))])
+    assert sorted(zipfile.ZipFile(modules).namelist()) == ["helpers.py", "mylib/__init__.py"]
+
+
+def test_localize(code, tmp_path):
+    work, pkg, single = code
+    wheel = tmp_path / "dep-1.0-py3-none-any.whl"
+    with zipfile.ZipFile(str(wheel), "w") as z:
+        z.writestr("dep/__init__.py", "VERSION = '1.0'\n")
+    files, path = bundle.localize(str(work), [str(pkg), str(wheel), str(single), "hdfs:///libs/other.whl"])
+    assert sorted(files) == ["dep-1.0-py3-none-any.whl", "other.whl", "py_modules", "working_dir"]
+    assert str(files["working_dir"].type) == str(files["py_modules"].type) == "ARCHIVE"
+    assert str(files["other.whl"].type) == "FILE"
+    assert path == ["working_dir", "py_modules", "dep-1.0-py3-none-any.whl", "other.whl"]
+
+    # imports as in a container, with files unpacked as NodeManager would
+    container = tmp_path / "container"
+    for key in ["working_dir", "py_modules"]:
+        zipfile.ZipFile(files[key].source[len("file://"):]).extractall(str(container / key))
+    os.symlink(str(wheel), str(container / wheel.name))
+    env = dict(os.environ, PYTHONPATH=":".join(str(container / p) for p in path[:3]))
+    out = subprocess.check_output([sys.executable, "-c", "import train, mylib, helpers, dep; "
+                                   "print(train.EPOCHS, mylib.NAME, helpers.double(2), dep.VERSION)"], env=env)
+    assert out.decode().split() == ["10", "mylib", "4", "1.0"]
+
+    assert bundle.localize(py_modules=[str(pkg)])[1] == ["py_modules"]
+    with pytest.raises(ValueError, match="given twice"):
+        bundle.localize(py_modules=[str(pkg), str(pkg)])
+    with pytest.raises(ValueError, match="package directories"):
+        bundle.localize(py_modules=["hdfs:///libs/mylib"])
+    with pytest.raises(ValueError, match="local directory"):
+        bundle.localize("hdfs:///project")
+
+
+@pytest.mark.usefixtures("load_config")
+def test_make_specification_ships_code(code):
+    work, pkg, _ = code
+    spec = core._make_specification(ray_runtime_cfg=core.RayRuntimeConfig(),
+                                     environment="hdfs:///envs/env.tar.gz", working_dir=str(work),
+                                     py_modules=[str(pkg)])
+    for service in spec.services.values():
+        assert {"environment", "working_dir", "py_modules"} <= set(service.files)
+        assert 'export PYTHONPATH="$PWD/working_dir:$PWD/py_modules${PYTHONPATH:+:$PYTHONPATH}"' in service.script
+    # packed once for all services
+    assert len({s.files["working_dir"].source for s in spec.services.values()}) == 1
+    spec = core._make_specification(ray_runtime_cfg=core.RayRuntimeConfig(), environment="python:///usr/bin/python")
+    assert "PYTHONPATH" not in spec.services[core._HEAD_SERVICE].script
@@ -0,0 +1,84 @@
+import pytest
+from skein.model import Queue, Resources
+from ray_yarn import capacity, core, testing
+
+_ENVIRONMENT = "python:///usr/bin/python"
+
+
+def _queue(name, used, capacity=50.0, max_capacity=50.0, state="RUNNING"):
+    return Queue(name, state, capacity, max_capacity, used, {"*"}, "")
+
+
+def _client(*queues, used=Resources(0, 0)):
+    # 4 nodes of 16GiB and 16 vcores
+    return testing.FakeSkeinClient(hosts=["host%d" % i for i in range(4)], node_resources=Resources(16384, 16),
+                                   queues=queues or None, node_used=used)
+
+
+def _spec(instances, memory=2048, vcores=1):
+    cfg = core.RayRuntimeConfig(initial_instances=instances, memory=memory, num_cpus=vcores)
+    return core._make_specification(ray_runtime_cfg=cfg, environment=_ENVIRONMENT)
+
+
+def test_headroom():
+    total = Resources(65536, 64)
+    room = capacity.headroom(_queue("q1", 50.0, capacity=50.0, max_capacity=100.0), total)
+    assert (room.memory, room.vcores) == (65536 - 16384, 64 - 16)
+    # over capacity by elasticity
+    assert capacity.headroom(_queue("q1", 300.0, capacity=25.0, max_capacity=50.0), total).memory == 0
+    assert capacity.fits(room, Resources(4096, 1)) == 12
+    # other queues use the rest of the cluster
+    room = capacity.headroom(_queue("q1", 50.0, capacity=50.0, max_capacity=100.0), total, Resources(8192, 32))
+    assert (room.memory, room.vcores) == (8192, 32)
+
+
+@pytest.mark.usefixtures("load_config")
+def test_fit_picks_queue_with_most_room():
+    spec = _spec(4)
+    room = capacity.fit(_client(_queue("busy", 90.0), _queue("idle", 10.0), _queue("stopped", 0.0, state="STOPPED")),
+                        spec, core._WORKER_SERVICE, ["busy", "idle", "stopped"])
+    assert spec.queue == room.queue == "idle"
+    with pytest.raises(ValueError):
+        capacity.fit(_client(_queue("stopped", 0.0, state="STOPPED")), spec, core._WORKER_SERVICE, ["stopped"])
+
+
+@pytest.mark.usefixtures("load_config")
+def test_fit_caps_or_warns_initial_instances():
+    # 10% used of 32GiB, 28.8GiB free: 2GiB head and 512MiB master leave room for 13 workers
+    spec = _spec(20)
+    with pytest.warns(UserWarning, match="room for 13 of 20"):
+        capacity.fit(_client(_queue("default", 10.0)), spec, core._WORKER_SERVICE)
+    assert spec.services[core._WORKER_SERVICE].instances == 20
+    with pytest.warns(UserWarning, match="capped from 20 to 13"):
+        capacity.fit(_client(_queue("default", 10.0)), spec, core._WORKER_SERVICE, check="cap")
+    assert spec.services[core._WORKER_SERVICE].instances == 13
+    with pytest.warns(UserWarning, match="no room for application master"):
+        capacity.fit(_client(_queue("default", 100.0)), spec, core._WORKER_SERVICE, check="cap")
+    # queue has room, but nodes are used by other queues beyond their capacity: 4GiB free of each node
+    spec = _spec(20)
+    with pytest.warns(UserWarning, match="room for 6 of 20"):
+        capacity.fit(_client(_queue("default", 10.0), used=Resources(12288, 4)), spec, core._WORKER_SERVICE)
+    with pytest.raises(ValueError):
+        capacity.fit(_client(), spec, core._WORKER_SERVICE, check="fail")
+
+
+@pytest.mark.usefixtures("load_config")
+def test_container_above_max_allocation_rejected():
+    client = _client()
+    with pytest.raises(ValueError, match="service ray.head asks for 32768 MiB"):
+        core.YarnCluster(ray_runtime_cfg=core.RayRuntimeConfig(memory=32768), environment=_ENVIRONMENT,
+                         skein_client=client, capacity_check="warn")
+    assert not client.applications
+
+
+@pytest.mark.usefixtures("load_config")
+def test_yarn_cluster_capacity_check():
+    client = _client(_queue("q1", 90.0), _queue("q2", 0.0))
+    with pytest.warns(UserWarning, match="capped"):
+        cluster = core.YarnCluster(ray_runtime_cfg=core.RayRuntimeConfig(initial_instances=100),
+                                   environment=_ENVIRONMENT, skein_client=client, queues=["q1", "q2"],
+                                   capacity_check="cap")
+    assert cluster.spec.queue == "q2"
+    assert client.application_report(cluster.app_id).queue == "q2"
+    assert cluster.health().target == cluster.spec.services[core._WORKER_SERVICE].instances < 100
+    cluster.shutdown()
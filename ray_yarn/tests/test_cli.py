@@ -1,6 +1,19 @@
+import gc
+import io
+import os
+import json
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
 import pytest
+import skein
 import ray_yarn
-from ray_yarn import cli, core
+from ray_yarn import cli, config, core, testing, topology
+from .conftest import wait_for
 
 
 def test_extract_type():
@@ -83,3 +96,530 @@ def test_version(capfd):
     run_command("--version")
     out, err = capfd.readouterr()
     assert "ray-yarn " + ray_yarn.__version__ in out
+
+
+def test_place_in_local_dirs_head(tmp_path, monkeypatch):
+    monkeypatch.setenv("CONTAINER_ID", "container_1_0001_01_000001")
+    local_dirs = [str(tmp_path / "d1"), str(tmp_path / "d2")]
+    kwargs = {"object_store_memory": 1}
+    system_config = {}
+    cli._place_in_local_dirs(True, kwargs, local_dirs, system_config)
+    assert kwargs["temp_dir"] == local_dirs[0] + "/ray"
+    assert kwargs["plasma_directory"] == "/dev/shm"
+    spill = json.loads(system_config["object_spilling_config"])
+    assert spill["type"] == "filesystem"
+    assert spill["params"]["directory_path"] == [d + "/ray_spill" for d in local_dirs]
+
+
+def test_place_in_local_dirs_worker(tmp_path, monkeypatch):
+    monkeypatch.setenv("CONTAINER_ID", "container_1_0001_01_000002")
+    local_dirs = [str(tmp_path / ("x" * 60))]
+    kwargs = {"object_store_memory": "1PiB"}
+    system_config = {}
+    cli._place_in_local_dirs(False, kwargs, local_dirs, system_config)
+    assert "temp_dir" not in kwargs
+    assert not system_config
+    assert kwargs["plasma_directory"] == local_dirs[0] + "/ray_plasma/container_1_0001_01_000002"
+    assert os.path.isdir(kwargs["plasma_directory"])
+    assert kwargs["raylet_socket_name"] == "/tmp/ray-container_1_0001_01_000002/raylet"
+
+
+def test_place_in_local_dirs_keep_user_values():
+    kwargs = {"temp_dir": "/t", "plasma_directory": "/p"}
+    system_config = {}
+    cli._place_in_local_dirs(True, kwargs, ["/data1/local"], system_config)
+    assert kwargs == {"temp_dir": "/t", "plasma_directory": "/p"}
+    assert "object_spilling_config" in system_config
+    kwargs = {}
+    cli._place_in_local_dirs(True, kwargs, [], system_config)
+    assert not kwargs
+
+
+def test_allocate_ports_head(monkeypatch):
+    monkeypatch.setenv("SKEIN_RESOURCE_VCORES", "2")
+    kwargs = {"port": 0}
+    ports = cli._allocate_ports(True, kwargs)
+    for name in ["port", "gcs_server_port", "dashboard_port", "ray_client_server_port",
+                 "object_manager_port", "node_manager_port"]:
+        assert kwargs[name] > 0
+        assert ports[name] == kwargs[name]
+    worker_ports = [int(p) for p in kwargs["worker_port_list"].split(',')]
+    assert len(worker_ports) == 100
+    all_ports = worker_ports + [v for k, v in ports.items() if k != "worker_port_list"]
+    assert len(set(all_ports)) == len(all_ports)
+
+
+def test_allocate_ports_worker_keep_user_values(monkeypatch):
+    monkeypatch.setenv("SKEIN_RESOURCE_VCORES", "10")
+    kwargs = {"node_manager_port": 12345, "min_worker_port": 20000, "max_worker_port": 20100}
+    ports = cli._allocate_ports(False, kwargs)
+    assert list(ports.keys()) == ["object_manager_port"]
+    assert kwargs["node_manager_port"] == 12345
+    assert kwargs["min_worker_port"] == 20000
+    assert "worker_port_list" not in kwargs
+    assert "port" not in kwargs
+    # sized by container vcores
+    kwargs = {}
+    cli._allocate_ports(False, kwargs)
+    assert len(kwargs["worker_port_list"].split(',')) == 160
+
+
+def test_add_node_resources(monkeypatch):
+    monkeypatch.delenv("SKEIN_CONTAINER_ID", raising=False)
+    monkeypatch.setenv("NM_HOST", "host1")
+    kwargs = {"resources": '{"res1": 2.0, "node:host1": 3.0}'}
+    cli._add_node_resources(kwargs)
+    assert kwargs["resources"] == '{"res1":2.0,"node:host1":3.0}'
+    kwargs = {}
+    cli._add_node_resources(kwargs)
+    assert json.loads(kwargs["resources"]) == {"node:host1": 1.0}
+    monkeypatch.setenv("SKEIN_CONTAINER_ID", "ray.worker_0")
+    kwargs = {}
+    cli._add_node_resources(kwargs)
+    assert json.loads(kwargs["resources"]) == {"node:container:ray.worker_0": 1.0, "node:host1": 1.0}
+    monkeypatch.delenv("NM_HOST")
+    monkeypatch.delenv("SKEIN_CONTAINER_ID")
+    kwargs = {}
+    cli._add_node_resources(kwargs)
+    assert not kwargs
+
+
+def test_busy_workers():
+    procs = [subprocess.Popen(["bash", "-c", "exec -a '%s' sleep 10" % title])
+             for title in ["ray::my_task()", "ray::IDLE", "ray::Actor.method()"]]
+    try:
+        deadline = time.time() + 5
+        while cli._busy_workers(os.getpid()) < 2 and time.time() < deadline:
+            time.sleep(0.05)
+        assert cli._busy_workers(os.getpid()) == 2
+    finally:
+        for p in procs:
+            p.kill()
+            p.wait()
+    assert cli._busy_workers(os.getpid()) == 0
+
+
+def test_refuse_new_tasks(tmp_path, monkeypatch):
+    import ray.util
+    monkeypatch.setenv("SKEIN_CONTAINER_ID", "ray.worker_0")
+    ip = ray.util.get_node_ip_address()
+    port, node_manager_port = _free_port(), _free_port()
+    gcs_address = "%s:%d" % (ip, port)
+    kwargs = {"node_ip_address": ip, "node_manager_port": node_manager_port}
+    cli._add_node_resources(kwargs)
+    with open(str(tmp_path / "head.log"), "w") as log_file:
+        head = cli._RayProcess(["ray", "start", "--head", "--block", "--port=%d" % port, "--num-cpus=2",
+                                "--node-manager-port=%d" % node_manager_port, "--node-ip-address=" + ip,
+                                "--resources=" + kwargs["resources"], "--include-dashboard=false"], log_file)
+        head.start()
+        driver = None
+        try:
+            # a driver with a running task, and a new one once the node refuses new tasks, exits with whether it ran
+            driver = subprocess.Popen([sys.executable, "-c", "\n".join([
+                "import ray, sys, time",
+                "ray.init(address=%r)" % gcs_address,
+                "task = ray.remote(num_cpus=1)(lambda t: time.sleep(t))",
+                "running = task.remote(60)",
+                "input()",
+                "new = task.remote(0)",
+                "ready, _ = ray.wait([new], timeout=2)",
+                "ray.cancel(new)",
+                "ray.cancel(running, force=True)",
+                "sys.exit(len(ready))"])], stdin=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True)
+            node_id = topology.find_node_id(gcs_address, ip, node_manager_port, timeout=60)
+            state = topology.gcs_state(gcs_address)
+            wait_for(lambda: state._available_resources_per_node()[node_id].get("CPU") == 1, timeout=30)
+            reserve = cli._refuse_new_tasks(gcs_address, kwargs)
+            wait_for(lambda: "CPU" not in state._available_resources_per_node()[node_id], timeout=30)
+            driver.communicate("\n", timeout=30)
+            assert driver.returncode == 0
+            # CPU freed by the running task is reserved next
+            wait_for(lambda: state._available_resources_per_node()[node_id].get("CPU") == 1, timeout=30)
+            reserve()
+            wait_for(lambda: "CPU" not in state.available_resources(), timeout=30)
+            ray.shutdown()
+            # reservations go with the driver
+            wait_for(lambda: state.available_resources().get("CPU") == 2, timeout=30)
+        finally:
+            ray.shutdown()
+            if driver is not None:
+                driver.kill()
+            for child in cli.psutil.Process(head.pid).children(recursive=True):
+                child.kill()
+            head.proc.kill()
+            head.proc.wait(30)
+
+
+@pytest.mark.usefixtures("load_config")
+def test_drain(monkeypatch):
+    monkeypatch.setenv("SKEIN_CONTAINER_ID", "ray.worker_0")
+    monkeypatch.setattr(cli, "_refuse_new_tasks", lambda gcs_address, kwargs: lambda: None)
+    client = testing.FakeSkeinClient()
+    cluster = core.YarnCluster(environment="python:///usr/bin/python", skein_client=client)
+    cluster.scale(1)
+    app = client.applications[cluster.app_id]
+    cli._drain(app, os.getpid(), True, "127.0.0.1:6379", {}, grace_period=0)
+    assert cluster.draining() == ["ray.worker_0"]
+    assert len(cluster.workers()) == 2
+    # no replacement of workers killed on purpose
+    app.kv[core._RELEASED_PREFIX + "ray.worker_0"] = b"0"
+    cli._drain(app, os.getpid(), True, "127.0.0.1:6379", {}, grace_period=0)
+    assert len(cluster.workers()) == 2
+    monkeypatch.setenv("SKEIN_CONTAINER_ID", "ray.worker_1")
+    # no replacement when shutting down
+    app.kv[core._RAY_SHUTDOWN] = b"SUCCEEDED"
+    cli._drain(app, os.getpid(), True, "127.0.0.1:6379", {}, grace_period=0)
+    assert len(cluster.workers()) == 2
+    cluster.drain("ray.worker_1")
+    assert app.kv.wait(core._DRAIN_PREFIX + "ray.worker_1")
+    cluster.shutdown()
+
+
+def test_reconnect_to_restarted_head(tmp_path):
+    kv = testing.FakeKeyValueStore(time)
+    kv[core._RAY_HEAD_ADDRESS] = b"127.0.0.1:6379"
+    # stand-in of "ray start --block", bash exits when its child is terminated
+    command_list = ["bash", "-c", "sleep 30 & wait", "--address=127.0.0.1:6379"]
+    with open(str(tmp_path / "runtime.log"), "wb") as log_file:
+        process = cli._RayProcess(command_list, log_file)
+        process.start()
+        first = process.pid
+        app_client = type("AppClient", (), {"kv": kv})
+        threading.Thread(target=cli._watch_head_address, args=(app_client, process.address, process.reconnect),
+                         daemon=True).start()
+        waiter = threading.Thread(target=process.wait, daemon=True)
+        waiter.start()
+
+        start = time.perf_counter()
+        kv[core._RAY_HEAD_ADDRESS] = b"127.0.0.1:6380"
+        while (process.pid == first or process.proc.poll() is not None) and time.perf_counter() - start < 10:
+            time.sleep(0.01)
+        recovery = time.perf_counter() - start
+        assert process.address == "127.0.0.1:6380"
+        assert process.proc.poll() is None
+        assert recovery < 2, "worker reconnected in %.2f seconds" % recovery
+        # same address again is not a move
+        kv[core._RAY_HEAD_ADDRESS] = b"127.0.0.1:6380"
+        time.sleep(0.3)
+        second = process.pid
+        assert process.proc.poll() is None
+        process.kill(15, None)
+        waiter.join(5)
+        assert not waiter.is_alive()
+        assert process.pid == second
+
+
+def test_pycache_warning():
+    environ = {"PYTHONPYCACHEPREFIX": "/tmp/pycache"}
+    assert "python 3.7 ignores PYTHONPYCACHEPREFIX" in cli._pycache_warning(environ, (3, 7, 12, "final", 0))
+    assert cli._pycache_warning(environ, (3, 8, 0, "final", 0)) is None
+    assert cli._pycache_warning({}, (3, 7, 12, "final", 0)) is None
+    assert cli.yarn_parser.parse_args(["start", "--head"]).func is cli.start
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _redis_server():
+    """Path of redis-server, the one ray wheels ship if none is on PATH, None if neither"""
+    import ray
+    bundled = os.path.join(os.path.dirname(ray.__file__), "core", "src", "ray", "thirdparty", "redis", "src",
+                           "redis-server")
+    return shutil.which("redis-server") or (bundled if os.path.exists(bundled) else None)
+
+
+def test_workers_reconnect_to_restarted_head_with_external_redis(tmp_path, monkeypatch):
+    # ray connects to external redis with the redis client library
+    pytest.importorskip("redis")
+    if _redis_server() is None:
+        pytest.skip("redis-server not found")
+    password = "ray-yarn-test"
+    redis_port = _free_port()
+    redis = subprocess.Popen([_redis_server(), "--port", str(redis_port), "--requirepass", password,
+                              "--save", "", "--appendonly", "no"], stdout=subprocess.DEVNULL)
+    import ray.util
+    ip = ray.util.get_node_ip_address()
+    common = ["--block", "--node-ip-address=" + ip, "--redis-password=" + password]
+
+    def start_head(port, log_file):
+        # in head environment only, like containers of the head service
+        monkeypatch.setenv(core._ENV_GCS_REDIS_ADDRESS, "127.0.0.1:%d" % redis_port)
+        head = cli._RayProcess(["ray", "start", "--head", "--port=%d" % port, "--num-cpus=0",
+                                  "--include-dashboard=false"] + common, log_file)
+        head.start()
+        monkeypatch.delenv(core._ENV_GCS_REDIS_ADDRESS)
+        return head
+
+    kv = testing.FakeKeyValueStore(time)
+    app_client = type("AppClient", (), {"kv": kv})
+    worker_port = _free_port()
+    head = worker = None
+    try:
+        with open(str(tmp_path / "head.log"), "w") as head_log, open(str(tmp_path / "worker.log"), "w") as worker_log:
+            first_address = "%s:%d" % (ip, _free_port())
+            head = start_head(int(first_address.split(":")[1]), head_log)
+            kv[core._RAY_HEAD_ADDRESS] = first_address.encode()
+            worker = cli._RayProcess(["ray", "start", "--address=" + first_address, "--num-cpus=1",
+                                      "--node-manager-port=%d" % worker_port] + common, worker_log)
+            worker.start()
+            threading.Thread(target=cli._watch_head_address, args=(app_client, worker.address, worker.reconnect),
+                             daemon=True).start()
+            threading.Thread(target=worker.wait, daemon=True).start()
+            first_node = topology.find_node_id(first_address, ip, worker_port, timeout=60)
+            # GCS of this ray keeps its tables in the redis given by the environment
+            gcs = [p for p in cli.psutil.process_iter(["cmdline"]) if "gcs_server" in " ".join(p.info["cmdline"] or [])]
+            assert any("--redis_port=%d" % redis_port in p.info["cmdline"] for p in gcs)
+
+            head.kill(signal.SIGTERM, None)
+            head.proc.wait(30)
+            # restarted head gets new ports, and publishes its address
+            second_address = "%s:%d" % (ip, _free_port())
+            head = start_head(int(second_address.split(":")[1]), head_log)
+            first_pid = worker.pid
+            kv[core._RAY_HEAD_ADDRESS] = second_address.encode()
+            # worker restarts its ray processes in place, and the new raylet registers as another node
+            wait_for(lambda: worker.pid != first_pid, timeout=60)
+            assert worker.address == second_address
+            wait_for(lambda: topology.find_node_id(second_address, ip, worker_port, timeout=60) != first_node,
+                     timeout=120)
+            # node table of the first head survived in redis
+            nodes = {n["NodeID"]: n for n in topology.gcs_state(second_address).node_table()}
+            assert first_node in nodes
+    finally:
+        for process in [worker, head]:
+            if process is not None and process.proc.poll() is None:
+                # no restart by the wait thread
+                process._reconnecting = None
+                for child in cli.psutil.Process(process.pid).children(recursive=True):
+                    child.kill()
+                process.proc.kill()
+                process.proc.wait(30)
+        redis.terminate()
+        redis.wait(10)
+
+
+def _submit_apps(client):
+    for name, tags in [("etl", ["team-a", "nightly"]), ("train", ["team-a"]), ("serve", ["team-b"])]:
+        spec = core._make_specification(ray_runtime_cfg=core.RayRuntimeConfig(), environment="python:///usr/bin/python",
+                                        name=name, tags=tags)
+        client.submit(spec)
+
+
+@pytest.mark.usefixtures("load_config")
+def test_list(capfd, monkeypatch):
+    client = testing.FakeSkeinClient()
+    _submit_apps(client)
+    monkeypatch.setattr(cli, "_get_skein_client", lambda: client)
+    with pytest.raises(SystemExit) as exc:
+        cli.main(["list", "--tag", "team-a", "--json"])
+    assert exc.value.code == 0
+    listed = json.loads(capfd.readouterr().out)
+    assert [a["name"] for a in listed] == ["etl", "train"]
+    assert listed[0]["tags"] == ["nightly", "team-a"]
+    assert listed[0]["state"] == "RUNNING"
+
+    ids = sorted(client.applications)
+    with pytest.raises(SystemExit):
+        cli.main(["list", ids[2], ids[0], "--name", "serve"])
+    out = capfd.readouterr().out
+    assert "APPLICATION_ID" in out and ids[2] in out and ids[0] not in out
+
+    client.kill_application(ids[1])
+    with pytest.raises(SystemExit):
+        cli.main(["list", "--state", "killed", "--json"])
+    assert [a["application_id"] for a in json.loads(capfd.readouterr().out)] == [ids[1]]
+
+
+@pytest.mark.usefixtures("load_config")
+def test_list_watch_prints_changes_only(capfd, monkeypatch):
+    client = testing.FakeSkeinClient()
+    _submit_apps(client)
+    monkeypatch.setattr(cli, "_get_skein_client", lambda: client)
+    polls = []
+
+    def sleep(seconds):
+        polls.append(seconds)
+        if len(polls) == 2:
+            client.kill_application(sorted(client.applications)[0])
+        if len(polls) == 4:
+            raise KeyboardInterrupt()
+    monkeypatch.setattr(cli, "_watch_sleep", sleep)
+    with pytest.raises(KeyboardInterrupt):
+        cli.list_applications(watch=5, as_json=True)
+    out = capfd.readouterr().out
+    assert polls == [5] * 4
+    assert out.count('"name": "serve"') == 2
+    assert out.count('"name": "etl"') == 1
+
+
+@pytest.mark.usefixtures("load_config")
+def test_kill_by_tag(capfd, monkeypatch):
+    client = testing.FakeSkeinClient()
+    _submit_apps(client)
+    monkeypatch.setattr(cli, "_get_skein_client", lambda: client)
+    with pytest.raises(SystemExit) as exc:
+        cli.main(["kill", "--tag", "team-a"])
+    assert exc.value.code == 0
+    killed = sorted(i for i, app in client.applications.items() if app.final_status == "KILLED")
+    assert [client.applications[i].spec.name for i in killed] == ["etl", "train"]
+    assert capfd.readouterr().out.count("killed ") == 2
+    with pytest.raises(SystemExit) as exc:
+        cli.main(["kill"])
+    assert exc.value.code == 1
+
+
+def test_resolve_ip_address(monkeypatch):
+    def gethostbyname(name):
+        raise AssertionError("looked up %s" % name)
+    monkeypatch.setattr(socket, "gethostbyname", gethostbyname)
+    monkeypatch.setattr(socket, "getaddrinfo", gethostbyname)
+    addresses = {"eth0": ["10.0.0.5"], "eth1": ["192.168.1.7", "192.168.1.8"], "lo": ["127.0.0.1"]}
+    assert cli._resolve_ip_address({}, addresses) == "10.0.0.5"
+    assert cli._resolve_ip_address({"NM_HOST": "192.168.1.8"}, addresses) == "192.168.1.8"
+    # not local, e.g. resolved to another interface's name
+    assert cli._resolve_ip_address({"NM_HOST": "172.16.0.1"}, addresses) == "10.0.0.5"
+    assert cli._resolve_ip_address({"RAY_YARN_NODE_IP_INTERFACE": "eth1", "NM_HOST": "10.0.0.5"},
+                                   addresses) == "192.168.1.7"
+    assert cli._resolve_ip_address({"RAY_YARN_NODE_IP_CIDR": "192.168.1.8/32"}, addresses) == "192.168.1.8"
+    assert cli._resolve_ip_address({"RAY_YARN_NODE_IP_INTERFACE": "eth9"}, addresses) == "10.0.0.5"
+    # host name is not resolved
+    assert cli._resolve_ip_address({"NM_HOST": "node-7.example.com"}, addresses) == "10.0.0.5"
+    assert cli._resolve_ip_address({}, {"lo": ["127.0.0.1"]}) == "127.0.0.1"
+    assert cli._resolve_ip_address({}, {}) == "127.0.0.1"
+
+
+def test_get_ip_address_cached(monkeypatch):
+    cli._get_ip_address.cache_clear()
+    calls = []
+    monkeypatch.setattr(cli, "_local_addresses", lambda: calls.append(1) or {"eth0": ["10.0.0.5"]})
+    assert cli._get_ip_address() == "10.0.0.5"
+    assert cli._get_ip_address() == "10.0.0.5"
+    assert len(calls) == 1
+    cli._get_ip_address.cache_clear()
+
+
+@pytest.mark.usefixtures("load_config")
+def test_pool_without_shapes(capfd, monkeypatch):
+    monkeypatch.setitem(config.yarn_configs, "pool", None)
+    with pytest.raises(SystemExit) as exc:
+        cli.main(["pool", "--port", "0"])
+    assert exc.value.code == 1
+    assert "no cluster shapes" in capfd.readouterr().err
+
+
+_DRIVER_SCRIPT = """
+import sys
+print("driver args", sys.argv[1:])
+sys.exit(int(sys.argv[1]))
+"""
+
+
+def _play_drivers(app, stopped, run=True):
+    """Stand-in of driver containers of fake application, runs their scripts and finishes them"""
+    while not stopped.is_set():
+        for c in app._containers:
+            if c.service_name == core._DRIVER_SERVICE and c.final_state is None and c.ready_at <= time.time():
+                returncode = cli._run_script(app, c.env[core._ENV_DRIVER_ID]) if run else 1
+                c.final_state = skein.model.ContainerState.SUCCEEDED if returncode == 0 \
+                    else skein.model.ContainerState.FAILED
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def driver_script(tmp_path, monkeypatch):
+    monkeypatch.chdir(str(tmp_path))
+    monkeypatch.setattr(core, "_DRIVER_POLL_INTERVAL", 0.01)
+    script = tmp_path / "job.py"
+    script.write_text(_DRIVER_SCRIPT)
+    return str(script)
+
+
+@pytest.mark.usefixtures("load_config")
+def test_run_driver(driver_script, monkeypatch):
+    client = testing.FakeSkeinClient()
+    cluster = core.YarnCluster(environment="python:///usr/bin/python", skein_client=client)
+    app = client.applications[cluster.app_id]
+    stopped = threading.Event()
+    threading.Thread(target=_play_drivers, args=(app, stopped), daemon=True).start()
+    try:
+        output = io.StringIO()
+        assert cluster.run_driver(driver_script, ["0", "x"], output=output) == 0
+        assert "driver args ['0', 'x']" in output.getvalue()
+        # nothing is left in kv
+        assert not app.kv.get_prefix(core._DRIVERS_PREFIX)
+        assert not app.finished
+        # output beyond the limit is in container log only
+        monkeypatch.setattr(cli, "_MAX_DRIVER_OUTPUT", 10)
+        output = io.StringIO()
+        assert cluster.run_driver(driver_script, ["0", "x" * 100], output=output) == 0
+        assert "output beyond 10 bytes is in the log of driver container" in output.getvalue()
+        assert "x" * 100 not in output.getvalue()
+        assert cluster.run_driver(driver_script, ["3"], shutdown=True, output=io.StringIO()) == 3
+        assert app.final_status == "FAILED"
+    finally:
+        stopped.set()
+
+
+@pytest.mark.usefixtures("load_config")
+def test_run_driver_failures(driver_script):
+    client = testing.FakeSkeinClient()
+    cluster = core.YarnCluster(environment="python:///usr/bin/python", skein_client=client)
+    app = client.applications[cluster.app_id]
+    with pytest.raises(ValueError):
+        cluster.run_driver(driver_script, resources={"memory": "64GiB", "vcores": 1})
+    with pytest.raises(TimeoutError):
+        cluster.run_driver(driver_script, ["0"], timeout=0.05)
+    assert [str(c.state) for c in app.get_containers(services=[core._DRIVER_SERVICE], states=core._ALL_STATES)] \
+        == ["KILLED"]
+    stopped = threading.Event()
+    threading.Thread(target=_play_drivers, args=(app, stopped, False), daemon=True).start()
+    try:
+        with pytest.raises(core.RayYarnError):
+            cluster.run_driver(driver_script, ["0"])
+    finally:
+        stopped.set()
+    cluster.shutdown()
+
+
+@pytest.mark.usefixtures("load_config")
+def test_run_keep(driver_script, monkeypatch):
+    client = testing.FakeSkeinClient()
+    monkeypatch.setattr(core, "_get_skein_client", lambda skein_client=None, security=None: client)
+    stopped = threading.Event()
+
+    def play_drivers():
+        wait_for(lambda: client.applications)
+        _play_drivers(next(iter(client.applications.values())), stopped)
+    threading.Thread(target=play_drivers, daemon=True).start()
+    try:
+        with pytest.raises(SystemExit) as exc:
+            cli.main(["run", "--environment", "python:///usr/bin/python", "--keep", driver_script, "0"])
+    finally:
+        stopped.set()
+    assert exc.value.code == 0
+    # not shut down as the cluster object, referenced by the traceback until then, is collected
+    del exc
+    gc.collect()
+    app = next(iter(client.applications.values()))
+    assert not app.finished
+    app.shutdown()
+
+
+@pytest.mark.usefixtures("load_config")
+def test_run_in_application(driver_script, capfd, monkeypatch):
+    client = testing.FakeSkeinClient()
+    cluster = core.YarnCluster(environment="python:///usr/bin/python", skein_client=client)
+    monkeypatch.setattr(cli, "_get_skein_client", lambda: client)
+    stopped = threading.Event()
+    threading.Thread(target=_play_drivers, args=(client.applications[cluster.app_id], stopped), daemon=True).start()
+    try:
+        with pytest.raises(SystemExit) as exc:
+            cli.main(["run", "--app-id", cluster.app_id, driver_script, "5", "--flag"])
+    finally:
+        stopped.set()
+    assert exc.value.code == 5
+    assert "driver args ['5', '--flag']" in capfd.readouterr().out
+    cluster.shutdown()
@@ -1,6 +1,9 @@
+import threading
+import time
 import pytest
 import ray
-from ray_yarn import config, core
+import skein
+from ray_yarn import config, core, locality, testing, topology
 from .conftest import check_is_shutdown
 
 
@@ -81,11 +84,6 @@ def test_value_object_var_keyword_values():
     assert hash(oe) == hash(str(oe))
 
 
-@pytest.fixture
-def load_config():
-    config.load_config()
-
-
 def _lookup_assert(kwargs, name, value1, value2, value3):
     assert core.lookup(kwargs, name, None) == value1
     assert core.lookup(kwargs, name, config.CONFIG_NAME_HEAD) == value2
@@ -169,10 +167,214 @@ def test_yarn_cluster(skein_client, conda_env):
     with core.YarnCluster(environment=conda_env,
                           ray_runtime_cfg=cfg) as yarn:
         yarn.scale(1)
-        ip = yarn.get_home_ip()
-        ray.init(address='ray://%s:10001' % ip)
+        ray.init(address=yarn.get_client_address())
         ref = my_function.remote()
         assert 1 == ray.get(ref)
 
     check_is_shutdown(skein_client, yarn.app_id)
 
+
+@pytest.mark.usefixtures("load_config")
+def test_make_specification_with_locality():
+    def provider(paths):
+        assert paths == ["/data"]
+        return [locality.BlockLocation("/data/a", 0, 100, ["h1", "h2"]),
+                locality.BlockLocation("/data/a", 100, 100, ["h2"])]
+    spec = core._make_specification(ray_runtime_cfg=core.RayRuntimeConfig(), environment="python:///usr/bin/python",
+                                    input_paths=["/data"], block_location_provider=provider)
+    worker = spec.services["ray.worker"]
+    assert worker.nodes == ["h2"]
+    assert worker.relax_locality
+    spec = core._make_specification(ray_runtime_cfg=core.RayRuntimeConfig(), environment="python:///usr/bin/python")
+    assert not spec.services["ray.worker"].nodes
+
+
+@pytest.mark.usefixtures("load_config")
+def test_make_specification_head_restarts():
+    spec = core._make_specification(ray_runtime_cfg=core.RayRuntimeConfig(), environment="python:///usr/bin/python")
+    assert spec.services["ray.head"].max_restarts == 0
+    assert core._ENV_GCS_REDIS_ADDRESS not in spec.services["ray.head"].env
+    spec = core._make_specification(ray_runtime_cfg=core.RayRuntimeConfig(), environment="python:///usr/bin/python",
+                                    head_max_restarts=3, gcs_redis_address="redis-host:6379")
+    head = spec.services["ray.head"]
+    assert head.max_restarts == 3
+    assert head.env[core._ENV_GCS_REDIS_ADDRESS] == "redis-host:6379"
+
+
+@pytest.mark.usefixtures("load_config")
+def test_make_specification_node_ip_env(monkeypatch):
+    monkeypatch.setitem(config.yarn_configs, "node_ip_cidr", "10.1.0.0/16")
+    spec = core._make_specification(ray_runtime_cfg=core.RayRuntimeConfig(), environment="python:///usr/bin/python")
+    for service in spec.services.values():
+        assert service.env[core._ENV_NODE_IP_CIDR] == "10.1.0.0/16"
+
+
+def test_files_and_build_script():
+    files, build_script = core._files_and_build_script("conda:///opt/envs/ray", activate=False)
+    assert files == {}
+    script = build_script("start")
+    assert 'export PATH="/opt/envs/ray/bin:$PATH"' in script
+    assert 'export PYTHONPYCACHEPREFIX="${LOCAL_DIRS%%,*}/ray-yarn-pycache"' in script
+    assert script.endswith("/opt/envs/ray/bin/python -m ray_yarn.cli start")
+    _, build_script = core._files_and_build_script("conda:///opt/envs/ray")
+    assert build_script("start") == "conda activate /opt/envs/ray\nray-yarn start"
+    files, build_script = core._files_and_build_script("/tmp/env.tar.gz", activate=False)
+    assert files == {"environment": "/tmp/env.tar.gz"}
+    assert build_script("start").startswith('export PATH="$PWD/environment/bin:$PATH"\n')
+    _, build_script = core._files_and_build_script("/tmp/env.tar.gz")
+    assert build_script("start") == "source environment/bin/activate\nenvironment/bin/python -m ray_yarn.cli start"
+
+
+def test_files_and_build_script_with_cache(monkeypatch):
+    monkeypatch.setattr(core.envcache, "cached_archive", lambda path, cache_dir: cache_dir + "/abc/env.tar.gz")
+    files, _ = core._files_and_build_script("/tmp/env.tar.gz", cache_dir="hdfs:///envs")
+    f = files["environment"]
+    assert f.source == "hdfs:///envs/abc/env.tar.gz"
+    assert str(f.visibility) == "PUBLIC"
+    assert str(f.type) == "ARCHIVE"
+    files, _ = core._files_and_build_script("hdfs:///shared/env.tar.gz", cache_dir="hdfs:///envs")
+    assert files["environment"].source == "hdfs:///shared/env.tar.gz"
+
+
+@pytest.mark.usefixtures("load_config")
+def test_concurrent_scale_is_coalesced():
+    client = testing.FakeSkeinClient(rpc_latency=0.05)
+    cluster = core.YarnCluster(environment="python:///usr/bin/python", skein_client=client, scale_interval=0.1)
+    app = client.applications[cluster.app_id]
+    calls = []
+    scale = app.scale
+
+    def counting_scale(service, count=None, delta=None):
+        calls.append(count)
+        return scale(service, count=count, delta=delta)
+    app.scale = counting_scale
+
+    threads = [threading.Thread(target=cluster.scale, args=(1,))]
+    threads[0].start()
+    time.sleep(0.01)
+    # arrive while the first call is in flight, merged into one for the latest size
+    for n in range(2, 22):
+        threads.append(threading.Thread(target=cluster.scale, args=(n,)))
+        threads[-1].start()
+        time.sleep(0.001)
+    for t in threads:
+        t.join()
+    assert calls[0] == 1
+    assert len(calls) == 2
+    assert len(cluster.workers()) == calls[1] > 1
+
+
+@pytest.mark.usefixtures("load_config")
+def test_concurrent_scale_merged_for_largest_size():
+    client = testing.FakeSkeinClient(rpc_latency=0.05)
+    cluster = core.YarnCluster(environment="python:///usr/bin/python", skein_client=client, scale_interval=0.1)
+    first = threading.Thread(target=cluster.scale, args=(1,))
+    first.start()
+    time.sleep(0.01)
+    # both wait for the first call in flight and are merged, the smaller one arriving last
+    threads = [threading.Thread(target=cluster.scale, args=(n,)) for n in (10, 5)]
+    for t in threads:
+        t.start()
+        time.sleep(0.01)
+    for t in [first] + threads:
+        t.join()
+    assert len(cluster.workers()) == 10
+    cluster.shutdown()
+
+
+@pytest.mark.usefixtures("load_config")
+def test_scale_rate_limited_and_errors_raised():
+    client = testing.FakeSkeinClient(rpc_latency=0.02)
+    cluster = core.YarnCluster(environment="python:///usr/bin/python", skein_client=client, scale_interval=0.2)
+    start = time.perf_counter()
+    # one at a time, nothing to merge so nothing waits
+    for n in range(1, 5):
+        cluster.scale(n)
+    assert time.perf_counter() - start < 0.2
+    assert len(cluster.workers()) == 4
+    # arriving while one is in flight, spaced by the interval
+    threads = [threading.Thread(target=cluster.scale, args=(n,)) for n in (5, 6)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+        t.join(0.01)
+    for t in threads:
+        t.join()
+    assert time.perf_counter() - start >= 0.2
+    assert len(cluster.workers()) == 6
+    cluster.shutdown()
+    with pytest.raises(skein.ApplicationNotRunningError):
+        cluster.scale(7)
+
+
+@pytest.mark.usefixtures("load_config")
+def test_detach():
+    client = testing.FakeSkeinClient()
+    cluster = core.YarnCluster(environment="python:///usr/bin/python", skein_client=client)
+    app = client.applications[cluster.app_id]
+    cluster.detach()
+    del cluster
+    assert not app.finished
+    cluster = core.YarnCluster(environment="python:///usr/bin/python", skein_client=client)
+    cluster.detach()
+    cluster.shutdown()
+    assert client.applications[cluster.app_id].finished
+    app.shutdown()
+
+
+@pytest.mark.usefixtures("load_config")
+def test_resize():
+    client = testing.FakeSkeinClient()
+    cluster = core.YarnCluster(environment="python:///usr/bin/python", skein_client=client)
+    cluster.scale(3)
+    cluster.resize(1)
+    assert [c.id for c in cluster.workers()] == ["ray.worker_0"]
+    assert sorted(cluster.application_client.kv.get_prefix(core._RELEASED_PREFIX)) == [
+        core._RELEASED_PREFIX + "ray.worker_1", core._RELEASED_PREFIX + "ray.worker_2"]
+    cluster.resize(2)
+    assert len(cluster.workers()) == 2
+    assert cluster.reconcile().target == 2
+    cluster.shutdown()
+
+
+@pytest.mark.usefixtures("load_config")
+def test_gang_scale_waits_for_all_workers():
+    sim = testing.SimulatedYarn(vcores=9, allocation_delay=lambda rng: rng.uniform(1, 20))
+    with sim.patch():
+        cluster = core.YarnCluster(environment="python:///usr/bin/python", skein_client=sim)
+        cluster.scale(8, gang=True, timeout=60)
+        assert 1 < sim.time() <= 60
+        assert len(cluster._joined()) == 8
+
+
+@pytest.mark.usefixtures("load_config")
+def test_joined_once_ray_node_registered():
+    cluster = core.YarnCluster(environment="python:///usr/bin/python", skein_client=testing.FakeSkeinClient())
+    cluster.scale(2)
+    kv = cluster.application_client.kv
+    assert cluster._joined() == {"ray.worker_0", "ray.worker_1"}
+    # ports are published before ray starts, they don't make a worker joined
+    topology.withdraw(kv, "ray.worker_1")
+    kv[core._RAY_PORTS_PREFIX + "ray.worker_1"] = b"{}"
+    assert cluster._joined() == {"ray.worker_0"}
+    cluster.shutdown()
+
+
+@pytest.mark.usefixtures("load_config")
+def test_gang_scale_releases_partial_allocation():
+    # room for head and 6 workers
+    sim = testing.SimulatedYarn(vcores=7, allocation_delay=1)
+    with sim.patch():
+        cluster = core.YarnCluster(environment="python:///usr/bin/python", skein_client=sim)
+        cluster.scale(2)
+        sim.sleep(2)
+        with pytest.raises(TimeoutError, match="6 of 8 workers joined"):
+            cluster.scale(8, gang=True, timeout=30)
+        assert 30 <= sim.time() < 35
+        # workers before the call are kept, capacity of the others is given back
+        assert len(cluster.workers()) == 2
+        assert sim.used_vcores == 3
+        assert cluster.health().target == 2
+        # released ones don't request replacements as they drain
+        released = cluster.application_client.kv.get_prefix(core._RELEASED_PREFIX)
+        assert len(released) == 6 and core._RELEASED_PREFIX + "ray.worker_0" not in released
@@ -0,0 +1,70 @@
+import pytest
+import ray
+from ray_yarn import data, locality
+from ray_yarn.locality import BlockLocation
+
+
+def test_plan_splits():
+    blocks = [
+        BlockLocation("/a", 0, 10, ["h1", "h2"]),
+        BlockLocation("/a", 10, 10, ["h1", "h2"]),
+        BlockLocation("/a", 20, 10, ["h1"]),
+        BlockLocation("/b", 0, 10, ["h3"]),
+    ]
+    splits = data.plan_splits(blocks, {"h1": ["n1", "n2"], "h2": ["n3"]})
+    assert [(s.host, s.node_id) for s in splits] == [("h1", "n1"), ("h2", "n3"), ("h1", "n2"), (None, None)]
+    assert [(s.path, s.offset, s.length) for s in splits] == [(b.path, b.offset, b.length) for b in blocks]
+
+
+def _write_parquet(path, num_rows, row_group_size):
+    pa = pytest.importorskip("pyarrow")
+    pq = pytest.importorskip("pyarrow.parquet")
+    table = pa.table({"id": list(range(num_rows)), "value": [str(i) for i in range(num_rows)]})
+    pq.write_table(table, str(path), row_group_size=row_group_size)
+
+
+def test_read_split_parquet(tmp_path):
+    fs = pytest.importorskip("pyarrow.fs")
+    path = tmp_path / "part-0.parquet"
+    _write_parquet(path, 10000, 1000)
+    blocks = locality.local_block_locations([str(tmp_path)], 8 * 1024, ["h1"])
+    assert len(blocks) > 1
+    splits = data.plan_splits(blocks, {"h1": ["n1"]})
+    ids = []
+    for split in splits:
+        for batch in data.read_split(split, fs.LocalFileSystem(), columns=["id"]):
+            assert batch.schema.names == ["id"]
+            ids.extend(batch.column(0).to_pylist())
+    # every row group is read by exactly one split
+    assert ids == list(range(10000))
+
+
+def test_read_split_remote_puts_batches(tmp_path):
+    fs = pytest.importorskip("pyarrow.fs")
+    path = tmp_path / "part-0.parquet"
+    _write_parquet(path, 1000, 1000)
+    split = data.Split(str(path), 0, path.stat().st_size, None, None)
+    ray.init(num_cpus=1)
+    try:
+        refs = data._as_completed([data._read_split_remote.remote(split, fs.LocalFileSystem(), data.FORMAT_PARQUET,
+                                                                  ["id"], 100)])
+        batches = [ray.get(ref) for ref in refs]
+        # one object per batch
+        assert [b.num_rows for b in batches] == [100] * 10
+        assert [i for b in batches for i in b.column(0).to_pylist()] == list(range(1000))
+    finally:
+        ray.shutdown()
+
+
+def test_read_split_binary(tmp_path):
+    fs = pytest.importorskip("pyarrow.fs")
+    path = tmp_path / "file.bin"
+    path.write_bytes(bytes(range(256)) * 10)
+    blocks = locality.local_block_locations([str(path)], 1000, [])
+    assert [b.length for b in blocks] == [1000, 1000, 560]
+    splits = [data.Split(b.path, b.offset, b.length, None, None) for b in blocks]
+    content = b"".join(next(data.read_split(s, fs.LocalFileSystem(), format=data.FORMAT_BINARY)).column(0)[0].as_py()
+                       for s in splits)
+    assert content == path.read_bytes()
+    with pytest.raises(ValueError):
+        data.read_split(data.Split(str(path), 0, 1, None, None), fs.LocalFileSystem(), format="csv")
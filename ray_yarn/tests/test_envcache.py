@@ -0,0 +1,43 @@
+import pytest
+from ray_yarn import config, envcache
+
+
+@pytest.fixture
+def user_config(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, "USER_CONFIG_LOC", str(tmp_path / "config"))
+
+
+@pytest.mark.usefixtures("user_config")
+def test_archive_digest(tmp_path, monkeypatch):
+    archive = tmp_path / "env.tar.gz"
+    archive.write_bytes(b"content")
+    digest = envcache.archive_digest(str(archive))
+    assert digest == "ed7002b439e9ac845f22357d822bac1444730fbdb6016d3ec9432297b9ec9f73"
+    # remembered, not hashed again
+    monkeypatch.setattr(envcache.hashlib, "sha256", None)
+    assert envcache.archive_digest(str(archive)) == digest
+
+
+@pytest.mark.usefixtures("user_config")
+def test_cached_archive(tmp_path, monkeypatch):
+    archive = tmp_path / "env.tar.gz"
+    archive.write_bytes(b"content")
+    calls = []
+    existing = set()
+
+    def hdfs(*args):
+        calls.append(args)
+        if args[0] == "-test":
+            return 0 if args[2] in existing else 1
+        if args[0] == "-put":
+            existing.add(args[2])
+        return 0
+    monkeypatch.setattr(envcache, "_hdfs", hdfs)
+    target = envcache.cached_archive(str(archive), "hdfs:///envs/")
+    digest = envcache.archive_digest(str(archive))
+    assert target == "hdfs:///envs/%s/env.tar.gz" % digest
+    assert ("-put", str(archive), target) in calls
+    assert ("-chmod", "644", target) in calls
+    calls.clear()
+    assert envcache.cached_archive(str(archive), "hdfs:///envs") == target
+    assert calls == [("-test", "-e", target)]
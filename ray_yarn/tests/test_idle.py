@@ -0,0 +1,111 @@
+import threading
+import time
+import pytest
+import ray
+from ray_yarn import core, idle, testing
+from .conftest import Clock
+
+_BUSY = idle.Activity(1, 0, [])
+_IDLE = idle.Activity(0, 0, [])
+
+
+@pytest.mark.usefixtures("load_config")
+def test_reaper_scales_down_then_shuts_down():
+    cluster = core.YarnCluster(environment="python:///usr/bin/python", skein_client=testing.FakeSkeinClient(),
+                               idle_timeout=600, idle_shutdown_timeout=1800)
+    head_env = cluster.spec.services[core._HEAD_SERVICE].env
+    assert (head_env[core._ENV_IDLE_TIMEOUT], head_env[core._ENV_IDLE_SHUTDOWN_TIMEOUT]) == ("600", "1800")
+    assert core._ENV_IDLE_TIMEOUT not in cluster.spec.services[core._WORKER_SERVICE].env
+    cluster.scale(2)
+    app = cluster.application_client
+    clock = Clock()
+    activity = [_BUSY]
+    reaper = idle.Reaper(app, lambda: activity[0], 600, 1800, core._WORKER_SERVICE, clock=clock)
+    assert reaper.check() is None
+    activity[0] = _IDLE
+    clock.now = 100
+    assert reaper.check() is None
+    clock.now = 700
+    assert reaper.check() == "scale-down"
+    assert not cluster.workers()
+    # reconciliation doesn't replace workers scaled down for idleness
+    assert cluster.reconcile().target == 0
+    assert not cluster.workers()
+
+    # in use again, then scaled up by client
+    clock.now = 800
+    activity[0] = _BUSY
+    assert reaper.check() is None
+    assert app.kv.get(core._IDLE) is None
+    activity[0] = _IDLE
+    reaper.check()
+    clock.now = 1400
+    assert reaper.check() == "scale-down"
+    cluster.scale(1)
+    assert len(cluster.workers()) == 1 and app.kv.get(core._IDLE) is None
+    # idle from the scale up
+    clock.now = 2000
+    assert reaper.check() is None
+    clock.now = 2600
+    assert reaper.check() == "scale-down"
+    clock.now = 4400
+    assert reaper.check() == "shutdown"
+    assert app.finished and app.final_status == "SUCCEEDED"
+    assert "idle timeout" in app.diagnostics and "2400 seconds" in app.diagnostics
+    cluster.shutdown()
+
+
+@pytest.mark.usefixtures("load_config")
+def test_reaper_shuts_down_without_scale_down():
+    client = testing.FakeSkeinClient()
+    app = client.connect(client.submit(core._make_specification(ray_runtime_cfg=core.RayRuntimeConfig(),
+                                                                 environment="python:///usr/bin/python")))
+    clock = Clock()
+    removed = []
+    reaper = idle.Reaper(app, lambda: _IDLE, 0, 60, core._WORKER_SERVICE, on_shutdown=lambda: removed.append(1),
+                         clock=clock)
+    assert reaper.check() is None
+    clock.now = 60
+    assert reaper.check() == "shutdown"
+    assert app.finished and removed == [1]
+    assert app.kv.get(core._RAY_SHUTDOWN) == b"SUCCEEDED"
+
+
+@pytest.mark.usefixtures("load_config")
+def test_reaper_disabled_if_activity_unreadable(monkeypatch):
+    monkeypatch.setattr(idle, "_POLL_INTERVAL", 0.01)
+    client = testing.FakeSkeinClient()
+    app = client.connect(client.submit(core._make_specification(ray_runtime_cfg=core.RayRuntimeConfig(),
+                                                                 environment="python:///usr/bin/python")))
+
+    def activity():
+        raise ImportError("ray can't read GCS state")
+    reaper = idle.Reaper(app, activity, 60, 0, core._WORKER_SERVICE)
+    thread = threading.Thread(target=reaper.run, args=(threading.Event(),))
+    thread.start()
+    thread.join(5)
+    # the reaper stops, not the head
+    assert not thread.is_alive()
+    assert not app.finished
+
+
+def test_gcs_activity():
+    ray.init(num_cpus=2)
+    try:
+        activity = idle.gcs_activity(ray.worker.global_worker.node.gcs_address)
+        # this driver
+        assert activity() == idle.Activity(1, 0, [])
+
+        @ray.remote(num_cpus=1)
+        class Actor(object):
+            def ping(self):
+                return True
+
+        actor = Actor.remote()
+        ray.get(actor.ping.remote())
+        deadline = time.time() + 10
+        while activity().busy_resources != ["CPU"] and time.time() < deadline:
+            time.sleep(0.1)
+        assert activity() == idle.Activity(1, 1, ["CPU"])
+    finally:
+        ray.shutdown()
@@ -45,7 +45,7 @@ def test_load_yarn_yaml():
     assert yarn_cfg is not None
     assert yarn_cfg['num-cpus'] == 1
     head_cfg = yarn_cfg['head']
-    assert head_cfg['port'] == 6379
+    assert head_cfg['port'] == 0
 
 
 def test_parse_env_literal():
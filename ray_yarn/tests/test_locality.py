@@ -0,0 +1,47 @@
+from ray_yarn import locality
+from ray_yarn.locality import BlockLocation
+
+FSCK_OUTPUT = """
+Connecting to namenode via http://namenode:9870/fsck?ugi=testuser&files=1&blocks=1&locations=1&path=%2Fdata
+FSCK started by testuser (auth:SIMPLE) from /172.18.0.5 for path /data at Mon Oct 18 12:00:00 UTC 2021
+
+/data <dir>
+/data/part-0.parquet 201326592 bytes, replicated: replication=2, 2 block(s):  OK
+0. BP-929597290-172.17.0.2-1634:blk_1073741825_1001 len=134217728 Live_repl=2  \
+[DatanodeInfoWithStorage[10.0.0.1:9866,DS-5e1d,DISK], DatanodeInfoWithStorage[10.0.0.2:9866,DS-8a0c,DISK]]
+1. BP-929597290-172.17.0.2-1634:blk_1073741826_1002 len=67108864 Live_repl=2  \
+[DatanodeInfoWithStorage[10.0.0.2:9866,DS-8a0c,DISK], DatanodeInfoWithStorage[10.0.0.3:9866,DS-1f2e,DISK]]
+
+/data/part-1.parquet 1024 bytes, replicated: replication=1, 1 block(s):  OK
+0. BP-929597290-172.17.0.2-1634:blk_1073741827_1003 len=1024 Live_repl=1  \
+[DatanodeInfoWithStorage[10.0.0.4:9866,DS-9b9b,DISK]]
+
+Status: HEALTHY
+"""
+
+
+def test_parse_fsck(monkeypatch):
+    monkeypatch.setattr(locality.socket, "gethostbyaddr", lambda a: ("host" + a.split('.')[-1], [], [a]))
+    blocks = locality.parse_fsck(FSCK_OUTPUT)
+    assert blocks == [
+        BlockLocation("/data/part-0.parquet", 0, 134217728, ["host1", "host2"]),
+        BlockLocation("/data/part-0.parquet", 134217728, 67108864, ["host2", "host3"]),
+        BlockLocation("/data/part-1.parquet", 0, 1024, ["host4"]),
+    ]
+
+
+def test_bytes_by_host():
+    blocks = [BlockLocation("/a", 0, 10, ["h1", "h2"]), BlockLocation("/a", 10, 5, ["h2", "h3"])]
+    assert list(locality.bytes_by_host(blocks).items()) == [("h2", 15), ("h1", 10), ("h3", 5)]
+
+
+def test_preferred_hosts():
+    blocks = [
+        BlockLocation("/a", 0, 100, ["h1", "h2"]),
+        BlockLocation("/a", 100, 100, ["h2", "h3"]),
+        BlockLocation("/b", 0, 50, ["h4"]),
+        BlockLocation("/c", 0, 50, []),
+    ]
+    assert locality.preferred_hosts(blocks) == ["h2", "h4"]
+    assert locality.preferred_hosts(blocks, max_hosts=1) == ["h2"]
+    assert locality.preferred_hosts([]) == []
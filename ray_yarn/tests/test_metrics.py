@@ -0,0 +1,109 @@
+import urllib.request
+import pytest
+from ray_yarn import core, metrics, testing
+from .conftest import wait_for
+
+
+@pytest.fixture
+def enabled():
+    metrics.enable()
+    yield
+    metrics.disable()
+
+
+def test_disabled_is_noop():
+    registry = metrics.Registry()
+    h = metrics.Histogram("h_seconds", "help", registry=registry)
+    g = metrics.Gauge("g", "help", registry=registry)
+    h.observe(1.0)
+    g.set(1, state="RUNNING")
+    assert h.count() == 0
+    assert g.get(state="RUNNING") is None
+    assert "h_seconds_count" not in registry.render()
+
+
+@pytest.mark.usefixtures("enabled")
+def test_render():
+    registry = metrics.Registry()
+    h = metrics.Histogram("h_seconds", "Some help", buckets=(0.1, 1.0), registry=registry)
+    g = metrics.Gauge("g", "Gauge help", registry=registry)
+    h.observe(0.05, key="address")
+    h.observe(0.5, key="address")
+    h.observe(5, key="address")
+    g.set(3, state="RUNNING")
+    text = registry.render()
+    assert "# HELP h_seconds Some help" in text
+    assert "# TYPE h_seconds histogram" in text
+    assert 'h_seconds_bucket{key="address",le="0.1"} 1' in text
+    assert 'h_seconds_bucket{key="address",le="1.0"} 2' in text
+    assert 'h_seconds_bucket{key="address",le="+Inf"} 3' in text
+    assert 'h_seconds_sum{key="address"} 5.55' in text
+    assert 'h_seconds_count{key="address"} 3' in text
+    assert "# TYPE g gauge" in text
+    assert 'g{state="RUNNING"} 3' in text
+
+
+@pytest.mark.usefixtures("enabled")
+def test_time_decorator():
+    registry = metrics.Registry()
+    h = metrics.Histogram("h_seconds", "help", registry=registry)
+
+    @h.time()
+    def f(x):
+        return x + 1
+
+    assert f(1) == 2
+    assert h.count() == 1
+
+
+@pytest.mark.usefixtures("enabled")
+def test_http_server():
+    registry = metrics.Registry()
+    metrics.Gauge("g", "help", registry=registry).set(1)
+    server = metrics.start_http_server(0, addr="127.0.0.1", registry=registry)
+    try:
+        with urllib.request.urlopen("http://127.0.0.1:%d/metrics" % server.server_port) as resp:
+            assert resp.headers["Content-Type"].startswith("text/plain")
+            assert "g 1" in resp.read().decode()
+    finally:
+        server.shutdown()
+
+
+class _KVClient(object):
+    def __init__(self, kv):
+        self.kv = kv
+
+
+@pytest.mark.usefixtures("enabled")
+def test_kv_wait_instrumented():
+    before = metrics.KV_WAIT_SECONDS.count(key="ports")
+    assert core._get_or_wait_kv(_KVClient({"ports/ray.worker_0": b"{}"}), "ports/ray.worker_0", 0) == b"{}"
+    assert metrics.KV_WAIT_SECONDS.count(key="ports") == before + 1
+
+
+@pytest.mark.usefixtures("enabled")
+def test_gauge_remove():
+    registry = metrics.Registry()
+    g = metrics.Gauge("g", "help", registry=registry)
+    g.set(1, app_id="app_1", state="RUNNING")
+    g.set(2, app_id="app_1", state="FAILED")
+    g.set(3, app_id="app_2", state="RUNNING")
+    g.remove(app_id="app_1")
+    assert 'app_id="app_1"' not in registry.render()
+    assert g.get(app_id="app_2", state="RUNNING") == 3
+
+
+@pytest.mark.usefixtures("enabled", "load_config")
+def test_head_address_seconds_when_it_appears():
+    client = testing.FakeSkeinClient(head_address_latency=0.2)
+    cluster = core.YarnCluster(environment="python:///usr/bin/python", skein_client=client)
+    # set as the address appeared, not when it's first read
+    wait_for(lambda: metrics.HEAD_ADDRESS_SECONDS.get(app_id=cluster.app_id) is not None)
+    seconds = metrics.HEAD_ADDRESS_SECONDS.get(app_id=cluster.app_id)
+    assert 0.2 <= seconds < 0.5
+    cluster.get_home_ip()
+    assert metrics.HEAD_ADDRESS_SECONDS.get(app_id=cluster.app_id) == seconds
+    cluster.workers()
+    assert metrics.CONTAINERS.get(app_id=cluster.app_id, state="RUNNING") is not None
+    cluster.shutdown()
+    assert cluster.app_id not in metrics.REGISTRY.render()
@@ -0,0 +1,60 @@
+import pytest
+from skein.model import Resources
+from ray_yarn import cli, core, planner, testing
+
+
+def test_plan_without_waste():
+    nodes = [Resources(memory=256 * 1024, vcores=64)] * 20
+    best = planner.plan(400, 1600 * 1024, nodes)[0]
+    assert best == planner.Plan(16, 65536, 25, 0.0, 0.0)
+
+
+def test_plan_rounds_to_increments():
+    # 3000 MiB per vcore, rounded up to 1536 MiB increments
+    nodes = [Resources(memory=96 * 1024, vcores=32)] * 10
+    plans = planner.plan(100, 300000, nodes, memory_increment=1536)
+    assert all(p.memory % 1536 == 0 for p in plans)
+    best = plans[0]
+    assert best.count * best.vcores >= 100 and best.count * best.memory >= 300000
+    # as good as the shape of one vcore, with fewer containers
+    naive = planner._evaluate(1, 3072, 100, 300000, planner.Counter({(32, 96 * 1024): 10}))
+    assert best.waste + best.fragmentation <= naive.waste + naive.fragmentation
+    assert best.count < naive.count
+
+
+def test_plan_fits_nodes():
+    nodes = [Resources(memory=64 * 1024, vcores=16), Resources(memory=32 * 1024, vcores=8)]
+    plans = planner.plan(1000, 4000 * 1024, nodes)
+    assert all(p.vcores <= 16 and p.memory <= 64 * 1024 for p in plans)
+    with pytest.raises(ValueError):
+        planner.plan(0, 1024, nodes)
+    with pytest.raises(ValueError):
+        planner.plan(10, 1024, [])
+
+
+@pytest.mark.usefixtures("load_config")
+def test_yarn_cluster_target_resources():
+    client = testing.FakeSkeinClient(hosts=["host%d" % i for i in range(4)], node_resources=Resources(65536, 16))
+    cluster = core.YarnCluster(environment="python:///usr/bin/python", skein_client=client,
+                               target_resources={"vcores": 40, "memory": "160GiB"})
+    workers = cluster.spec.services[core._WORKER_SERVICE]
+    assert (workers.resources.vcores, workers.resources.memory, workers.instances) == (8, 32768, 5)
+    assert len(cluster.workers()) == 5
+    assert cluster.health().target == 5
+    cluster.shutdown()
+
+
+@pytest.mark.usefixtures("load_config")
+def test_plan_command(capfd, monkeypatch):
+    with pytest.raises(SystemExit) as exc:
+        cli.main(["plan", "--vcores", "400", "--memory", "1600GiB", "--node-vcores", "64", "--node-memory",
+                  "256GiB", "--nodes", "20", "--top", "1"])
+    assert exc.value.code == 0
+    lines = capfd.readouterr().out.splitlines()
+    assert len(lines) == 2
+    assert lines[1].split()[:3] == ["16", "65536", "25"]
+    client = testing.FakeSkeinClient(node_resources=Resources(65536, 16))
+    monkeypatch.setattr(cli, "_get_skein_client", lambda: client)
+    with pytest.raises(SystemExit):
+        cli.main(["plan", "--vcores", "32", "--memory", "128GiB"])
+    assert capfd.readouterr().out.splitlines()[1].split()[:3] == ["16", "65536", "2"]
@@ -0,0 +1,167 @@
+import time
+import pytest
+from ray_yarn import core, idle, pool, testing
+from .conftest import Clock, wait_for
+
+_ENVIRONMENT = "python:///usr/bin/python"
+_IDLE = idle.Activity(0, 0, [])
+
+
+def _new_pool(client, idle=2, workers=1, **kwargs):
+    shape = pool.Shape("small", idle, workers, {"environment": _ENVIRONMENT, "skein_client": client})
+    kwargs.setdefault("activity", lambda cluster: lambda: _IDLE)
+    p = pool.ClusterPool([shape], **kwargs)
+    p.maintain()
+    wait_for(lambda: p.status()["small"]["idle"] == idle)
+    return p
+
+
+@pytest.mark.usefixtures("load_config")
+def test_shapes_from_config():
+    shapes = pool.shapes_from_config({"shapes": {"small": {"idle": 2, "workers": 4, "queue": "q1", "num_cpus": 4}}})
+    assert len(shapes) == 1
+    shape = shapes[0]
+    assert (shape.name, shape.idle, shape.workers) == ("small", 2, 4)
+    assert shape.options["queue"] == "q1"
+    assert shape.options["name"] == "ray-pool-small"
+    assert shape.options["ray_runtime_cfg"].num_cpus == 4
+    with pytest.raises(ValueError):
+        pool.shapes_from_config({"shapes": {"small": {"cpus": 4}}})
+    assert pool.shapes_from_config(None) == []
+
+
+@pytest.mark.usefixtures("load_config")
+def test_lease_and_release():
+    client = testing.FakeSkeinClient()
+    p = _new_pool(client)
+    start = time.perf_counter()
+    lease = p.lease("small")
+    assert time.perf_counter() - start < 0.05
+    assert lease.address.startswith("ray://127.0.0.1:")
+    # replacement of the leased cluster is started
+    wait_for(lambda: p.status()["small"] == {"idle": 2, "starting": 0, "leased": 1})
+
+    app = client.applications[lease.app_id]
+    app.scale("ray.worker", count=5)
+    app.kv[core._DRAIN_PREFIX + "ray.worker_0"] = b"1"
+    p.release(lease.lease_id)
+    # pool is full, the returned cluster is retired
+    wait_for(lambda: app.finished)
+    assert p.status()["small"] == {"idle": 2, "starting": 0, "leased": 0}
+    with pytest.raises(KeyError):
+        p.release(lease.lease_id)
+    with pytest.raises(KeyError):
+        p.lease("large")
+    p.shutdown()
+    assert all(a.finished for a in client.applications.values())
+
+
+@pytest.mark.usefixtures("load_config")
+def test_release_resets_cluster():
+    client = testing.FakeSkeinClient()
+    p = _new_pool(client, idle=1, workers=2)
+    lease = p.lease("small")
+    app = client.applications[lease.app_id]
+    app.scale("ray.worker", count=5)
+    app.kv[core._DRAIN_PREFIX + "ray.worker_0"] = b"1"
+    wait_for(lambda: p.status()["small"]["idle"] == 1)
+    # pool is not full, the returned cluster is reset and kept
+    p.shapes["small"] = p.shapes["small"]._replace(idle=2)
+    p.release(lease.lease_id)
+    wait_for(lambda: p.status()["small"]["idle"] == 2)
+    assert not app.finished
+    assert len(app.get_containers(services=["ray.worker"])) == 2
+    assert not app.kv.get_prefix(core._DRAIN_PREFIX)
+    # removed workers don't request replacements
+    assert len(app.kv.get_prefix(core._RELEASED_PREFIX)) == 3
+    p.shutdown()
+
+
+@pytest.mark.usefixtures("load_config")
+def test_release_retires_cluster_left_in_use(monkeypatch):
+    monkeypatch.setattr(pool, "_RESET_POLL_INTERVAL", 0.01)
+    client = testing.FakeSkeinClient()
+    # a detached actor of the lease, then a driver that disconnects shortly after release
+    activity = {}
+    p = _new_pool(client, idle=1, activity=lambda cluster: lambda: activity.get(cluster.app_id, _IDLE),
+                  reset_timeout=0.5)
+    first, second = p.lease("small"), p.lease("small")
+    wait_for(lambda: p.status()["small"] == {"idle": 1, "starting": 0, "leased": 2})
+    # pool is not full, returned clusters are kept if they're reset
+    p.shapes["small"] = p.shapes["small"]._replace(idle=3)
+    activity[first.app_id] = idle.Activity(0, 1, [])
+    activity[second.app_id] = idle.Activity(1, 0, ["CPU"])
+    with pytest.warns(UserWarning, match="ray still in use after lease, 0 drivers, 1 actors"):
+        p.release(first.lease_id)
+        p.release(second.lease_id)
+        time.sleep(0.1)
+        activity[second.app_id] = _IDLE
+        wait_for(lambda: client.applications[first.app_id].finished)
+    wait_for(lambda: second.app_id in [c.cluster.app_id for c in p._idle["small"]])
+    assert not client.applications[second.app_id].finished
+    assert p.retired == 1
+    p.shutdown()
+
+
+@pytest.mark.usefixtures("load_config")
+def test_quick_leases_keep_idle_target():
+    client = testing.FakeSkeinClient()
+    p = _new_pool(client, idle=2)
+    for _ in range(5):
+        p.release(p.lease("small").lease_id)
+    wait_for(lambda: p.status()["small"]["starting"] == 0 and p.status()["small"]["leased"] == 0)
+    p.maintain()
+    wait_for(lambda: p.status()["small"] == {"idle": 2, "starting": 0, "leased": 0})
+    p.shutdown()
+
+
+@pytest.mark.usefixtures("load_config")
+def test_retire_after_max_leases_and_idle_time():
+    client = testing.FakeSkeinClient()
+    clock = Clock(1000.0)
+    p = _new_pool(client, idle=1, max_leases=1, max_idle_time=60, clock=clock)
+    lease = p.lease("small")
+    app = client.applications[lease.app_id]
+    wait_for(lambda: p.status()["small"]["idle"] == 1)
+    p.release(lease.lease_id)
+    wait_for(lambda: app.finished)
+    assert p.retired == 1
+    idle = p._idle["small"][0].cluster.app_id
+    clock.now += 61
+    p.maintain()
+    wait_for(lambda: client.applications[idle].finished)
+    wait_for(lambda: p.status()["small"]["idle"] == 1)
+    assert p._idle["small"][0].cluster.app_id != idle
+    p.shutdown()
+
+
+@pytest.mark.usefixtures("load_config")
+def test_lease_timeout():
+    client = testing.FakeSkeinClient()
+    p = _new_pool(client, idle=1)
+    p.shapes["small"] = p.shapes["small"]._replace(idle=0)
+    p.lease("small")
+    with pytest.raises(TimeoutError):
+        p.lease("small", timeout=0.05)
+    p.shutdown()
+
+
+@pytest.mark.usefixtures("load_config")
+def test_pool_server_and_client():
+    client = testing.FakeSkeinClient()
+    p = _new_pool(client, idle=1)
+    server = pool.serve(p, 0, "127.0.0.1")
+    try:
+        pool_client = pool.PoolClient("http://127.0.0.1:%d" % server.server_port)
+        with pool_client.leased("small") as lease:
+            assert lease.shape == "small"
+            assert lease.app_id in client.applications
+            assert pool_client.status()["small"]["leased"] == 1
+        wait_for(lambda: pool_client.status()["small"]["leased"] == 0)
+        with pytest.raises(core.RayYarnError):
+            pool_client.lease("large")
+        with pytest.raises(core.RayYarnError):
+            pool_client.release("no-such-lease")
+    finally:
+        server.shutdown()
+        p.shutdown()
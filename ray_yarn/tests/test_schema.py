@@ -0,0 +1,74 @@
+import os
+from inspect import signature
+import pytest
+from ray_yarn import cli, config, core, schema, testing
+
+_YARN_FILE = os.path.dirname(os.path.realpath(__file__)) + "/../yarn.yaml"
+
+
+def test_runtime_schema_from_signature():
+    types = schema.runtime_schema(core.RayRuntimeConfig)
+    assert (types["num_cpus"], types["resources"], types["include_dashboard"], types["temp_dir"]) == \
+        (int, dict, bool, str)
+    assert list(types) == list(signature(core.RayRuntimeConfig.__init__).parameters)[1:]
+
+
+def test_validate_shipped_config():
+    assert schema.validate(config.read_config(_YARN_FILE)) == []
+
+
+def test_validate():
+    problems = schema.validate({
+        "num_cpus": "4", "memory": "2 gigs", "object_store_memory": "1GiB", "usage_interval": 30,
+        "activate_environment": "yes", "capacity_check": "fail", "queuue": "default",
+        "redis_password": "pa$$", "plasma_directory": "/mnt/my disk",
+        "resources": {"res'1": 1.0, "res2": "2"},
+        "head": {"port": 70000, "gcs_redis_address": "redis:6379", "min_worker_port": 20000,
+                 "max_worker_port": 10000},
+        "worker": {"worker_port_list": "10000,10001,x", "initial_instances": True},
+        "driver": {"num_cpus": 1, "memory": "2GiB", "gpus": 1},
+    })
+    assert problems == [
+        "num_cpus: expected int, got str 4",
+        "memory: bad memory size 2 gigs, expected a number with unit like 4GiB",
+        "activate_environment: expected bool, got str yes",
+        "queuue: unknown option",
+        "redis_password: has shell characters but no space, it isn't quoted in container script",
+        "resources: can't be quoted in container script, it has a single quote or newline",
+        "capacity_check: expected one of warn, cap, got fail",
+        "head.port: expected port in 0-65535, got 70000",
+        "worker.worker_port_list: expected comma-separated ports, got 10000,10001,x",
+        "worker.initial_instances: expected int, got bool True",
+        "driver.gpus: unknown option",
+        "head.resources.res2: expected number, got 2",
+        "head.min_worker_port: 20000 is above max_worker_port 10000",
+        "worker.resources.res2: expected number, got 2",
+    ]
+
+
+@pytest.mark.usefixtures("load_config")
+def test_invalid_runtime_config_not_submitted():
+    client = testing.FakeSkeinClient()
+    with pytest.raises(config.ConfigError, match="head.memory: bad memory size 4 gigs") as exc:
+        core.YarnCluster(ray_runtime_cfg=core.RayRuntimeConfig(memory="4 gigs", num_cpus="2"),
+                         environment="python:///usr/bin/python", skein_client=client)
+    assert "worker.num_cpus: expected int, got str 2" in str(exc.value)
+    assert not client.applications
+
+
+def test_validate_command(tmp_path, capfd):
+    with pytest.raises(SystemExit) as exc:
+        cli.main(["validate", _YARN_FILE])
+    assert exc.value.code == 0
+    assert capfd.readouterr().out.strip().endswith(": ok")
+    bad = tmp_path / "yarn.yaml"
+    bad.write_text("yarn:\n  num-cpus: four\n  worker:\n    max-worker-prot: 10999\n")
+    with pytest.raises(SystemExit) as exc:
+        cli.main(["validate", str(bad)])
+    assert exc.value.code == 1
+    assert capfd.readouterr().err.splitlines() == ["%s: num_cpus: expected int, got str four" % bad,
+                                                    "%s: worker.max_worker_prot: unknown option" % bad]
+    bad.write_text("yarn: [\n")
+    with pytest.raises(SystemExit) as exc:
+        cli.main(["validate", str(bad)])
+    assert exc.value.code == 1 and "bad yaml" in capfd.readouterr().err
@@ -0,0 +1,89 @@
+import json
+import os
+import pytest
+import ray
+from ray_yarn import cli, core, spill, testing
+
+_APP_ID = "application_1_0001"
+
+
+def test_configure():
+    kwargs = {}
+    system_config = {}
+    spill.configure(True, kwargs, system_config, "file:///tmp/spill/", _APP_ID)
+    assert kwargs == {"storage": "file:///tmp/spill/" + _APP_ID}
+    assert json.loads(system_config["object_spilling_config"])["type"] == "ray_storage"
+    assert system_config["min_spilling_size"] == spill._MIN_SPILLING_SIZE
+    kwargs = {}
+    system_config = {}
+    spill.configure(False, kwargs, system_config, "file:///tmp/spill", _APP_ID)
+    assert kwargs == {"storage": "file:///tmp/spill/" + _APP_ID}
+    assert not system_config
+    kwargs = {}
+    spill.configure(True, kwargs, system_config, None, _APP_ID)
+    assert not kwargs and not system_config
+
+
+def test_configure_keep_user_values():
+    kwargs = {"storage": "s3://bucket/ray"}
+    system_config = {"object_spilling_config": "{}", "min_spilling_size": 1}
+    spill.configure(True, kwargs, system_config, "file:///tmp/spill", _APP_ID)
+    assert kwargs == {"storage": "s3://bucket/ray"}
+    assert system_config == {"object_spilling_config": "{}", "min_spilling_size": 1}
+
+
+def test_spill_and_restore(tmp_path):
+    np = pytest.importorskip("numpy")
+    pytest.importorskip("pyarrow.fs")
+    spill_dir = "file://" + str(tmp_path)
+    kwargs = {}
+    system_config = {}
+    spill.configure(True, kwargs, system_config, spill_dir, _APP_ID)
+    # spill any pending object, to fuse several objects per file with small object store
+    system_config["min_spilling_size"] = 30 * 2 ** 20
+    ray.init(num_cpus=1, object_store_memory=80 * 2 ** 20, storage=kwargs["storage"], include_dashboard=False,
+             _system_config=system_config)
+    try:
+        refs = [ray.put(np.full(2 * 2 ** 20, i)) for i in range(8)]
+        for i, ref in enumerate(refs):
+            assert ray.get(ref)[0] == i
+        spilled = [f for _, _, files in os.walk(str(tmp_path / _APP_ID / "spilled_objects")) for f in files]
+    finally:
+        ray.shutdown()
+    assert spilled
+    # objects are fused into files named by first object and count, like "<object id>-multi-2"
+    assert any(int(f.rsplit("-multi-", 1)[1]) > 1 for f in spilled)
+    assert spill.remove(spill_dir, _APP_ID)
+    assert not os.path.exists(str(tmp_path / _APP_ID))
+    assert not spill.remove(spill_dir, _APP_ID)
+
+
+@pytest.mark.usefixtures("load_config")
+def test_spill_dir_removed_on_shutdown(tmp_path):
+    pytest.importorskip("pyarrow.fs")
+    client = testing.FakeSkeinClient()
+    spill_dir = "file://" + str(tmp_path)
+    cluster = core.YarnCluster(environment="python:///usr/bin/python", skein_client=client, spill_dir=spill_dir)
+    for service in cluster.spec.services.values():
+        assert service.env[core._ENV_SPILL_DIR] == spill_dir
+    os.makedirs(str(tmp_path / cluster.app_id / "spilled_objects"))
+    cluster.shutdown()
+    assert not os.path.exists(str(tmp_path / cluster.app_id))
+
+
+@pytest.mark.usefixtures("load_config")
+def test_spill_dir_removed_by_exiting_head(tmp_path):
+    pytest.importorskip("pyarrow.fs")
+    client = testing.FakeSkeinClient()
+    spill_dir = "file://" + str(tmp_path)
+    cluster = core.YarnCluster(environment="python:///usr/bin/python", skein_client=client, spill_dir=spill_dir,
+                               head_max_restarts=1)
+    app = client.applications[cluster.app_id]
+    os.makedirs(str(tmp_path / cluster.app_id))
+    # kept for head restarted in place
+    cli._remove_spilled(app, spill_dir)
+    assert os.path.exists(str(tmp_path / cluster.app_id))
+    # removed when the application shuts down without YarnCluster.shutdown
+    cluster._finalizer()
+    cli._remove_spilled(app, spill_dir)
+    assert not os.path.exists(str(tmp_path / cluster.app_id))
@@ -0,0 +1,239 @@
+import gc
+import time
+import pytest
+from ray_yarn import core, testing
+from .conftest import wait_for
+
+
+@pytest.mark.usefixtures("load_config")
+def test_yarn_cluster_with_fake_client():
+    client = testing.FakeSkeinClient(allocation_latency=0.05, hosts=["h1", "h2"])
+    cluster = core.YarnCluster(environment="python:///usr/bin/python", skein_client=client)
+    assert cluster.get_home_ip() == "127.0.0.1"
+    cluster.scale(3)
+    workers = cluster.workers()
+    assert [w.id for w in workers] == ["ray.worker_0", "ray.worker_1", "ray.worker_2"]
+    assert all(str(w.state) == "REQUESTED" for w in workers)
+    wait_for(lambda: all(str(w.state) == "RUNNING" for w in cluster.workers()))
+    workers = cluster.workers()
+    assert {w.yarn_node_http_address for w in workers} == {"h1:8042", "h2:8042"}
+    assert client.application_report(cluster.app_id).usage.num_used_containers == 4
+    cluster.shutdown(status="FAILED", diagnostics="done")
+    report = client.application_report(cluster.app_id)
+    assert str(report.final_status) == "FAILED"
+    assert report.diagnostics == "done"
+    assert client.applications[cluster.app_id].finished
+
+
+@pytest.mark.usefixtures("load_config")
+def test_fake_kv_latency_and_delay():
+    client = testing.FakeSkeinClient(kv_latency=0.01, head_address_latency=0.05)
+    app = client.applications[client.submit(core._make_specification(
+        ray_runtime_cfg=core.RayRuntimeConfig(), environment="python:///usr/bin/python"))]
+    start = time.perf_counter()
+    assert app.kv.get(core._RAY_HEAD_ADDRESS) is None
+    assert time.perf_counter() - start >= 0.01
+    wait_for(lambda: app.kv.get(core._RAY_HEAD_ADDRESS) is not None)
+    assert app.kv.get(core._RAY_HEAD_ADDRESS) == b"127.0.0.1:6379"
+
+
+@pytest.mark.usefixtures("load_config")
+def test_simulated_yarn_capacity_and_delay():
+    sim = testing.SimulatedYarn(vcores=10, allocation_delay=lambda rng: rng.uniform(5, 10))
+    with sim.patch():
+        cluster = core.YarnCluster(environment="python:///usr/bin/python", skein_client=sim)
+        # waits for head address in simulated time
+        assert cluster.get_home_ip(timeout=60) == "127.0.0.1"
+        assert 5 <= sim.time() <= 11
+        cluster.scale(20)
+        sim.sleep(60)
+        states = [str(w.state) for w in cluster.workers()]
+        # 1 vcore each, head takes one
+        assert states.count("RUNNING") == 9
+        assert states.count("REQUESTED") == 11
+        cluster.shutdown()
+    assert sim.used_vcores == 0
+
+
+@pytest.mark.usefixtures("load_config")
+def test_simulated_yarn_failures_and_restarts():
+    sim = testing.SimulatedYarn(failure_rate=1.0, seed=1)
+    with sim.patch():
+        cluster = core.YarnCluster(environment="python:///usr/bin/python",
+                                   ray_runtime_cfg=core.RayRuntimeConfig(max_restarts=-1), skein_client=sim)
+        app = sim.applications[cluster.app_id]
+        cluster.scale(100)
+        # head can't restart, so its failure would end application
+        app.spec.services["ray.head"].max_restarts = -1
+        sim.sleep(10 * 3600)
+        assert app.restarts["ray.worker"] > 500
+        assert len([w for w in cluster.workers() if str(w.state) == "RUNNING"]) == 100
+        failed = app.get_containers(services=["ray.worker"], states=["FAILED"])
+        assert len(failed) == app.restarts["ray.worker"]
+
+
+@pytest.mark.usefixtures("load_config")
+def test_simulated_yarn_preemption():
+    sim = testing.SimulatedYarn(vcores=51)
+    with sim.patch():
+        cluster = core.YarnCluster(environment="python:///usr/bin/python",
+                                   ray_runtime_cfg=core.RayRuntimeConfig(max_restarts=-1), skein_client=sim)
+        app = sim.applications[cluster.app_id]
+        cluster.scale(50)
+        sim.sleep(1)
+        sim.set_capacity(vcores=21)
+        assert sim.preempted == 30
+        assert sim.used_vcores == 21
+        assert app.restarts["ray.worker"] == 30
+        assert len(cluster.workers()) == 50
+        assert not app.finished
+        # preemption of head ends application as it can't restart
+        sim.preempt(1, service="ray.head")
+        assert app.finished
+        assert app.final_status == "FAILED"
+        assert sim.used_vcores == 0
+
+
+@pytest.mark.usefixtures("load_config")
+def test_simulated_yarn_max_restarts():
+    sim = testing.SimulatedYarn()
+    with sim.patch():
+        cluster = core.YarnCluster(environment="python:///usr/bin/python",
+                                   ray_runtime_cfg=core.RayRuntimeConfig(max_restarts=2), skein_client=sim)
+        app = sim.applications[cluster.app_id]
+        cluster.scale(5)
+        sim.sleep(1)
+        sim.preempt(2, service="ray.worker")
+        assert app.restarts["ray.worker"] == 2
+        assert not app.finished
+        sim.sleep(1)
+        sim.preempt(1, service="ray.worker")
+        assert app.finished
+        assert "ray.worker" in app.diagnostics
+
+
+@pytest.mark.usefixtures("load_config")
+def test_simulated_yarn_scale_5000():
+    sim = testing.SimulatedYarn(vcores=4001, allocation_delay=lambda rng: rng.expovariate(1 / 30.0))
+    with sim.patch():
+        cluster = core.YarnCluster(environment="python:///usr/bin/python", skein_client=sim)
+        cluster.scale(5000)
+        sim.sleep(3600)
+        assert sim.used_vcores == 4001
+        assert sum(1 for w in cluster.workers() if str(w.state) == "RUNNING") == 4000
+
+
+@pytest.mark.usefixtures("load_config")
+def test_simulated_yarn_head_restart():
+    sim = testing.SimulatedYarn(allocation_delay=5, head_address_latency=3)
+    with sim.patch():
+        cluster = core.YarnCluster(environment="python:///usr/bin/python", head_max_restarts=1, skein_client=sim)
+        app = sim.applications[cluster.app_id]
+        cluster.scale(10)
+        sim.sleep(10)
+        assert app.kv.get(core._RAY_HEAD_ADDRESS) == b"127.0.0.1:6379"
+        events = app.kv.events(key=core._RAY_HEAD_ADDRESS, event_type="PUT")
+        failed_at = sim.time()
+        sim.preempt(1, service="ray.head")
+        assert not app.finished
+        event = next(events)
+        # restarted head is allocated and publishes its address, workers stay
+        assert event.result.value == b"127.0.0.1:6380"
+        assert sim.time() - failed_at == pytest.approx(8, abs=0.2)
+        assert app.restarts["ray.head"] == 1
+        assert len(cluster.workers()) == 10
+        assert cluster.get_home_ip(refresh=True) == "127.0.0.1"
+        sim.preempt(1, service="ray.head")
+        assert app.finished
+
+
+@pytest.mark.usefixtures("load_config")
+def test_reconcile_replaces_failed_workers_in_batches(monkeypatch):
+    monkeypatch.setattr(core, "_REPLACE_BATCH_SIZE", 4)
+    sim = testing.SimulatedYarn(hosts=["h%d" % i for i in range(10)])
+    with sim.patch():
+        cluster = core.YarnCluster(environment="python:///usr/bin/python",
+                                   ray_runtime_cfg=core.RayRuntimeConfig(max_restarts=0), skein_client=sim)
+        app = sim.applications[cluster.app_id]
+        app.spec.services["ray.worker"].allow_failures = True
+        cluster.scale(20)
+        sim.sleep(1)
+        for c in cluster.workers()[:10]:
+            app.fail_container(c.id)
+        assert len(cluster.workers()) == 10
+        health = cluster.reconcile()
+        assert (health.target, health.active, health.failed, health.replaced) == (20, 14, 10, 4)
+        cluster.reconcile()
+        cluster.reconcile()
+        assert len(cluster.workers()) == 20
+        assert cluster.health().replaced == 10
+        assert cluster.health().bad_hosts == []
+        # scale is based on live workers after reconciliation
+        cluster.scale(22)
+        assert len(cluster.workers()) == 22
+
+
+@pytest.mark.usefixtures("load_config")
+def test_reconcile_drains_bad_hosts_once():
+    sim = testing.SimulatedYarn(hosts=["h0", "h1", "h2"])
+    with sim.patch():
+        cluster = core.YarnCluster(environment="python:///usr/bin/python",
+                                   ray_runtime_cfg=core.RayRuntimeConfig(max_restarts=-1), skein_client=sim)
+        app = sim.applications[cluster.app_id]
+        cluster.scale(9)
+        sim.sleep(1)
+        # containers crash on h0 over and over, skein restarts them
+        for _ in range(3):
+            for c in cluster.workers():
+                if c.yarn_node_http_address.startswith("h0:"):
+                    app.fail_container(c.id)
+                    break
+            sim.sleep(1)
+        on_h0 = {c.id for c in cluster.workers() if c.yarn_node_http_address.startswith("h0:")}
+        assert on_h0
+        health = cluster.reconcile()
+        assert health.bad_hosts == ["h0"]
+        assert health.host_failures == {"h0": 3}
+        # workers on h0 are drained, they leave for replacements themselves
+        assert {k[len(core._DRAIN_PREFIX):] for k in app.kv.get_prefix(core._DRAIN_PREFIX)} == on_h0
+        for container_id in on_h0:
+            app.kill_container(container_id)
+            app.scale(core._WORKER_SERVICE, delta=1)
+        sim.sleep(1)
+        cluster.reconcile()
+        sim.sleep(1)
+        assert len(cluster.workers()) == 9
+        # workers landing on h0 again are kept, rather than drained over and over
+        while not any(c.yarn_node_http_address.startswith("h0:") for c in cluster.workers()):
+            cluster.scale(len(cluster.workers()) + 1)
+            sim.sleep(1)
+        cluster.reconcile()
+        assert {k[len(core._DRAIN_PREFIX):] for k in app.kv.get_prefix(core._DRAIN_PREFIX)} == on_h0
+        assert not cluster.application_client.kv.get_prefix(core._RELEASED_PREFIX)
+        # h0 stays bad within the window
+        assert cluster.health().bad_hosts == ["h0"]
+        # failures age out of the window
+        sim.sleep(core._BAD_HOST_WINDOW)
+        assert cluster.health().bad_hosts == []
+        cluster.reconcile()
+        assert cluster._drained_hosts == set()
+
+
+@pytest.mark.usefixtures("load_config")
+def test_reconcile_in_background():
+    client = testing.FakeSkeinClient()
+    cluster = core.YarnCluster(environment="python:///usr/bin/python",
+                               ray_runtime_cfg=core.RayRuntimeConfig(max_restarts=0), skein_client=client,
+                               reconcile_interval=0.01)
+    app = client.applications[cluster.app_id]
+    app.spec.services["ray.worker"].allow_failures = True
+    cluster.scale(3)
+    app.fail_container(cluster.workers()[0].id)
+    wait_for(lambda: len(app.get_containers(services=["ray.worker"])) == 3)
+    assert cluster.health().replaced == 1
+    assert cluster.health().failed == 1
+    assert len(cluster.workers()) == 3
+    # reconciler doesn't keep dropped clusters alive, finalizer shuts them down
+    del cluster
+    gc.collect()
+    assert app.finished
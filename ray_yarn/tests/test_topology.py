@@ -0,0 +1,90 @@
+import sys
+import threading
+import time
+from types import SimpleNamespace
+import pytest
+import ray
+from ray_yarn import cli, core, testing, topology
+from .conftest import wait_for
+
+
+def _info(container, node_id, host):
+    return topology.NodeInfo(container, node_id, host, "10.0.0.1", {"node_manager_port": 40000})
+
+
+def test_topology_index():
+    nodes = topology.Topology()
+    nodes.add(_info("ray.worker_0", "n0", "host0"))
+    nodes.add(_info("ray.worker_1", "n1", "host0"))
+    nodes.add(_info("ray.worker_2", "n2", "host1"))
+    assert nodes.by_container("ray.worker_1").node_id == "n1"
+    assert nodes.by_node_id("n2").container == "ray.worker_2"
+    assert sorted(n.container for n in nodes.on_host("host0")) == ["ray.worker_0", "ray.worker_1"]
+    # rejoined restarted head with a new node id
+    nodes.add(_info("ray.worker_0", "n3", "host0"))
+    assert nodes.by_node_id("n0") is None and nodes.by_node_id("n3").container == "ray.worker_0"
+    nodes.discard("ray.worker_2")
+    nodes.discard("ray.worker_2")
+    assert nodes.by_container("ray.worker_2") is None and nodes.on_host("host1") == []
+    assert sorted(nodes.hosts()) == ["host0"] and len(nodes) == 2
+
+
+@pytest.mark.usefixtures("load_config")
+def test_yarn_cluster_topology():
+    cluster = core.YarnCluster(environment="python:///usr/bin/python",
+                               skein_client=testing.FakeSkeinClient(hosts=["host0", "host1"]))
+    cluster.scale(2)
+    kv = cluster.application_client.kv
+    nodes = cluster.topology()
+    assert cluster.topology() is nodes
+    # published by containers once their ray nodes registered
+    wait_for(lambda: nodes.by_container("ray.worker_1") is not None)
+    worker = nodes.by_container("ray.worker_1")
+    assert nodes.by_node_id(worker.node_id) is worker
+    # published again after the view started, like by a worker rejoining a restarted head
+    topology.publish(kv, _info("ray.worker_1", "n1", worker.host))
+    wait_for(lambda: nodes.by_node_id("n1") is not None)
+    assert nodes.by_node_id(worker.node_id) is None
+    assert "ray.worker_1" in [n.container for n in nodes.on_host(worker.host)]
+    cluster.application_client.fail_container("ray.worker_1")
+    cluster.reconcile()
+    assert nodes.by_node_id("n1") is None and nodes.by_container("ray.worker_0") is not None
+    assert topology._NODES_PREFIX + "ray.worker_1" not in kv
+    # withdrawn by exiting container
+    topology.withdraw(kv, "ray.worker_0")
+    wait_for(lambda: nodes.by_container("ray.worker_0") is None)
+    # and the replacement of the failed one joined
+    wait_for(lambda: sorted(n.container for n in nodes) == ["ray.head_0", "ray.worker_2"])
+    watch = next(t for t in threading.enumerate() if t.name == "ray-yarn-topology")
+    cluster.shutdown()
+    watch.join(5)
+    assert not watch.is_alive()
+
+
+def test_publish_node(monkeypatch):
+    ray.init(num_cpus=1)
+    try:
+        node = ray.nodes()[0]
+        gcs_address = ray.worker.global_worker.node.gcs_address
+        ip, port = node["NodeManagerAddress"], node["NodeManagerPort"]
+        assert topology.find_node_id(gcs_address, ip, port) == node["NodeID"]
+        with pytest.raises(TimeoutError):
+            topology.find_node_id(gcs_address, ip, port + 1, timeout=0)
+
+        kv = testing.FakeKeyValueStore(time)
+        monkeypatch.setenv("SKEIN_CONTAINER_ID", "ray.worker_0")
+        monkeypatch.setenv("NM_HOST", "host0")
+        cli._publish_node(SimpleNamespace(kv=kv), gcs_address,
+                          {"node_ip_address": ip, "node_manager_port": port, "object_manager_port": 40001})
+        info = topology._parse(kv[topology._NODES_PREFIX + "ray.worker_0"])
+        assert info == topology.NodeInfo("ray.worker_0", node["NodeID"], "host0", ip,
+                                         {"node_manager_port": port, "object_manager_port": 40001})
+    finally:
+        ray.shutdown()
+
+
+def test_gcs_state_unsupported(monkeypatch):
+    # like ray versions without it
+    monkeypatch.setitem(sys.modules, "ray.state", None)
+    with pytest.raises(ImportError, match="can't read GCS state"):
+        topology.gcs_state("127.0.0.1:6379")
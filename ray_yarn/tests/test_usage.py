@@ -0,0 +1,76 @@
+import json
+import subprocess
+import sys
+import threading
+import time
+import pytest
+from ray_yarn import cli, core, testing, usage
+
+_BUSY = "import time\nend = time.time() + 30\nwhile time.time() < end: pass"
+
+
+@pytest.fixture
+def busy_tree():
+    # a process with busy child, like ray with a worker running a task
+    spawn = "import subprocess, sys; subprocess.call([sys.executable, '-c', %r])" % _BUSY
+    parent = subprocess.Popen([sys.executable, "-c", spawn])
+    yield parent
+    for p in usage.psutil.Process(parent.pid).children(recursive=True):
+        p.kill()
+    parent.kill()
+    parent.wait()
+
+
+def test_sampler(busy_tree):
+    kv = testing.FakeKeyValueStore(time)
+    sampler = usage.Sampler(kv, "ray.worker_0", lambda: busy_tree.pid, 1)
+    time.sleep(0.5)
+    sampler.sample()
+    time.sleep(0.5)
+    sampler._window.append(sampler.sample())
+    cpu, rss, shared = sampler._window[-1]
+    assert 0.5 < cpu < 1.5
+    assert rss > 1
+    sampler.publish()
+    summary = json.loads(kv[usage._USAGE_PREFIX + "ray.worker_0"].decode())
+    assert summary["cpu"] == summary["cpu_max"] == round(cpu, 3)
+    assert summary["rss_max"] >= summary["rss"] > 1
+    assert not sampler._window
+
+
+def test_sampler_run_publishes_every_interval(busy_tree, monkeypatch):
+    monkeypatch.setattr(usage, "_SAMPLE_INTERVAL", 0.05)
+    kv = testing.FakeKeyValueStore(time)
+    sampler = usage.Sampler(kv, "ray.worker_0", lambda: busy_tree.pid, 0.2)
+    stopped = threading.Event()
+    thread = threading.Thread(target=sampler.run, args=(stopped,))
+    thread.start()
+    events = kv.events(key=usage._USAGE_PREFIX + "ray.worker_0", event_type="PUT", poll_interval=0.01)
+    times = [json.loads(next(events).result.value.decode())["t"] for _ in range(2)]
+    stopped.set()
+    thread.join()
+    assert times[1] > times[0]
+    # gone process is not sampled
+    assert usage.Sampler(kv, "ray.worker_1", lambda: 2 ** 22 + 1, 1).sample() == (0.0, 0.0, 0.0)
+
+
+@pytest.mark.usefixtures("load_config")
+def test_resource_usage(capfd, monkeypatch):
+    client = testing.FakeSkeinClient()
+    cluster = core.YarnCluster(ray_runtime_cfg=core.RayRuntimeConfig(num_cpus=4, memory=8192),
+                               environment="python:///usr/bin/python", skein_client=client)
+    cluster.scale(1)
+    summary = {"t": 1.0, "cpu": 1.0, "cpu_max": 3.5, "rss": 2048.0, "rss_max": 4096.0, "shared": 1024.0}
+    cluster.application_client.kv[usage._USAGE_PREFIX + "ray.worker_0"] = json.dumps(summary).encode()
+    usages = {u.container: u for u in cluster.resource_usage()}
+    assert usages["ray.worker_0"] == usage.ContainerUsage("ray.worker_0", "ray.worker", "host0", 4, 1.0, 3.5, 8192,
+                                                          2048.0, 4096.0, 1024.0, 1.0)
+    assert usages["ray.head_0"].cpu is None
+
+    monkeypatch.setattr(cli, "_get_skein_client", lambda: client)
+    with pytest.raises(SystemExit) as exc:
+        cli.main(["usage", cluster.app_id])
+    assert exc.value.code == 0
+    out = capfd.readouterr().out
+    assert "1.0 (25%)" in out and "4096.0 (50%)" in out
+    cluster.shutdown()
@@ -0,0 +1,153 @@
+"""Which YARN container runs which ray node, on which host.
+
+Each container publishes ``NodeInfo`` of its ray node to application kv at ``nodes/<container
+id>`` once the node registered with GCS, and again when it rejoins a restarted head, and
+withdraws it when it exits. ``YarnCluster`` withdraws those of containers gone without exiting,
+like killed ones. ``Topology`` indexes them by container id, ray node id and host, and follows kv
+events so that it's updated incrementally rather than joining containers and ``ray.nodes()`` by
+IP address.
+"""
+import json
+import queue
+import threading
+import time
+from collections import namedtuple
+
+_NODES_PREFIX = "nodes/"
+_REGISTER_POLL_INTERVAL = 1
+_REGISTER_TIMEOUT = 300
+# how often watch checks if it's stopped while no event arrives
+_WATCH_POLL_INTERVAL = 1
+
+NodeInfo = namedtuple("NodeInfo", ["container", "node_id", "host", "ip", "ports"])
+NodeInfo.__doc__ = """Ray node of a container. ``host`` is its NodeManager host, ``ip`` the address ray binds,
+and ``ports`` the ports of ray processes by option name, like ``node_manager_port``.
+"""
+
+
+def gcs_state(gcs_address):
+    """``ray.state.GlobalState`` reading tables of GCS at address without connecting as a driver.
+
+    It's not public API of ray, raises ImportError if this ray version doesn't have it.
+    """
+    try:
+        from ray.state import GlobalState
+        from ray._raylet import GcsClientOptions
+        options = GcsClientOptions.from_gcs_address(gcs_address)
+    except (ImportError, AttributeError) as e:
+        import ray
+        raise ImportError("ray %s can't read GCS state without a driver: %s" % (ray.__version__, e))
+    state = GlobalState()
+    state._initialize_global_state(options)
+    return state
+
+
+def find_node_id(gcs_address, ip, node_manager_port, timeout=_REGISTER_TIMEOUT, clock=time):
+    """Id of the live ray node of raylet at ip and port, waiting until it registers with GCS.
+
+    Reads GCS tables without connecting as a driver. Raises TimeoutError if it doesn't register
+    in time.
+    """
+    state = gcs_state(gcs_address)
+    deadline = clock.time() + timeout
+    while True:
+        try:
+            for node in state.node_table():
+                if node["Alive"] and node["NodeManagerAddress"] == ip and node["NodeManagerPort"] == node_manager_port:
+                    return node["NodeID"]
+        except Exception:
+            pass  # GCS not up yet
+        if clock.time() >= deadline:
+            raise TimeoutError("ray node at %s:%d didn't register with GCS %s in %s seconds"
+                               % (ip, node_manager_port, gcs_address, timeout))
+        clock.sleep(_REGISTER_POLL_INTERVAL)
+
+
+def publish(kv, info):
+    kv[_NODES_PREFIX + info.container] = _dump(info)
+
+
+def withdraw(kv, container_id):
+    kv.discard(_NODES_PREFIX + container_id)
+
+
+def _dump(info):
+    return json.dumps(info._asdict(), separators=(',', ':')).encode()
+
+
+def _parse(value):
+    return NodeInfo(**json.loads(value.decode()))
+
+
+class Topology(object):
+    """Index of ``NodeInfo`` by container id, ray node id and host. Lookups are O(1)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._by_container = {}
+        self._by_node_id = {}
+        self._by_host = {}
+
+    def add(self, info):
+        """Index info, in place of earlier info of its container"""
+        with self._lock:
+            self._remove(info.container)
+            self._by_container[info.container] = info
+            self._by_node_id[info.node_id] = info
+            self._by_host.setdefault(info.host, {})[info.container] = info
+
+    def _remove(self, container_id):
+        info = self._by_container.pop(container_id, None)
+        if info is None:
+            return
+        if self._by_node_id.get(info.node_id) is info:
+            del self._by_node_id[info.node_id]
+        on_host = self._by_host.get(info.host, {})
+        on_host.pop(container_id, None)
+        if not on_host:
+            self._by_host.pop(info.host, None)
+
+    def discard(self, container_id):
+        """Remove info of container which is gone, if any"""
+        with self._lock:
+            self._remove(container_id)
+
+    def by_container(self, container_id):
+        """``NodeInfo`` of container, like ``ray.worker_0``, None if unknown"""
+        return self._by_container.get(container_id)
+
+    def by_node_id(self, node_id):
+        """``NodeInfo`` of ray node by its hex id, None if unknown"""
+        return self._by_node_id.get(node_id)
+
+    def on_host(self, host):
+        """``NodeInfo`` of containers on host"""
+        with self._lock:
+            return list(self._by_host.get(host, {}).values())
+
+    def hosts(self):
+        with self._lock:
+            return list(self._by_host)
+
+    def __len__(self):
+        return len(self._by_container)
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self._by_container.values()))
+
+    def watch(self, kv, stopped, poll_interval=_WATCH_POLL_INTERVAL):
+        """Index infos in kv, then each one published or withdrawn, until ``stopped`` event is set"""
+        # subscribed before the snapshot so that nothing published meanwhile is missed
+        with kv.events(prefix=_NODES_PREFIX) as events:
+            for value in kv.get_prefix(_NODES_PREFIX).values():
+                self.add(_parse(value))
+            while not stopped.is_set():
+                try:
+                    event = events.get(timeout=poll_interval)
+                except queue.Empty:
+                    continue
+                if str(event.event_type) == "DELETE":
+                    self.discard(event.key[len(_NODES_PREFIX):])
+                else:
+                    self.add(_parse(event.result.value))
@@ -0,0 +1,124 @@
+"""Resource usage of ray process trees in containers, compared with their allocations.
+
+``Sampler`` runs in each container next to ray. It samples CPU and memory of the ray process tree
+every few seconds and publishes a summary to application kv at ``usage/<container id>`` once
+per interval. ``resource_usage`` reads the summaries back and pairs them with the resources
+each container was allocated, so that ``num-cpus`` and ``memory`` can be sized by real use.
+
+Memory of a process tree is its private memory plus the largest shared memory of a process.
+Ray workers map the object store, summing their RSS would count it once per worker.
+"""
+import json
+import time
+from collections import namedtuple
+
+import psutil
+
+_USAGE_PREFIX = "usage/"
+# seconds between samples within a publish interval, peaks are taken over samples
+_SAMPLE_INTERVAL = 5
+_MIB = 2 ** 20
+
+ContainerUsage = namedtuple("ContainerUsage", ["container", "service", "host", "vcores", "cpu", "cpu_max",
+                                               "memory", "rss", "rss_max", "shared", "updated"])
+ContainerUsage.__doc__ = """Allocated and used resources of a container.
+
+``vcores`` and ``memory`` (MiB) are allocated. ``cpu`` is average cores used over the last
+interval and ``cpu_max`` the peak of samples in it. ``rss`` and ``shared`` are MiB of memory
+at the last sample and ``rss_max`` the peak since start. Used fields are None until the
+container published a summary, ``updated`` is its time.
+"""
+
+
+class Sampler(object):
+    """Samples the process tree of ``pid()`` and publishes summaries to kv every interval seconds.
+
+    ``pid`` is a callable so that the sampler follows restarted processes.
+    """
+
+    def __init__(self, kv, container_id, pid, interval, clock=time):
+        self.kv = kv
+        self.key = _USAGE_PREFIX + container_id
+        self.pid = pid
+        self.interval = interval
+        self.clock = clock
+        # psutil processes by pid, reused so that CPU times are diffed per process
+        self._processes = {}
+        self._cpu_times = {}
+        self._last = None
+        self._rss_max = 0
+        self._window = []
+
+    def _tree(self):
+        pid = self.pid()
+        try:
+            root = self._processes.get(pid) or psutil.Process(pid)
+            tree = [root] + root.children(recursive=True)
+        except psutil.NoSuchProcess:
+            return []
+        self._processes = {p.pid: self._processes.get(p.pid, p) for p in tree}
+        return list(self._processes.values())
+
+    def sample(self):
+        """Sample the process tree, returns (cpu cores since last sample, rss MiB, shared MiB)"""
+        now = self.clock.time()
+        cpu_times, private, shared = {}, 0, 0
+        for p in self._tree():
+            try:
+                with p.oneshot():
+                    times = p.cpu_times()
+                    memory = p.memory_info()
+            except (psutil.NoSuchProcess, psutil.AccessDenied):
+                continue
+            cpu_times[p.pid] = times.user + times.system
+            mem_shared = getattr(memory, "shared", 0)
+            private += memory.rss - mem_shared
+            shared = max(shared, mem_shared)
+        # processes started since last sample count from zero
+        used = sum(t - self._cpu_times.get(pid, 0) for pid, t in cpu_times.items())
+        elapsed = now - self._last if self._last is not None else None
+        self._cpu_times = cpu_times
+        self._last = now
+        rss = (private + shared) / _MIB
+        self._rss_max = max(self._rss_max, rss)
+        cpu = used / elapsed if elapsed else 0.0
+        return cpu, rss, shared / _MIB
+
+    def publish(self):
+        """Publish summary of samples since last publish"""
+        if not self._window:
+            return
+        cpu = sum(s[0] for s in self._window) / len(self._window)
+        _, rss, shared = self._window[-1]
+        summary = {"t": round(self.clock.time(), 1), "cpu": round(cpu, 3),
+                   "cpu_max": round(max(s[0] for s in self._window), 3), "rss": round(rss, 1),
+                   "rss_max": round(self._rss_max, 1), "shared": round(shared, 1)}
+        self.kv[self.key] = json.dumps(summary, separators=(',', ':')).encode()
+        self._window = []
+
+    def run(self, stopped):
+        """Sample and publish until ``stopped`` event is set"""
+        step = min(_SAMPLE_INTERVAL, self.interval)
+        self.sample()
+        next_publish = self.clock.time() + self.interval
+        while not stopped.wait(step):
+            self._window.append(self.sample())
+            if self.clock.time() >= next_publish:
+                self.publish()
+                next_publish += self.interval
+
+
+def resource_usage(app_client):
+    """``ContainerUsage`` of active containers of the application"""
+    spec = app_client.get_specification()
+    summaries = app_client.kv.get_prefix(_USAGE_PREFIX)
+    usages = []
+    for c in app_client.get_containers():
+        resources = spec.services[c.service_name].resources
+        summary = summaries.get(_USAGE_PREFIX + c.id)
+        summary = json.loads(summary.decode()) if summary is not None else {}
+        host = c.yarn_node_http_address.rsplit(':', 1)[0] if c.yarn_node_http_address else None
+        usages.append(ContainerUsage(c.id, c.service_name, host, resources.vcores, summary.get("cpu"),
+                                     summary.get("cpu_max"), resources.memory, summary.get("rss"),
+                                     summary.get("rss_max"), summary.get("shared"), summary.get("t")))
+    return usages
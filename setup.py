@@ -31,6 +31,8 @@ setup(
     long_description=long_description,
     url="https://github.com/ray-project/ray_yarn",
     install_requires=install_requires,
+    # spilling to cluster filesystem and reading files with ray_yarn.data
+    extras_require={"data": ["pyarrow>=3.0"]},
     zip_safe=False,
     entry_points="""
         [console_scripts]